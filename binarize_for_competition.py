@@ -18,6 +18,7 @@ from torchvision.transforms import functional
 from data.TestDataset import FolderDataset
 
 from trainer.LaMaTrainer import LaMaTrainingModule, set_seed
+from trainer.Runtime import make_backend
 from data.dataloaders import make_test_dataloader
 from data.datasets import make_test_dataset
 from trainer.Validator import Validator
@@ -37,6 +38,10 @@ def binarize_for_competition(config_args, config, patch_sizes=[256], strides=[25
     load_data = config['load_data']
     trainer = LaMaTrainingModule(config, device=device, make_loaders=False)
     trainer.config['train_batch_size'] = config_args.batch_size
+    if config_args.backend != 'eager':
+        # The exported model is expected next to the checkpoint, as written by export_inference.py
+        export_path = config['resume'].with_suffix('.ts' if config_args.backend == 'torchscript' else '.onnx')
+        trainer.model = make_backend(config_args.backend, export_path, device)
     test_dataset_path = config['test_data_path']
     print(f'Loading {test_dataset_path}')
     tmp_config = config.copy()
@@ -66,10 +71,8 @@ def binarize_for_competition(config_args, config, patch_sizes=[256], strides=[25
         trainer.model.eval()
         validator = Validator(apply_threshold=True, threshold=0.5)
         with torch.no_grad():
-            for i, item in enumerate(test_data_loader):
-                image_name = item['image_name'][0]
-                test_loss_item, validator, images_item = trainer.eval_item(item, validator, 0.5)
-
+            for test_loss_item, validator, images_item in trainer.eval_items(test_data_loader, validator, 0.5):
+                image_name = list(images_item.keys())[0]
                 images_item[image_name][0].save(Path(save_folder, f"{Path(image_name).stem}_test_img.png"))
                 images_item[image_name][1].save(Path(save_folder, f"{Path(image_name).stem}_pred_img.png"))
                 images_item[image_name][2].save(Path(save_folder, f"{Path(image_name).stem}_gt_test_img.png"))
@@ -140,7 +143,9 @@ if __name__ == '__main__':
     parser.add_argument('--min_patch_size', type=int, default=128)
     parser.add_argument('--max_patch_size', type=int, default=768)
     parser.add_argument('--eval_mode', type=str, default='false', choices=['true', 'false'])
+    parser.add_argument('--test_blending', type=str, default='crop', choices=['crop', 'mean', 'gaussian', 'hann'])
     parser.add_argument('--finetuning', type=str, default='false', choices=['true', 'false'])
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnx'])
 
     args = parser.parse_args()
 
@@ -219,6 +224,7 @@ if __name__ == '__main__':
     train_config['apply_threshold_to_test'] = args.apply_threshold_to
     train_config['threshold'] = args.threshold
     train_config['load_data'] = args.load_data == 'true'
+    train_config['test_blending'] = args.test_blending
 
     train_config['apply_threshold_to_train'] = True
     train_config['apply_threshold_to_valid'] = True
@@ -0,0 +1,204 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+# RGB <-> YIQ: hue is rotated as the angle of the chroma (I, Q) plane
+_RGB_TO_YIQ = torch.tensor([[0.299, 0.587, 0.114],
+                            [0.596, -0.274, -0.322],
+                            [0.211, -0.523, 0.312]])
+_YIQ_TO_RGB = torch.linalg.inv(_RGB_TO_YIQ)
+_GRAY = torch.tensor([0.2989, 0.587, 0.114])
+
+
+class _SeededTransform:
+    """Draws its random parameters from a generator on the device of the batch, seeded with seed when given."""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self._generator = None
+        self._generator_device = None
+
+    def _get_generator(self, device):
+        if self._generator is None or self._generator_device != device:
+            self._generator = torch.Generator(device=device)
+            self._generator_device = device
+            if self.seed is not None:
+                self._generator.manual_seed(self.seed)
+            else:
+                self._generator.seed()
+        return self._generator
+
+    def _rand(self, batch_size, device, low=0., high=1.):
+        return torch.rand(batch_size, generator=self._get_generator(device), device=device) * (high - low) + low
+
+
+class BatchAugmentation(_SeededTransform):
+    """
+    Batched, on-device version of the get_transform pipeline: ColorJitter, RandomRotation, RandomHorizontalFlip,
+    RandomVerticalFlip and RandomCrop are applied to whole batches with per-sample random parameters.
+
+    The rotation, the flips and the crop are composed into a single affine sampling grid, so every sample is resampled
+    once with nearest interpolation, and pixels coming from outside the source patch are white, in the image and in
+    the ground truth, as in the PIL pipeline. The parameters are drawn from a generator seeded with seed, so runs are
+    reproducible.
+
+    As in RandomAffineCrop, the colours are jittered before the warp, so the white fill is not jittered: the contrast
+    mean is taken over the whole source patch instead of the window the crop reads from. With jitter_after_warp, as
+    in the 'latin' variant, the warped crop is filled with white first and the jitter sees the fill, as ColorJitter
+    after RandomAffineCrop does.
+    """
+
+    def __init__(self, output_size: int, brightness=0.5, contrast=0.5, saturation=0.5, hue=0.5, degrees=(0, 360),
+                 hflip=0.5, vflip=0.5, color_jitter=True, jitter_after_warp=False, threshold=None, seed=None):
+        self.output_size = output_size
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.degrees = degrees
+        self.hflip = hflip
+        self.vflip = vflip
+        self.color_jitter = color_jitter
+        self.jitter_after_warp = jitter_after_warp
+        self.threshold = threshold
+        super(BatchAugmentation, self).__init__(seed)
+
+    @torch.no_grad()
+    def __call__(self, images, gts):
+        """
+        :param images: uint8 tensor with shape (batch, 3, h, w), as produced by CustomTransform.ToUint8Tensor
+        :param gts: tensor with shape (batch, 1, h, w) with values in [0, 255]
+        :return: float images and ground truths in [0, 1] with spatial size output_size
+        """
+        images = images.float().div_(255)
+        gts = gts.float().div_(255)
+        valid = torch.ones_like(gts)
+
+        if self.color_jitter and not self.jitter_after_warp:
+            images = self._jitter(images)
+
+        stacked = self._resample(torch.cat([images, gts, valid], dim=1))
+        images, gts, valid = stacked[:, :3], stacked[:, 3:4], stacked[:, 4:5]
+
+        # Outside of the source patch: white, like the fill of the PIL rotation
+        images = torch.where(valid > 0, images, torch.ones_like(images))
+        gts = torch.where(valid > 0, gts, torch.ones_like(gts))
+
+        if self.color_jitter and self.jitter_after_warp:
+            images = self._jitter(images)
+
+        if self.threshold is not None:
+            gts = (gts > self.threshold).float()
+        return images, gts
+
+    def _resample(self, x):
+        batch_size, _, height, width = x.shape
+        size = self.output_size
+        device = x.device
+
+        angle = torch.deg2rad(self._rand(batch_size, device, *self.degrees))
+        hflip = self._rand(batch_size, device) < self.hflip
+        vflip = self._rand(batch_size, device) < self.vflip
+        top = torch.floor(self._rand(batch_size, device) * (height - size + 1))
+        left = torch.floor(self._rand(batch_size, device) * (width - size + 1))
+
+        # Pixel centres of the crop in the rotated and flipped patch
+        coords = torch.arange(size, device=device, dtype=x.dtype)
+        v, u = torch.meshgrid(coords, coords, indexing='ij')
+        xs = left.view(-1, 1, 1) + u
+        ys = top.view(-1, 1, 1) + v
+
+        # Undo the flips
+        xs = torch.where(hflip.view(-1, 1, 1), width - 1 - xs, xs)
+        ys = torch.where(vflip.view(-1, 1, 1), height - 1 - ys, ys)
+
+        # Undo the counter-clockwise rotation around the centre of the patch
+        cx, cy = (width - 1) / 2, (height - 1) / 2
+        cos, sin = torch.cos(angle).view(-1, 1, 1), torch.sin(angle).view(-1, 1, 1)
+        src_x = cx + cos * (xs - cx) - sin * (ys - cy)
+        src_y = cy + sin * (xs - cx) + cos * (ys - cy)
+
+        grid = torch.stack([(2 * src_x + 1) / width - 1, (2 * src_y + 1) / height - 1], dim=-1)
+        return F.grid_sample(x, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def _jitter(self, images):
+        batch_size = images.shape[0]
+        device = images.device
+        view = (-1, 1, 1, 1)
+        gray_weights = _GRAY.to(device).view(1, 3, 1, 1)
+
+        brightness = self._rand(batch_size, device, 1 - self.brightness, 1 + self.brightness).view(view)
+        contrast = self._rand(batch_size, device, 1 - self.contrast, 1 + self.contrast).view(view)
+        saturation = self._rand(batch_size, device, 1 - self.saturation, 1 + self.saturation).view(view)
+        hue = self._rand(batch_size, device, -self.hue, self.hue)
+
+        images = (images * brightness).clamp_(0, 1)
+
+        mean = (images * gray_weights).sum(dim=1, keepdim=True).mean(dim=(2, 3), keepdim=True)
+        images = (contrast * images + (1 - contrast) * mean).clamp_(0, 1)
+
+        gray = (images * gray_weights).sum(dim=1, keepdim=True)
+        images = (saturation * images + (1 - saturation) * gray).clamp_(0, 1)
+
+        # Hue: rotate the chroma by hue * 2 pi, one 3x3 colour matrix per sample
+        theta = hue * 2 * math.pi
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        rotation = torch.zeros(batch_size, 3, 3, device=device)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+        rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+        matrix = _YIQ_TO_RGB.to(device) @ rotation @ _RGB_TO_YIQ.to(device)
+        images = torch.einsum('bij,bjhw->bihw', matrix, images)
+        return images.clamp_(0, 1)
+
+
+class BatchMerge(_SeededTransform):
+    """
+    The merge_image augmentation on whole batches: with probability merge_probability, every sample is overlaid on
+    another sample of the same batch by taking the pixel-wise minimum of the images and of the ground truths, so ink of
+    both samples is kept. With a batch of one sample there is nothing to merge with.
+    """
+
+    def __init__(self, merge_probability=1., seed=None):
+        super(BatchMerge, self).__init__(seed)
+        self.merge_probability = merge_probability
+
+    @torch.no_grad()
+    def __call__(self, images, gts):
+        """
+        :param images: tensor with shape (batch, 3, h, w) with values in [0, 1]
+        :param gts: tensor with shape (batch, 1, h, w) with values in [0, 1]
+        """
+        batch_size = images.shape[0]
+        if batch_size < 2 or self.merge_probability <= 0:
+            return images, gts
+        device = images.device
+
+        # Partner of every sample: the next one in a random order, never the sample itself
+        order = torch.randperm(batch_size, generator=self._get_generator(device), device=device)
+        partner = torch.empty_like(order)
+        partner[order] = order.roll(-1)
+
+        merge = (self._rand(batch_size, device) < self.merge_probability).view(-1, 1, 1, 1)
+        images = torch.where(merge, torch.minimum(images, images[partner]), images)
+        gts = torch.where(merge, torch.minimum(gts, gts[partner]), gts)
+        return images, gts
+
+
+def make_batch_transform(config: dict):
+    """
+    :return: the BatchAugmentation equivalent to get_transform for the configured variant, or None when the
+    variant has no batched equivalent
+    """
+    variant = config.get('train_transform_variant', None)
+    output_size = config['train_patch_size']
+    seed = config.get('seed', None)
+
+    if variant in (None, 'threshold_mask', 'no_color_jitter'):
+        return BatchAugmentation(output_size, color_jitter=variant != 'no_color_jitter',
+                                 threshold=0.9 if variant == 'threshold_mask' else None, seed=seed)
+    elif variant == 'latin':
+        return BatchAugmentation(output_size, degrees=(-10, 10), hflip=0., vflip=0., jitter_after_warp=True,
+                                 seed=seed)
+    return None
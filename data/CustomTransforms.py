@@ -1,5 +1,7 @@
+import math
 import random
 
+from PIL import Image
 from torchvision import transforms
 from torchvision.transforms import functional
 
@@ -13,6 +15,14 @@ class ToTensor(transforms.ToTensor):
         return {'image': image, 'gt': gt}
 
 
+class ToUint8Tensor:
+    """PIL images to uint8 tensors, leaving the augmentations to a BatchAugmentation on the collated batch."""
+
+    def __call__(self, sample):
+        image, gt = sample['image'], sample['gt']
+        return {'image': functional.pil_to_tensor(image), 'gt': functional.pil_to_tensor(gt)}
+
+
 class ThresholdMask:
     def __init__(self, threshold=0.5):
         self.threshold = threshold
@@ -87,6 +97,67 @@ class RandomRotation(transforms.RandomRotation):
         return {'image': image, 'gt': gt}
 
 
+class RandomAffineCrop:
+    """
+    RandomRotation, RandomHorizontalFlip, RandomVerticalFlip and RandomCrop(size) in a single warp.
+
+    The rotation angle, the flips and the crop position are drawn first; only the window of the source patch that
+    the output crop maps to is cut out (and colour jittered, if color_jitter is given), and the window is warped
+    straight to the output size with one nearest-neighbour affine transform of the image and the GT together.
+    Pixels coming from outside the patch are white in both, as with the fill of RandomRotation.
+    """
+
+    def __init__(self, size, degrees=(0, 360), hflip=0.5, vflip=0.5, color_jitter=None):
+        self.size = size
+        self.degrees = degrees
+        self.hflip = hflip
+        self.vflip = vflip
+        self.color_jitter = color_jitter
+
+    def plan(self, width, height):
+        """
+        :return: (matrix, window): matrix maps the pixel centres (u, v) of the output to the pixel centres of the
+        source patch as (a * u + b * v + c, d * u + e * v + f), window is the box of the patch it reads from
+        """
+        angle = math.radians(random.uniform(*self.degrees))
+        hflip = random.random() < self.hflip
+        vflip = random.random() < self.vflip
+        top = random.randint(0, height - self.size)
+        left = random.randint(0, width - self.size)
+
+        # Crop, then undo the flips, then undo the counter-clockwise rotation around the centre of the patch
+        sx, tx = (-1, width - 1 - left) if hflip else (1, left)
+        sy, ty = (-1, height - 1 - top) if vflip else (1, top)
+        cx, cy = (width - 1) / 2, (height - 1) / 2
+        cos, sin = math.cos(angle), math.sin(angle)
+        matrix = (cos * sx, -sin * sy, cx + cos * (tx - cx) - sin * (ty - cy),
+                  sin * sx, cos * sy, cy + sin * (tx - cx) + cos * (ty - cy))
+
+        corners = [(u, v) for u in (0, self.size - 1) for v in (0, self.size - 1)]
+        xs = [matrix[0] * u + matrix[1] * v + matrix[2] for u, v in corners]
+        ys = [matrix[3] * u + matrix[4] * v + matrix[5] for u, v in corners]
+        window = (max(0, math.floor(min(xs))), max(0, math.floor(min(ys))),
+                  min(width, math.ceil(max(xs)) + 1), min(height, math.ceil(max(ys)) + 1))
+        return matrix, window
+
+    def __call__(self, sample):
+        image, gt = sample['image'], sample['gt']
+        (a, b, c, d, e, f), (x0, y0, x1, y1) = self.plan(*image.size)
+
+        image = image.crop((x0, y0, x1, y1))
+        gt = gt.crop((x0, y0, x1, y1))
+        if self.color_jitter is not None:
+            image = self.color_jitter(image)
+
+        # PIL maps the continuous coordinates of the output (pixel centres at + 0.5) to those of the window
+        data = (a, b, c + 0.5 - (a + b) * 0.5 - x0, d, e, f + 0.5 - (d + e) * 0.5 - y0)
+        merged = Image.merge('RGBA', (*image.split(), gt))
+        merged = merged.transform((self.size, self.size), Image.AFFINE, data, resample=Image.NEAREST,
+                                  fillcolor=(255, 255, 255, 255))
+        *channels, gt = merged.split()
+        return {'image': Image.merge('RGB', channels), 'gt': gt}
+
+
 class CenterCrop(transforms.CenterCrop):
 
     def __call__(self, sample):
@@ -0,0 +1,328 @@
+import atexit
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+# Header of every segment: height, width, channels, ready flag
+_HEADER = np.dtype('<i8')
+_HEADER_SIZE = 4 * _HEADER.itemsize
+SHM_PATH = '/dev/shm'
+# Fraction of the shared memory filesystem the cache uses by default, and that it always leaves free
+DEFAULT_SHM_FRACTION = 0.5
+SHM_RESERVE_FRACTION = 0.05
+# Budget when the shared memory filesystem cannot be inspected (no /dev/shm)
+FALLBACK_MAX_BYTES = 4 * 1024 ** 3
+# State directory shared by the processes of a cache: inherited by forked and spawned workers alike
+STATE_ENV = 'LAMA_IMAGE_CACHE_DIR'
+STATE_PREFIX = 'lama_image_cache_'
+
+
+def _segment_name(path, mode):
+    stat = os.stat(path)
+    key = f'{Path(path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}:{mode}'
+    # Short enough for the 31 characters limit of macOS
+    return 'lama_' + hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def _shm_space():
+    """:return: total and available bytes of the shared memory filesystem, or None when there is none"""
+    try:
+        stat = os.statvfs(SHM_PATH)
+    except (OSError, AttributeError):
+        return None
+    return stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+
+
+def default_max_bytes():
+    space = _shm_space()
+    return int(space[0] * DEFAULT_SHM_FRACTION) if space else FALLBACK_MAX_BYTES
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _sweep_dead_caches():
+    """Remove the segments and the state directories left by root processes that were killed before their exit."""
+    for state_dir in Path(tempfile.gettempdir()).glob(STATE_PREFIX + '*'):
+        try:
+            pid = int((state_dir / 'pid').read_text())
+        except (OSError, ValueError):
+            continue
+        if _pid_alive(pid):
+            continue
+        try:
+            names = (state_dir / 'segments').read_text().split()
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                segment = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            segment.close()
+            segment.unlink()
+        logger.info(f"Removed {len(names)} shared memory segments left by the dead process {pid}")
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+class ImageCache:
+    """
+    Decoded images in named shared memory segments, keyed by path, modification time and mode.
+
+    A segment created by a process can be attached by any other process by its name, so the DataLoader workers (forked
+    or spawned) and every dataset built on the same files read the pixels decoded once, instead of each holding its
+    own copy. A changed file gets a new name, so stale pixels are never read.
+
+    All the processes of a cache share a state directory: under a file lock, a segment is only created when the bytes
+    created so far by all of them stay within max_bytes and the shared memory filesystem keeps some free space, since
+    its pages are only reserved when written and running out of them kills the writer with SIGBUS instead of raising.
+    Otherwise the image is decoded without caching. The names of the created segments are recorded in the state
+    directory and the root process (the first one to create the cache, which the workers inherit it from) unlinks
+    all of them on clear() and at exit, whichever process created them. A root process killed before its exit
+    handlers leaves them behind: the next root process removes the segments of state directories whose root is dead.
+    Every process only unmaps the segments it uses least recently when its mappings exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._segments = OrderedDict()  # name -> (SharedMemory, shape)
+        self._num_bytes = 0
+        self._pid = os.getpid()
+        self._warned_full = False
+
+        self.state_dir = os.environ.get(STATE_ENV)
+        self.is_root = self.state_dir is None or not os.path.isdir(self.state_dir)
+        if self.is_root:
+            _sweep_dead_caches()
+            self.state_dir = tempfile.mkdtemp(prefix=STATE_PREFIX)
+            os.environ[STATE_ENV] = self.state_dir
+            with open(os.path.join(self.state_dir, 'pid'), 'w') as file:
+                file.write(str(self._pid))
+            self._write_state(0, max_bytes if max_bytes else default_max_bytes())
+        elif max_bytes:
+            self.max_bytes = max_bytes
+        atexit.register(self.close)
+
+    @property
+    def max_bytes(self):
+        with self._locked():
+            return self._read_state()[1]
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._locked():
+            self._write_state(self._read_state()[0], max_bytes)
+
+    def load(self, path, mode='RGB'):
+        """:return: the image at path converted to mode ('RGB' or 'L'), as a PIL image that the caller owns"""
+        array = self._get(path, mode)
+        if array is None:
+            return self._decode(path, mode)
+        # frombytes copies the pixels: the image does not keep the segment mapped
+        return Image.frombytes(mode, (array.shape[1], array.shape[0]), array)
+
+    def load_array(self, path, mode='RGB'):
+        """
+        :return: read-only view on the shared memory with shape (h, w, 3) for RGB or (h, w) for L. The segment is
+        not unmapped while a view is alive.
+        """
+        array = self._get(path, mode)
+        return np.asarray(self._decode(path, mode)) if array is None else array
+
+    def preload(self, paths, mode='RGB'):
+        for path in paths:
+            self._get(path, mode)
+
+    def _decode(self, path, mode):
+        return Image.open(path).convert(mode)
+
+    def _get(self, path, mode):
+        name = _segment_name(path, mode)
+        if name in self._segments:
+            self._segments.move_to_end(name)
+            segment, shape = self._segments[name]
+            return self._view(segment, shape)
+
+        segment, shape = self._attach(name)
+        if segment is None:
+            image = np.asarray(self._decode(path, mode))
+            segment, shape = self._create(name, image)
+            if segment is None:
+                return None
+
+        self._segments[name] = (segment, shape)
+        self._num_bytes += segment.size
+        self._evict(keep=name)
+        return self._view(segment, shape)
+
+    @staticmethod
+    def _view(segment, shape):
+        array = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=_HEADER_SIZE)
+        array.flags.writeable = False
+        return array
+
+    @staticmethod
+    def _attach(name):
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None, None
+        # Only the root process removes the segment: do not let the resource tracker unlink it for this process
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        height, width, channels, ready = np.ndarray(4, dtype=_HEADER, buffer=segment.buf)
+        if not ready:
+            # Still being written by another process
+            segment.close()
+            return None, None
+        shape = (int(height), int(width)) if channels == 1 else (int(height), int(width), int(channels))
+        return segment, shape
+
+    def _create(self, name, image):
+        size = _HEADER_SIZE + image.nbytes
+        with self._locked():
+            used, max_bytes = self._read_state()
+            space = _shm_space()
+            if used + size > max_bytes:
+                return None, None
+            if space and space[1] - size < space[0] * SHM_RESERVE_FRACTION:
+                if not self._warned_full:
+                    logger.warning(f"Only {space[1] / 1024 ** 2:.0f} MB left in {SHM_PATH}, decoding the images that "
+                                   f"do not fit instead of caching them")
+                    self._warned_full = True
+                return None, None
+            try:
+                segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Created by another process in the meantime
+                return self._attach(name)
+            except OSError as e:
+                logger.warning(f"Could not allocate {size} bytes of shared memory, not caching: {e}")
+                return None, None
+            # Only the root process removes the segment, on clear() or, if it was killed, from the next root process
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            self._write_state(used + size, max_bytes)
+            with open(os.path.join(self.state_dir, 'segments'), 'a') as file:
+                file.write(name + '\n')
+
+        header = np.ndarray(4, dtype=_HEADER, buffer=segment.buf)
+        header[:3] = [image.shape[0], image.shape[1], image.shape[2] if image.ndim == 3 else 1]
+        np.ndarray(image.shape, dtype=np.uint8, buffer=segment.buf, offset=_HEADER_SIZE)[:] = image
+        header[3] = 1
+        del header
+        return segment, image.shape
+
+    def _evict(self, keep=None):
+        max_bytes = self.max_bytes
+        for name in list(self._segments):
+            if self._num_bytes <= max_bytes:
+                break
+            if name != keep:
+                self._release(name)
+
+    def _release(self, name):
+        segment, _ = self._segments[name]
+        try:
+            segment.close()
+        except BufferError:
+            # A view returned by load_array is still in use
+            return
+        del self._segments[name]
+        self._num_bytes -= segment.size
+
+    def clear(self):
+        """Unmap the segments of this process and, in the root process, remove every segment of the cache."""
+        for name in list(self._segments):
+            self._release(name)
+        if not self.is_root or os.getpid() != self._pid or not os.path.isdir(self.state_dir):
+            return
+
+        with self._locked():
+            try:
+                with open(os.path.join(self.state_dir, 'segments')) as file:
+                    names = file.read().split()
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                try:
+                    segment = shared_memory.SharedMemory(name=name)
+                except FileNotFoundError:
+                    continue
+                segment.close()
+                segment.unlink()
+            self._write_state(0, self._read_state()[1])
+            open(os.path.join(self.state_dir, 'segments'), 'w').close()
+
+    def close(self):
+        """Remove every segment and the state directory of the cache (root process only)."""
+        self.clear()
+        if self.is_root and os.getpid() == self._pid:
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+            if os.environ.get(STATE_ENV) == self.state_dir:
+                del os.environ[STATE_ENV]
+
+    def _locked(self):
+        return _FileLock(os.path.join(self.state_dir, 'lock'))
+
+    def _read_state(self):
+        with open(os.path.join(self.state_dir, 'state')) as file:
+            used, max_bytes = file.read().split()
+        return int(used), int(max_bytes)
+
+    def _write_state(self, used, max_bytes):
+        tmp_path = os.path.join(self.state_dir, f'state.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as file:
+            file.write(f'{used} {max_bytes}\n')
+        os.replace(tmp_path, os.path.join(self.state_dir, 'state'))
+
+
+class _FileLock:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+_cache = None
+
+
+def get_image_cache():
+    """:return: the ImageCache of this process"""
+    global _cache
+    if _cache is None:
+        _cache = ImageCache()
+    return _cache
+
+
+def set_image_cache_size(max_bytes):
+    """Set the budget of the bytes created by all the processes of the cache, and of the mappings of this process."""
+    cache = get_image_cache()
+    cache.max_bytes = max_bytes
+    cache._evict()
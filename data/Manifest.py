@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from PIL import Image
+
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+MANIFEST_NAME = '.manifest.json'
+MANIFEST_VERSION = 1
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'lama_manifests'
+
+
+class Manifest:
+    """
+    Persisted listing of a dataset folder: every directory with its modification time, its subdirectories and its
+    files with size, modification time and, once read, image size.
+
+    On open, every recorded directory is stat-ed once and only the directories whose modification time changed (files
+    added, removed or renamed) are listed again, instead of walking and stat-ing the whole tree. A file rewritten in
+    place does not change the modification time of its directory, so its entry is only refreshed by rebuild().
+
+    The manifest is written as .manifest.json in the dataset folder, or in ~/.cache/lama_manifests when the folder is
+    read-only.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.dirs = {}
+        self._changed = False
+        self._load()
+        self.refresh()
+
+    @property
+    def paths(self):
+        return [self.root / MANIFEST_NAME,
+                CACHE_DIR / (hashlib.sha1(str(self.root.resolve()).encode()).hexdigest() + '.json')]
+
+    def _load(self):
+        for path in self.paths:
+            try:
+                with open(path) as file:
+                    manifest = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.dirs = manifest['dirs']
+                return
+
+    def save(self):
+        if not self._changed:
+            return
+        manifest = {'version': MANIFEST_VERSION, 'root': str(self.root), 'dirs': self.dirs}
+        for path in self.paths:
+            tmp_path = Path(f'{path}.{os.getpid()}.tmp')
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(tmp_path, 'w') as file:
+                    json.dump(manifest, file)
+                os.replace(tmp_path, path)
+                self._changed = False
+                return
+            except OSError:
+                continue
+        logger.warning(f"Could not write the manifest of {self.root}")
+
+    def refresh(self):
+        """Bring the manifest up to date with the folder, listing again only the directories that changed."""
+        dirs = {}
+        num_listed = self._refresh_dir('.', dirs)
+        if num_listed or dirs.keys() != self.dirs.keys():
+            self._changed = True
+        self.dirs = dirs
+        if num_listed:
+            logger.info(f"Manifest of {self.root}: listed {num_listed}/{len(dirs)} directories")
+        self.save()
+
+    def rebuild(self):
+        self.dirs = {}
+        self.refresh()
+
+    def _refresh_dir(self, relative, dirs):
+        path = self.root / relative
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+        num_listed = 0
+        entry = self.dirs.get(relative)
+        if entry is None or entry['mtime'] != mtime:
+            previous = entry
+            entry = self._list_dir(path, mtime, previous)
+            # Writing the manifest itself changes the mtime of the root: only count directories whose content changed
+            if previous is None or previous['subdirs'] != entry['subdirs'] or previous['files'] != entry['files']:
+                num_listed += 1
+        dirs[relative] = entry
+
+        for name in entry['subdirs']:
+            num_listed += self._refresh_dir(os.path.normpath(os.path.join(relative, name)), dirs)
+        return num_listed
+
+    @staticmethod
+    def _list_dir(path, mtime, previous=None):
+        previous_files = previous['files'] if previous else {}
+        subdirs, files = [], {}
+        with os.scandir(path) as entries:
+            for dir_entry in entries:
+                if dir_entry.name.startswith('.'):
+                    continue
+                if dir_entry.is_dir():
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    file = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+                    old = previous_files.get(dir_entry.name)
+                    if old and old['size'] == file['size'] and old['mtime'] == file['mtime']:
+                        file = old
+                    files[dir_entry.name] = file
+        return {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': files}
+
+    def directories(self, name, min_depth=0):
+        """
+        :param min_depth: number of directories required between the root and the matching directory, e.g. 1 for
+        rglob('*/imgs/*')
+        :return: the relative paths of the directories called name
+        """
+        return [relative for relative in sorted(self.dirs)
+                if relative != '.' and Path(relative).name == name and len(Path(relative).parts) > min_depth]
+
+    def glob(self, name, min_depth=0):
+        """:return: the sorted files of the directories called name, like rglob(f'{name}/*')"""
+        return [self.root / relative / file
+                for relative in self.directories(name, min_depth) for file in sorted(self.dirs[relative]['files'])]
+
+    def listing(self, directory):
+        """
+        :return: the files of directory, as the mapping of the manifest from their names to their entries (not a
+        copy), or an empty mapping when it does not exist
+        """
+        entry = self.dirs.get(self._relative(directory))
+        return entry['files'] if entry else {}
+
+    def image_size(self, path):
+        """:return: (width, height) of the image at path, read from its header the first time only"""
+        path = Path(path)
+        file = self.dirs[self._relative(path.parent)]['files'][path.name]
+        if 'width' not in file:
+            with Image.open(path) as image:
+                file['width'], file['height'] = image.size
+            self._changed = True
+        return file['width'], file['height']
+
+    def _relative(self, path):
+        return os.path.normpath(os.path.relpath(path, self.root))
+
+
+_manifests = {}
+
+
+def open_manifest(root):
+    """:return: the Manifest of root, shared by all the datasets of this process built on the same folder"""
+    key = str(Path(root).resolve())
+    if key in _manifests:
+        _manifests[key].refresh()
+    else:
+        _manifests[key] = Manifest(root)
+    return _manifests[key]
+
+
+def match_page_ground_truths(manifest, imgs):
+    """
+    Ground truth of every page of an imgs folder, in the sibling gt_imgs folder: {stem}_gt.bmp when it exists,
+    {stem}.png otherwise.
+    """
+    gt_imgs = []
+    listings = {}
+    for img_path in imgs:
+        gt_folder = img_path.parent.parent / 'gt_imgs'
+        if gt_folder not in listings:
+            listings[gt_folder] = manifest.listing(gt_folder)
+        names = listings[gt_folder]
+        name = f'{img_path.stem}_gt.bmp' if f'{img_path.stem}_gt.bmp' in names else img_path.stem + '.png'
+        gt_imgs.append(gt_folder / name)
+    return gt_imgs
+
+
+def match_substring_ground_truths(imgs, gt_imgs):
+    """
+    Ground truth of every image as the first of gt_imgs whose stem is contained in the stem of the image, as for
+    mobile-dataset. Instead of comparing every image with every ground truth, the substrings of the stem of each
+    image are looked up in a dictionary of the ground truth stems.
+    """
+    first_by_stem = {}
+    for i, gt_img in enumerate(gt_imgs):
+        first_by_stem.setdefault(gt_img.stem, i)
+    lengths = sorted({len(stem) for stem in first_by_stem})
+
+    matches = []
+    for img_path in imgs:
+        stem = img_path.stem
+        candidates = [first_by_stem[stem[start:start + length]]
+                      for length in lengths if length <= len(stem)
+                      for start in range(len(stem) - length + 1)
+                      if stem[start:start + length] in first_by_stem]
+        if not candidates:
+            raise FileNotFoundError(f"No ground truth found for {img_path}")
+        matches.append(gt_imgs[min(candidates)])
+    return matches
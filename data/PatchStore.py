@@ -0,0 +1,154 @@
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from data.Manifest import open_manifest
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+ARRAY_NAME = 'patches.npy'
+INDEX_NAME = 'index.json'
+
+
+def default_store_path(data_path, patch_size: int):
+    return Path(data_path) / f'patch_store_{patch_size}'
+
+
+def list_patches(data_path, patch_size: int):
+    """The (image, ground truth) pairs of the imgs_{patch_size} / gt_imgs_{patch_size} folders, as TrainingDataset."""
+    imgs = open_manifest(data_path).glob(f'imgs_{patch_size}')
+    gt_imgs = [img_path.parent.parent / ('gt_' + img_path.parent.name) / img_path.name for img_path in imgs]
+    return imgs, gt_imgs
+
+
+def _decode(paths):
+    img_path, gt_img_path = paths
+    sample = np.asarray(Image.open(img_path).convert("RGB"))
+    gt_sample = np.asarray(Image.open(gt_img_path).convert("L"))
+    return sample, gt_sample
+
+
+def allocate_store(dst, shape):
+    """
+    Create the (temporary) array of a store being written, or reopen it when a previous run with the same shape was
+    interrupted.
+
+    :return: the writable memory-mapped array
+    """
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+    tmp_array_path = dst / f'{ARRAY_NAME}.tmp'
+    if tmp_array_path.exists():
+        array = np.load(tmp_array_path, mmap_mode='r+')
+        if list(array.shape) == list(shape):
+            return array
+        del array
+    return np.lib.format.open_memmap(tmp_array_path, mode='w+', dtype=np.uint8, shape=tuple(shape))
+
+
+def has_allocated_store(dst, shape):
+    """:return: whether allocate_store would reopen the array of an interrupted run instead of creating a new one"""
+    tmp_array_path = Path(dst) / f'{ARRAY_NAME}.tmp'
+    if not tmp_array_path.exists():
+        return False
+    array = np.load(tmp_array_path, mmap_mode='r')
+    same_shape = list(array.shape) == list(shape)
+    del array
+    return same_shape
+
+
+def open_allocated_store(dst):
+    return np.load(Path(dst) / f'{ARRAY_NAME}.tmp', mmap_mode='r+')
+
+
+def commit_store(dst, index: dict):
+    """Write the index and move the array of a completely written store in place."""
+    dst = Path(dst)
+    with open(dst / f'{INDEX_NAME}.tmp', 'w') as file:
+        json.dump(index, file)
+    os.replace(dst / f'{ARRAY_NAME}.tmp', dst / ARRAY_NAME)
+    os.replace(dst / f'{INDEX_NAME}.tmp', dst / INDEX_NAME)
+
+
+def build_patch_store(data_path, patch_size: int, dst=None, workers: int = 8):
+    """
+    Decode every patch of data_path once and pack it into a single uint8 array with shape (n, h, w, 4), where the
+    last channel is the ground truth, stored as a .npy file next to a JSON index.
+
+    :return: path of the store
+    """
+    dst = Path(dst) if dst else default_store_path(data_path, patch_size)
+    imgs, gt_imgs = list_patches(data_path, patch_size)
+    if not imgs:
+        raise FileNotFoundError(f"No imgs_{patch_size} patches found in {data_path}")
+
+    first, _ = _decode((imgs[0], gt_imgs[0]))
+    height, width = first.shape[:2]
+    shape = [len(imgs), height, width, 4]
+    array = allocate_store(dst, shape)
+
+    with Pool(workers) as pool:
+        for i, (sample, gt_sample) in enumerate(pool.imap(_decode, zip(imgs, gt_imgs), chunksize=64)):
+            if sample.shape[:2] != (height, width) or gt_sample.shape != (height, width):
+                raise ValueError(f"{imgs[i]} has shape {sample.shape[:2]}, expected {(height, width)}: "
+                                 f"every patch of the store must have the same size")
+            array[i, :, :, :3] = sample
+            array[i, :, :, 3] = gt_sample
+            if (i + 1) % 10000 == 0:
+                logger.info(f"Packed {i + 1}/{len(imgs)} patches")
+    array.flush()
+    del array
+
+    commit_store(dst, {
+        'data_path': str(data_path),
+        'patch_size': patch_size,
+        'shape': shape,
+        'imgs': [str(img_path.relative_to(data_path)) for img_path in imgs],
+    })
+    logger.info(f"Packed {len(imgs)} patches of {data_path} in {dst}")
+    return dst
+
+
+class PatchStore:
+    """
+    Read-only view of a store built by build_patch_store. The array is memory mapped on first access in every
+    process, so the DataLoader workers share the pages of the file through the page cache instead of each holding
+    its own copy of the patches.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / INDEX_NAME) as file:
+            self.index = json.load(file)
+        self._array = None
+
+    def __len__(self):
+        return self.index['shape'][0]
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.load(self.path / ARRAY_NAME, mmap_mode='r')
+        return self._array
+
+    def __getitem__(self, index):
+        """
+        :return: views on the mapped file of the image (h, w, 3) and of the ground truth (h, w)
+        """
+        patch = self.array[index]
+        return patch[:, :, :3], patch[:, :, 3]
+
+    def __getstate__(self):
+        # Do not pickle the mapping: every worker maps the file again
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / INDEX_NAME).exists() and (Path(path) / ARRAY_NAME).exists()
@@ -5,7 +5,12 @@ from PIL import Image
 from torch.utils.data import Dataset
 import math
 
-from data.utils import get_path
+import torch
+
+from data.ImageCache import get_image_cache
+from data.Manifest import open_manifest, match_page_ground_truths, match_substring_ground_truths
+from data.streaming import TileRowStream
+from data.utils import get_path, make_test_patches, make_test_stride, tile_grid, pad_to_multiple
 from utils.htr_logging import get_logger
 
 logger = get_logger(__file__)
@@ -17,7 +22,8 @@ class TestPatchSquare(Dataset):
 
 class TestDataset(Dataset):
 
-    def __init__(self, data_path, patch_size=256, stride=256, transform=None, is_validation=False, load_data=True):
+    def __init__(self, data_path, patch_size=256, stride=256, transform=None, is_validation=False, load_data=True,
+                 tiling='shift', whole_page_pixels=0, page_multiple=1):
         super(TestDataset, self).__init__()
 
         mobile_dataset = False
@@ -26,50 +32,71 @@ class TestDataset(Dataset):
             mobile_dataset = True
 
         self.is_validation = is_validation
-        if is_validation:
-            self.imgs = list(Path(data_path).rglob(f'imgs/*'))
-            gt_imgs = list(Path(data_path).rglob(f'gt_imgs/*'))
-        else:
-            self.imgs = list(Path(data_path).rglob(f'*/imgs/*'))
-            gt_imgs = list(Path(data_path).rglob(f'*/gt_imgs/*'))
+        self.manifest = manifest = open_manifest(data_path)
+        min_depth = 0 if is_validation else 1
+        self.imgs = manifest.glob('imgs', min_depth=min_depth)
 
         self.data_path = data_path
 
         if mobile_dataset:
-            self.gt_imgs = []
+            gt_imgs = manifest.glob('gt_imgs', min_depth=min_depth)
             logger.info(f"GT imgs: {len(gt_imgs)}")
-            for img_path in self.imgs:
-                gt_img = [gt_img for gt_img in gt_imgs if gt_img.stem in img_path.stem][0]
-                self.gt_imgs.append(gt_img)
-
+            self.gt_imgs = match_substring_ground_truths(self.imgs, gt_imgs)
         else:
-            self.gt_imgs = [
-                img_path.parent.parent / 'gt_imgs' / f'{img_path.stem}_gt.bmp' if
-                (img_path.parent.parent / 'gt_imgs' / f'{img_path.stem}_gt.bmp').exists() else
-                img_path.parent.parent / 'gt_imgs' / (img_path.stem + '.png')
-                for img_path in self.imgs]
+            self.gt_imgs = match_page_ground_truths(manifest, self.imgs)
 
         self.load_data = load_data
         self.imgs_path = self.imgs
         self.gt_imgs_path = self.gt_imgs
         if self.load_data:
-            self.imgs = [Image.open(img_path).convert("RGB") for img_path in self.imgs]
-            self.gt_imgs = [Image.open(gt_img_path).convert("L") for gt_img_path in self.gt_imgs]
+            # Decoded once into shared memory, read by every DataLoader worker and by every dataset on the same files
+            get_image_cache().preload(self.imgs, 'RGB')
+            get_image_cache().preload(self.gt_imgs, 'L')
 
         self.patch_size = patch_size
         self.stride = stride
+        self.tiling = tiling
+        self.whole_page_pixels = whole_page_pixels
+        self.page_multiple = page_multiple
         self.transform = transform
+        self.with_targets = True
 
     def __len__(self):
         return len(self.imgs)
 
+    def page_sizes(self):
+        """:return: (height, width) of every page, read from the image headers (cached in the manifest)"""
+        manifest = getattr(self, 'manifest', None)
+        sizes = []
+        for img_path in self.imgs_path:
+            if manifest is not None:
+                width, height = manifest.image_size(img_path)
+            else:
+                with Image.open(img_path) as image:
+                    width, height = image.size
+            sizes.append((height, width))
+        if manifest is not None:
+            manifest.save()
+        return sizes
+
+    def is_whole_page(self, height, width):
+        """:return: whether a page of the given size is returned whole, padded to a multiple of page_multiple"""
+        multiple = self.page_multiple
+        return math.ceil(height / multiple) * math.ceil(width / multiple) * multiple ** 2 <= self.whole_page_pixels
+
+    def num_tiles(self):
+        """:return: number of patches of every page, or for whole pages the number of patches of the same area"""
+        return [math.ceil(height * width / self.patch_size ** 2) if self.is_whole_page(height, width) else
+                math.prod(tile_grid(height, width, self.patch_size, self.stride, self.tiling))
+                for height, width in self.page_sizes()]
+
     def __getitem__(self, index):
         if self.load_data:
-            sample = self.imgs[index]
-            gt_sample = self.gt_imgs[index]
+            sample = get_image_cache().load(self.imgs[index], 'RGB')
+            gt_sample = get_image_cache().load(self.gt_imgs[index], 'L') if self.with_targets else None
         else:
             sample = Image.open(self.imgs[index]).convert("RGB")
-            gt_sample = Image.open(self.gt_imgs[index]).convert("L")
+            gt_sample = Image.open(self.gt_imgs[index]).convert("L") if self.with_targets else None
 
         # Create patches OLD
         # padding_width = ((sample.width // self.patch_size) + 1) * self.patch_size
@@ -83,18 +110,21 @@ class TestDataset(Dataset):
         # padding_left = math.ceil(padding_right / 2)
         # padding_right = math.floor(padding_right / 2)
 
-        padding_bottom = ((sample.height // self.patch_size) + 1) * self.patch_size - sample.height
-        padding_right = ((sample.width // self.patch_size) + 1) * self.patch_size - sample.width
-
-        tensor_padding = functional.to_tensor(sample).unsqueeze(0)
-        batch, channels, _, _ = tensor_padding.shape
-
-        tensor_padding = functional.pad(img=tensor_padding, padding=[0, 0, padding_right, padding_bottom], fill=1)
-        # tensor_padding = functional.pad(img=tensor_padding,
-        #                                 padding=[padding_left, padding_up, padding_right, padding_bottom], fill=1)
-        patches = tensor_padding.unfold(2, self.patch_size, self.stride).unfold(3, self.patch_size, self.stride)
-        num_rows = patches.shape[3]
-        patches = patches.reshape(batch, channels, -1, self.patch_size, self.patch_size)
+        if self.is_whole_page(sample.height, sample.width):
+            # Binarized in a single forward pass of a fully convolutional model: no patches to cut and merge
+            tiles = {'page': pad_to_multiple(functional.to_tensor(sample).unsqueeze(0), self.page_multiple)[0]}
+        else:
+            patches, num_rows = make_test_patches(functional.to_tensor(sample).unsqueeze(0), self.patch_size,
+                                                  self.stride, self.tiling)
+            tiles = {'num_rows': num_rows, 'samples_patches': patches}
+
+        if not self.with_targets:
+            # Inference only: the page is only needed to know the size of the reconstruction
+            return {
+                'image_name': str(self.imgs_path[index]),
+                **tiles,
+                'page_size': torch.tensor([sample.height, sample.width])
+            }
 
         if self.transform:
             sample = self.transform(sample)
@@ -103,8 +133,7 @@ class TestDataset(Dataset):
         item = {
             'image_name': str(self.imgs_path[index]),
             'sample': sample,
-            'num_rows': num_rows,
-            'samples_patches': patches,
+            **tiles,
             'gt_sample': gt_sample
         }
 
@@ -112,21 +141,34 @@ class TestDataset(Dataset):
 
 
 class FolderDataset(TestDataset):
-    def __init__(self, data_path, patch_size=256, overlap=True, transform=None, load_data=True):
+    def __init__(self, data_path, patch_size=256, overlap=True, transform=None, load_data=True, with_targets=True,
+                 paths=None, tiling='shift', stride=None, whole_page_pixels=0, page_multiple=1):
         super(TestDataset, self).__init__()
 
         # self.imgs_path = list(Path(data_path).iterdir() if Path(data_path).is_dir() else [Path(data_path)])
-        self.imgs = list(path for path in Path(data_path).rglob(f'*') if path.is_file())
+        self.imgs = list(paths) if paths is not None else self.list_images(data_path)
         self.data_path = data_path
         self.gt_imgs = self.imgs
 
         self.imgs_path = self.imgs
         self.gt_imgs_path = self.gt_imgs
         if load_data:
-            self.imgs = [Image.open(img_path).convert("RGB") for img_path in self.imgs]
-            self.gt_imgs = [Image.open(gt_img_path).convert("L") for gt_img_path in self.gt_imgs]
+            get_image_cache().preload(self.imgs, 'RGB')
+            if with_targets:
+                get_image_cache().preload(self.gt_imgs, 'L')
 
         self.patch_size = patch_size
-        self.stride = patch_size // 2 if overlap else patch_size
+        self.stride = stride if stride else make_test_stride(patch_size, overlap)
+        self.tiling = tiling
+        self.whole_page_pixels = whole_page_pixels
+        self.page_multiple = page_multiple
         self.transform = transform
         self.load_data = load_data
+        self.with_targets = with_targets
+
+    @staticmethod
+    def list_images(data_path):
+        return sorted(path for path in Path(data_path).rglob(f'*') if path.is_file())
+
+    def stream(self, index):
+        return TileRowStream(self.imgs_path[index], patch_size=self.patch_size, stride=self.stride, tiling=self.tiling)
@@ -7,6 +7,9 @@ from PIL import Image
 from torch.utils.data import Dataset
 from pathlib import Path
 
+from data.ImageCache import get_image_cache
+from data.Manifest import open_manifest, match_page_ground_truths
+from data.PatchStore import PatchStore
 from data.utils import get_path
 
 
@@ -42,7 +45,7 @@ class TrainPatchSquare(Dataset):
     def __len__(self):
         return len(self.full_images_paths)
 
-    def __getitem__(self, index, merge_image=False):
+    def __getitem__(self, index):
         full_image = Image.open(self.full_images_paths[index]).convert("RGB")
         mask_image = Image.open(self.mask_images_paths[index]).convert("L")
 
@@ -57,44 +60,33 @@ class TrainPatchSquare(Dataset):
             full_image = transform['image']
             mask_image = transform['gt']
 
-        # Merge two images
-        if merge_image:
-            random_index = random.randint(0, len(self.full_images) - 1)
-            random_sample, random_gt_sample = self.__getitem__(index=random_index, merge_image=False)
-
-            full_image = np.minimum(full_image, random_sample)
-            mask_image = np.minimum(mask_image, random_gt_sample)
-
         mask_image = mask_image.float()
         return full_image, mask_image
 
 
 class TrainingDataset(Dataset):
 
-    def __init__(self, data_path, split_size=256, patch_size=384, transform=None, load_data=True, merge_image=True):
+    def __init__(self, data_path, split_size=256, patch_size=384, transform=None, load_data=True):
         super(TrainingDataset, self).__init__()
-        self.imgs = list(Path(data_path).rglob(f'imgs_{patch_size}/*'))
+        self.imgs = open_manifest(data_path).glob(f'imgs_{patch_size}')
         self.gt_imgs = [img_path.parent.parent / ('gt_' + img_path.parent.name) / img_path.name for img_path in self.imgs]
 
         self.load_data = load_data
         if self.load_data:
-            self.imgs = [Image.open(img_path).convert("RGB") for img_path in self.imgs]
-            self.gt_imgs = [Image.open(gt_img_path).convert("L") for gt_img_path in self.gt_imgs]
+            # Decoded once into shared memory, read by every DataLoader worker and by every dataset on the same files
+            get_image_cache().preload(self.imgs, 'RGB')
+            get_image_cache().preload(self.gt_imgs, 'L')
 
         self.split_size = split_size
         self.transform = transform
-        self.merge_image = merge_image
 
     def __len__(self):
         return len(self.imgs)
 
-    def __getitem__(self, index, merge_image=None):
-        if self.merge_image and merge_image is None:
-            merge_image = self.merge_image
-
+    def __getitem__(self, index):
         if self.load_data:
-            sample = self.imgs[index]
-            gt_sample = self.gt_imgs[index]
+            sample = get_image_cache().load(self.imgs[index], 'RGB')
+            gt_sample = get_image_cache().load(self.gt_imgs[index], 'L')
         else:
             sample = Image.open(self.imgs[index]).convert("RGB")
             gt_sample = Image.open(self.gt_imgs[index]).convert("L")
@@ -104,13 +96,121 @@ class TrainingDataset(Dataset):
             sample = transform['image']
             gt_sample = transform['gt']
 
-        # Merge two images
-        if merge_image:
-            random_index = random.randint(0, len(self.imgs) - 1)
-            random_sample, random_gt_sample = self.__getitem__(index=random_index, merge_image=False)
+        gt_sample = gt_sample.float()
+        return sample, gt_sample
+
+
+class PatchStoreDataset(Dataset):
+    """TrainingDataset reading the patches from a PatchStore instead of from the image files."""
+
+    def __init__(self, store_path, transform=None):
+        super(PatchStoreDataset, self).__init__()
+        self.store = PatchStore(store_path)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        sample, gt_sample = self.store[index]
+        sample = Image.fromarray(np.ascontiguousarray(sample), mode="RGB")
+        gt_sample = Image.fromarray(np.ascontiguousarray(gt_sample), mode="L")
+
+        if self.transform:
+            transform = self.transform({'image': sample, 'gt': gt_sample})
+            sample = transform['image']
+            gt_sample = transform['gt']
 
-            sample = np.minimum(sample, random_sample)
-            gt_sample = np.minimum(gt_sample, random_gt_sample)
+        gt_sample = gt_sample.float()
+        return sample, gt_sample
+
+
+class PageSamplingDataset(Dataset):
+    """
+    Samples random crops of crop_size directly from the full pages (imgs / gt_imgs folders) of data_path, instead of
+    reading pre-cut patches.
+
+    The pages are decoded once into the shared ImageCache, so the DataLoader workers read them without copying. With ink_weight > 0, the crops are drawn more often around text: the crop centre falls in a cell of a
+    coarse grid with probability (1 - ink_weight) * uniform + ink_weight * (fraction of ink pixels of the cell).
+    """
+
+    def __init__(self, data_path, crop_size=384, transform=None, ink_weight=0.,
+                 samples_per_epoch=None, cell_size=32):
+        super(PageSamplingDataset, self).__init__()
+        manifest = open_manifest(data_path)
+        self.imgs = manifest.glob('imgs')
+        self.gt_imgs = match_page_ground_truths(manifest, self.imgs)
+        if not self.imgs:
+            raise FileNotFoundError(f"No pages found in {data_path}")
+
+        self.crop_size = crop_size
+        self.transform = transform
+        self.ink_weight = ink_weight
+        self.cell_size = cell_size
+
+        cache = get_image_cache()
+        self.page_sizes = []
+        self.cell_weights = []
+        for img_path, gt_img_path in zip(self.imgs, self.gt_imgs):
+            cache.preload([img_path], 'RGB')
+            gt_sample = cache.load_array(gt_img_path, 'L')
+            self.page_sizes.append(gt_sample.shape)
+            self.cell_weights.append(self._cell_weights(gt_sample))
+            del gt_sample
+
+        areas = np.array([height * width for height, width in self.page_sizes], dtype=np.float64)
+        self.page_weights = (areas / areas.sum()).tolist()
+        # By default an epoch sees about as many crops as there would be non-overlapping patches
+        self.samples_per_epoch = samples_per_epoch if samples_per_epoch else \
+            max(1, int(areas.sum() // (crop_size * crop_size)))
+
+    def _cell_weights(self, gt_sample):
+        height, width = gt_sample.shape
+        rows, cols = -(-height // self.cell_size), -(-width // self.cell_size)
+        ink = np.zeros((rows * self.cell_size, cols * self.cell_size), dtype=np.float32)
+        ink[:height, :width] = gt_sample < 128
+        ink = ink.reshape(rows, self.cell_size, cols, self.cell_size).mean(axis=(1, 3)).ravel()
+
+        uniform = np.full_like(ink, 1 / ink.size)
+        if self.ink_weight > 0 and ink.sum() > 0:
+            weights = (1 - self.ink_weight) * uniform + self.ink_weight * ink / ink.sum()
+        else:
+            weights = uniform
+        return np.cumsum(weights) / weights.sum()
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def _crop(self, page_index):
+        height, width = self.page_sizes[page_index]
+
+        cell = int(np.searchsorted(self.cell_weights[page_index], random.random(), side='right'))
+        cols = -(-width // self.cell_size)
+        centre_y = (cell // cols) * self.cell_size + random.randrange(self.cell_size)
+        centre_x = (cell % cols) * self.cell_size + random.randrange(self.cell_size)
+
+        # Keep the crop inside the page when possible, pad with white when the page is smaller than the crop
+        top = min(max(0, centre_y - self.crop_size // 2), max(0, height - self.crop_size))
+        left = min(max(0, centre_x - self.crop_size // 2), max(0, width - self.crop_size))
+        crop_height, crop_width = min(self.crop_size, height), min(self.crop_size, width)
+        sample = np.full((self.crop_size, self.crop_size, 3), 255, dtype=np.uint8)
+        gt_sample = np.full((self.crop_size, self.crop_size), 255, dtype=np.uint8)
+        sample[:crop_height, :crop_width] = \
+            get_image_cache().load_array(self.imgs[page_index], 'RGB')[top:top + crop_height, left:left + crop_width]
+        gt_sample[:crop_height, :crop_width] = \
+            get_image_cache().load_array(self.gt_imgs[page_index], 'L')[top:top + crop_height, left:left + crop_width]
+
+        return Image.fromarray(sample, mode="RGB"), Image.fromarray(gt_sample, mode="L")
+
+    def __getitem__(self, index):
+        # The index only sets the length of the epoch: the page and the crop are random
+        page_index = random.choices(range(len(self.page_sizes)), weights=self.page_weights)[0]
+        sample, gt_sample = self._crop(page_index)
+
+        if self.transform:
+            transform = self.transform({'image': sample, 'gt': gt_sample})
+            sample = transform['image']
+            gt_sample = transform['gt']
 
         gt_sample = gt_sample.float()
         return sample, gt_sample
@@ -2,11 +2,12 @@ import json
 import os
 import random
 
-import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 from pathlib import Path
 
+from data.ImageCache import get_image_cache
+from data.Manifest import open_manifest
 from data.utils import get_path
 
 
@@ -52,13 +53,14 @@ class ValidationDataset(Dataset):
 
     def __init__(self, data_path, split_size=256, patch_size=384, transform=None, load_data=True):
         super(ValidationDataset, self).__init__()
-        self.imgs = list(Path(data_path).rglob(f'val_imgs_{split_size}/*'))
+        self.imgs = open_manifest(data_path).glob(f'val_imgs_{split_size}')
         self.gt_imgs = [img_path.parent.parent / ('val_gt_' + img_path.parent.name[4:]) / img_path.name for img_path in self.imgs]
 
         self.load_data = load_data
         if self.load_data:
-            self.imgs = [Image.open(img_path).convert("RGB") for img_path in self.imgs]
-            self.gt_imgs = [Image.open(gt_img_path).convert("L") for gt_img_path in self.gt_imgs]
+            # Decoded once into shared memory, read by every DataLoader worker and by every dataset on the same files
+            get_image_cache().preload(self.imgs, 'RGB')
+            get_image_cache().preload(self.gt_imgs, 'L')
 
         self.split_size = split_size
         self.transform = transform
@@ -68,8 +70,8 @@ class ValidationDataset(Dataset):
 
     def __getitem__(self, index):
         if self.load_data:
-            sample = self.imgs[index]
-            gt_sample = self.gt_imgs[index]
+            sample = get_image_cache().load(self.imgs[index], 'RGB')
+            gt_sample = get_image_cache().load(self.gt_imgs[index], 'L')
         else:
             sample = Image.open(self.imgs[index]).convert("RGB")
             gt_sample = Image.open(self.gt_imgs[index]).convert("L")
@@ -90,11 +92,11 @@ class ErrorValidationDataset(ValidationDataset):
         self.gt_imgs = [Path(data_path) / f'gt_imgs_{patch_size}' / img_path.name for img_path in self.imgs]
 
         self.load_data = True
-        self.imgs = [Image.open(img_path).convert("RGB") for img_path in self.imgs]
-        self.gt_imgs = [Image.open(gt_img_path).convert("L") for gt_img_path in self.gt_imgs]
+        get_image_cache().preload(self.imgs, 'RGB')
+        get_image_cache().preload(self.gt_imgs, 'L')
 
-        def has_padding(img):
-            img = np.array(img).mean(-1)
+        def has_padding(img_path):
+            img = get_image_cache().load_array(img_path, 'RGB').mean(-1)
             bottom_padding = (img[-1, :] == 255.0).all()
             if bottom_padding: return True
             right_padding = (img[:, -1] == 255.0).all()
@@ -110,8 +112,8 @@ class ErrorValidationDataset(ValidationDataset):
 
     def __getitem__(self, index):
         if self.load_data:
-            sample = self.imgs[index]
-            gt_sample = self.gt_imgs[index]
+            sample = get_image_cache().load(self.imgs[index], 'RGB')
+            gt_sample = get_image_cache().load(self.gt_imgs[index], 'L')
         else:
             sample = Image.open(self.imgs[index]).convert("RGB")
             gt_sample = Image.open(self.gt_imgs[index]).convert("L")
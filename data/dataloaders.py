@@ -1,11 +1,63 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, ConcatDataset, Sampler
+from torch.utils.data.dataloader import default_collate
 
 from utils.htr_logging import get_logger
 
 logger = get_logger(__file__)
 
 
+class PageBatchSampler(Sampler):
+    """
+    Groups consecutive pages of a test dataset into loader batches of about tiles_per_batch patches, keeping the order
+    of the dataset. The tiles of the pages of a batch are flattened into model batches by the TileScheduler, so pages
+    of different sizes are evaluated together without padding.
+    """
+
+    def __init__(self, num_tiles: list, tiles_per_batch: int):
+        self.batches = []
+        batch, batch_tiles = [], 0
+        for index, tiles in enumerate(num_tiles):
+            batch.append(index)
+            batch_tiles += tiles
+            if batch_tiles >= tiles_per_batch:
+                self.batches.append(batch)
+                batch, batch_tiles = [], 0
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_pages(items):
+    """:return: the pages of the batch, each collated as by a loader with batch size 1"""
+    return [default_collate([item]) for item in items]
+
+
+def dataset_num_tiles(dataset: Dataset):
+    """:return: number of patches of every page of a (concatenation of) TestDataset, or None if unknown"""
+    datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    if not all(hasattr(dataset, 'num_tiles') for dataset in datasets):
+        return None
+    return [tiles for dataset in datasets for tiles in dataset.num_tiles()]
+
+
+def _make_page_dataloader(dataset: Dataset, dataloader_config: dict, tiles_per_batch: int):
+    num_tiles = dataset_num_tiles(dataset) if tiles_per_batch else None
+    if num_tiles is None:
+        return torch.utils.data.DataLoader(dataset, **dataloader_config)
+
+    dataloader_config = {key: value for key, value in dataloader_config.items()
+                         if key not in ('batch_size', 'shuffle', 'drop_last')}
+    batch_sampler = PageBatchSampler(num_tiles, tiles_per_batch)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_pages,
+                                       **dataloader_config)
+
+
 def make_train_dataloader(train_dataset: Dataset, config: dict):
     train_dataloader_config = config['train_kwargs']
     train_data_loader = torch.utils.data.DataLoader(train_dataset, **train_dataloader_config)
@@ -15,13 +67,15 @@ def make_train_dataloader(train_dataset: Dataset, config: dict):
 
 def make_valid_dataloader(valid_dataset: Dataset, config: dict):
     valid_dataloader_config = config['valid_kwargs']
-    valid_data_loader = torch.utils.data.DataLoader(valid_dataset, **valid_dataloader_config)
+    valid_data_loader = _make_page_dataloader(valid_dataset, valid_dataloader_config,
+                                              config.get('eval_batch_tiles', 0))
 
     return valid_data_loader
 
 
 def make_test_dataloader(test_dataset: Dataset, config: dict):
     test_dataloader_config = config['test_kwargs']
-    test_data_loader = torch.utils.data.DataLoader(test_dataset, **test_dataloader_config)
+    test_data_loader = _make_page_dataloader(test_dataset, test_dataloader_config,
+                                             config.get('eval_batch_tiles', 0))
 
     return test_data_loader
@@ -1,7 +1,10 @@
 from torchvision.transforms import transforms
 from torchvision.transforms import functional
 import time
-from data.TrainingDataset import TrainingDataset, TrainPatchSquare
+from data.BatchTransforms import make_batch_transform
+from data.PatchStore import PatchStore, default_store_path
+from data.TrainingDataset import TrainingDataset, TrainPatchSquare, PatchStoreDataset, \
+    PageSamplingDataset
 from data.TestDataset import TestPatchSquare, TestDataset
 from data.ValidationDataset import ValidationPatchSquare, ValidationDataset
 from data.utils import get_transform
@@ -18,12 +21,16 @@ def make_train_dataset(config: dict, training_only_with_patch_square=False):
     transform_variant = config['train_transform_variant'] if 'train_transform_variant' in config else None
     patch_size = config['train_patch_size']
     load_data = config['load_data']
-    merge_image = config['merge_image']
 
     logger.info(f"Train path: \"{train_data_path}\"")
     logger.info(f"Transform Variant: {transform_variant} - Training Patch Size: {patch_size}")
 
-    transform = get_transform(transform_variant=transform_variant, output_size=patch_size)
+    if config.get('batch_augmentation', False) and make_batch_transform(config) is not None:
+        # The augmentations run on the collated batches (see LaMaTrainingModule.batch_transform)
+        logger.info("Using batched augmentations")
+        transform = transforms.Compose([CustomTransform.ToUint8Tensor()])
+    else:
+        transform = get_transform(transform_variant=transform_variant, output_size=patch_size)
 
     logger.info(f"Loading train datasets...")
     time_start = time.time()
@@ -38,14 +45,28 @@ def make_train_dataset(config: dict, training_only_with_patch_square=False):
                     transform=transform))
         else:
             data_path = Path(path) / 'train' if (Path(path) / 'train').exists() else Path(path)
+            if config.get('sample_from_pages', False):
+                datasets.append(
+                    PageSamplingDataset(
+                        data_path=data_path,
+                        crop_size=config['train_patch_size_raw'],
+                        transform=transform,
+                        ink_weight=config.get('ink_weight', 0.)))
+                continue
+            store_path = default_store_path(data_path, config['train_patch_size_raw'])
+            if config.get('use_patch_store', False):
+                if PatchStore.exists(store_path):
+                    datasets.append(PatchStoreDataset(store_path, transform=transform))
+                    continue
+                logger.warning(f"No patch store in \"{store_path}\": loading the image files. "
+                               f"Run pack_patches.py to build it")
             datasets.append(
                 TrainingDataset(
                     data_path=data_path,
                     split_size=patch_size,
                     patch_size=config['train_patch_size_raw'],
                     transform=transform,
-                    load_data=load_data,
-                    merge_image=merge_image))
+                    load_data=load_data))
 
     logger.info(f"Loading train datasets took {time.time() - time_start:.2f} seconds")
 
@@ -89,7 +110,8 @@ def make_val_dataset(config: dict, training_only_with_patch_square=False):
                         stride=stride,
                         transform=transform,
                         is_validation=True,
-                        load_data=load_data
+                        load_data=load_data,
+                        tiling=config.get('test_tiling', 'shift')
                     )
                 )
             else:
@@ -125,7 +147,8 @@ def make_test_dataset(config: dict, is_validation=False):
                     stride=stride,
                     transform=transform,
                     is_validation=is_validation,
-                    load_data=load_data))
+                    load_data=load_data,
+                    tiling=config.get('test_tiling', 'shift')))
         logger.info(f'Loaded test dataset from {path} with {len(datasets[-1])} instances.')
 
     logger.info(f"Loading test datasets took {time.time() - time_start:.2f} seconds")
@@ -2,33 +2,102 @@ import argparse
 import logging
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
 import numpy as np
 import yaml
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
 # from tqdm import tqdm
 from pathlib import Path
 
+from data.PatchStore import ARRAY_NAME, allocate_store, commit_store, default_store_path, has_allocated_store, \
+    open_allocated_store
+
 
 def check_or_create_folder(name: str):
     pass
 
 
+def page_origins(size: int, stride: int):
+    """Origins of the patches along one side of a page: a patch starts every stride pixels, up to the last pixel."""
+    return range(0, size, stride)
+
+
+def extract_patches(image: np.ndarray, patch_size: int, stride: int):
+    """
+    Pad the page once with white on the bottom and right and take every window with stride tricks.
+
+    :param image: uint8 array with shape (h, w, channels)
+    :return: array of patches with shape (rows, cols, patch_size, patch_size, channels), in the order the rows and
+    columns of the page are visited
+    """
+    height, width, channels = image.shape
+    padded_height = (len(page_origins(height, stride)) - 1) * stride + patch_size
+    padded_width = (len(page_origins(width, stride)) - 1) * stride + patch_size
+
+    padded = np.full((padded_height, padded_width, channels), 255, dtype=np.uint8)
+    padded[:height, :width] = image
+    windows = sliding_window_view(padded, (patch_size, patch_size, channels))
+    return windows[::stride, ::stride, 0]
+
+
+def _split_page(img_path, gt_path, first_number, patch_size, stride, train_folder, train_gt_folder, store_path,
+                done_path):
+    or_img = cv2.imread(str(img_path))
+    gt_img = cv2.imread(str(gt_path))
+    if or_img is None or gt_img is None:
+        raise FileNotFoundError(f'Cannot read {img_path} or {gt_path}')
+    if or_img.shape != gt_img.shape:
+        raise ValueError(f'{img_path} has shape {or_img.shape} but its ground truth has shape {gt_img.shape}')
+
+    dg_patches = extract_patches(or_img, patch_size, stride)
+    gt_patches = extract_patches(gt_img, patch_size, stride)
+    dg_patches = dg_patches.reshape(-1, patch_size, patch_size, 3)
+    gt_patches = gt_patches.reshape(-1, patch_size, patch_size, 3)
+
+    if store_path is None:
+        for k, (dg_patch, gt_patch) in enumerate(zip(dg_patches, gt_patches)):
+            cv2.imwrite(str(train_folder / f'{first_number + k}.png'), dg_patch)
+            cv2.imwrite(str(train_gt_folder / f'{first_number + k}.png'), gt_patch)
+    else:
+        array = open_allocated_store(store_path)
+        start = first_number - 1
+        array[start:start + len(dg_patches), :, :, :3] = dg_patches[..., ::-1]  # BGR to RGB
+        array[start:start + len(dg_patches), :, :, 3] = gt_patches[..., 0]
+        array.flush()
+        del array
+
+    done_path.touch()
+    return len(dg_patches)
+
+
 class PatchImage:
+    """
+    Splits the pages of a dataset into overlapping training patches, one page per worker process.
 
-    def __init__(self, patch_size: int, overlap_size: int, patch_size_valid: int, destination_root: str):
+    The patches are numbered from the page sizes read from the image headers, so the numbering does not depend on
+    the order the workers finish in, and an interrupted run can be resumed: the pages already split are skipped.
+    """
+
+    def __init__(self, patch_size: int, overlap_size: int, patch_size_valid: int, destination_root: str,
+                 output_format: str = 'png', workers: int = None):
         logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
         destination_root = Path(destination_root)
         self.train_folder = destination_root / f'imgs_{patch_size}/'
         self.train_gt_folder = destination_root / f'gt_imgs_{patch_size}/'
         self.valid_folder = destination_root / f'val_imgs_{patch_size_valid}/'
         self.valid_gt_folder = destination_root / f'val_gt_imgs_{patch_size_valid}/'
+        self.store_folder = default_store_path(destination_root, patch_size)
+        self.progress_folder = destination_root / f'.patches_{patch_size}_{overlap_size}_{output_format}'
 
+        assert output_format in ('png', 'store'), f'Unknown output format {output_format}'
         self.patch_size = patch_size
         self.overlap_size = overlap_size
         self.patch_size_valid = patch_size_valid
-        self.number_image = 1
-        self.image_name = ""
+        self.output_format = output_format
+        self.workers = workers
 
         logging.info("Configuration patches ...")
         logging.info(f"Using Patch size: {self.patch_size} - Overlapping: {self.overlap_size}")
@@ -36,91 +105,79 @@ class PatchImage:
         self._create_folders()
 
     def _create_folders(self):
-        self.train_folder.mkdir(parents=True, exist_ok=True)
-        self.train_gt_folder.mkdir(parents=True, exist_ok=True)
+        if self.output_format == 'png':
+            self.train_folder.mkdir(parents=True, exist_ok=True)
+            self.train_gt_folder.mkdir(parents=True, exist_ok=True)
         # self.valid_folder.mkdir(parents=True, exist_ok=True)
         # self.valid_gt_folder.mkdir(parents=True, exist_ok=True)
+        self.progress_folder.mkdir(parents=True, exist_ok=True)
         logging.info("Configuration folders ...")
 
     def create_patches(self, root_original: str, root_ground_truth: str, test_dataset, validation_dataset):
-        mobile_dataset = False
         logging.info("Start process ...")
         root_original = Path(root_original)
         gt = root_original / 'test' / 'gt_imgs'
-        imgs = root_original / 'test' /'imgs'
-
-        # path_imgs = list(imgs.rglob('*.png')) + list(imgs.rglob('*.jpg')) + list(imgs.rglob('*.bmp') )
-        path_imgs = list(path_img for path_img in imgs.rglob('*') if path_img.suffix in {".png", ".jpg", ".bmp", ".tif"})
-
-        if mobile_dataset:
-            gt_imgs = list(gt.rglob('*.png')) + list(gt.rglob('*.jpg')) + list(gt.rglob('*.bmp') )
-        for i, img in enumerate(path_imgs):
-            or_img = cv2.imread(str(img))
-
-            if not mobile_dataset:
-                gt_img = gt / f'{img.stem}_gt.bmp'
-                gt_img = gt_img if gt_img.exists() else gt / (img.stem + '.png')
-            else:
-                gt_img = [gt_img_c for gt_img_c in gt_imgs if gt_img_c.stem in img.stem][0]
-                logging.info(f'IMG: {img}. Stem: {img.stem}. GT: {gt_img}')
-            gt_img = cv2.imread(str(gt_img))
-            # if i < len(path_imgs) * 0.1:
-            #     self._split_train_images(or_img, gt_img, type="valid")
-            # else:
-            try:
-                self._split_train_images(or_img, gt_img, type="train")
-            except Exception as e:
-                print(f'Error: {e} - {img}')
-
-    def _split_train_images(self, or_img: np.ndarray, gt_img: np.ndarray, type: str):
-        runtime_size = self.overlap_size if type == "train" else self.patch_size_valid
-        patch_size = self.patch_size if type == "train" else self.patch_size_valid
-        for i in range(0, or_img.shape[0], runtime_size):
-            for j in range(0, or_img.shape[1], runtime_size):
-
-                if i + patch_size <= or_img.shape[0] and j + patch_size <= or_img.shape[1]:
-                    dg_patch = or_img[i:i + patch_size, j:j + patch_size, :]
-                    gt_patch = gt_img[i:i + patch_size, j:j + patch_size, :]
-
-                elif i + patch_size > or_img.shape[0] and j + patch_size <= or_img.shape[1]:
-                    dg_patch = np.ones((patch_size, patch_size, 3)) * 255
-                    gt_patch = np.ones((patch_size, patch_size, 3)) * 255
-
-                    dg_patch[0:or_img.shape[0] - i, :, :] = or_img[i:or_img.shape[0], j:j + patch_size, :]
-                    gt_patch[0:or_img.shape[0] - i, :, :] = gt_img[i:or_img.shape[0], j:j + patch_size, :]
-
-                elif i + patch_size <= or_img.shape[0] and j + patch_size > or_img.shape[1]:
-                    dg_patch = np.ones((patch_size, patch_size, 3)) * 255
-                    gt_patch = np.ones((patch_size, patch_size, 3)) * 255
-
-                    dg_patch[:, 0:or_img.shape[1] - j, :] = or_img[i:i + patch_size, j:or_img.shape[1], :]
-                    gt_patch[:, 0:or_img.shape[1] - j, :] = gt_img[i:i + patch_size, j:or_img.shape[1], :]
-
-                else:
-                    dg_patch = np.ones((patch_size, patch_size, 3)) * 255
-                    gt_patch = np.ones((patch_size, patch_size, 3)) * 255
-
-                    dg_patch[0:or_img.shape[0] - i, 0:or_img.shape[1] - j, :] = or_img[i:or_img.shape[0],
-                                                                                j:or_img.shape[1],
-                                                                                :]
-                    gt_patch[0:or_img.shape[0] - i, 0:or_img.shape[1] - j, :] = gt_img[i:or_img.shape[0],
-                                                                                j:or_img.shape[1],
-                                                                                :]
-                    gt_patch[0:or_img.shape[0] - i, 0:or_img.shape[1] - j, :] = gt_img[i:or_img.shape[0],
-                                                                                j:or_img.shape[1],
-                                                                                :]
-
-                if type == "train":
-                    cv2.imwrite(str(self.train_folder / (str(self.number_image) + '.png')), dg_patch)
-                    cv2.imwrite(str(self.train_gt_folder / (str(self.number_image) + '.png')), gt_patch)
-                elif type == "valid":
-                    cv2.imwrite(str(self.valid_folder / (str(self.number_image) + '.png')), dg_patch)
-                    cv2.imwrite(str(self.valid_gt_folder / (str(self.number_image) + '.png')), gt_patch)
-                self.number_image += 1
-                print(self.number_image, end='\r')
-
-    def _create_name(self, folder: str, i: int, j: int):
-        return folder + self.image_name.split('.')[0] + '_' + str(i) + '_' + str(j) + '.png'
+        imgs = root_original / 'test' / 'imgs'
+
+        path_imgs = sorted(path_img for path_img in imgs.rglob('*') if path_img.suffix in {".png", ".jpg", ".bmp", ".tif"})
+        pages = []
+        for img in path_imgs:
+            gt_img = gt / f'{img.stem}_gt.bmp'
+            gt_img = gt_img if gt_img.exists() else gt / (img.stem + '.png')
+            pages.append((img, gt_img))
+
+        # Deterministic numbering: the patches of every page follow those of the previous pages
+        counts = [self._count_patches(img) for img, _ in pages]
+        first_numbers = np.cumsum([1] + counts[:-1]).tolist()
+        total = sum(counts)
+
+        done_paths = [self.progress_folder / f'{first_number}_{img.stem}.done'
+                       for (img, _), first_number in zip(pages, first_numbers)]
+
+        store_path = None
+        if self.output_format == 'store':
+            store_path = self.store_folder
+            shape = [total, self.patch_size, self.patch_size, 4]
+            if all(done_path.exists() for done_path in done_paths) and (store_path / ARRAY_NAME).exists():
+                logging.info(f"{len(pages)} pages already packed in {store_path}")
+                return
+            if not has_allocated_store(store_path, shape):
+                # The pages marked as split were written into an array that is not reopened: split them again
+                for done_path in self.progress_folder.glob('*.done'):
+                    done_path.unlink()
+            allocate_store(store_path, shape)
+
+        jobs = []
+        for (img, gt_img), first_number, done_path in zip(pages, first_numbers, done_paths):
+            if done_path.exists():
+                continue
+            jobs.append((img, gt_img, first_number, self.patch_size, self.overlap_size, self.train_folder,
+                         self.train_gt_folder, store_path, done_path))
+        logging.info(f"{len(pages)} pages, {total} patches: {len(pages) - len(jobs)} pages already split")
+
+        failed = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(_split_page, *job): job[0] for job in jobs}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f'Error: {e} - {futures[future]}')
+                print(f'{i + 1}/{len(jobs)}', end='\r')
+
+        if store_path is not None and failed == 0:
+            commit_store(store_path, {
+                'data_path': str(self.store_folder.parent),
+                'patch_size': self.patch_size,
+                'shape': [total, self.patch_size, self.patch_size, 4],
+            })
+
+    def _count_patches(self, img_path):
+        # Only the header is read
+        with Image.open(img_path) as image:
+            width, height = image.size
+        return len(page_origins(height, self.overlap_size)) * len(page_origins(width, self.overlap_size))
 
 
 def configure_args(path_configuration: str):
@@ -172,5 +229,15 @@ def configure_args(path_configuration: str):
                         type=str,
                         help='folder which contains images will are used to create the training dataset',
                         default=config_options['testing_dataset'])
+    parser.add_argument('-format', '--output_format',
+                        type=str,
+                        choices=['png', 'store'],
+                        help='write the patches as png files, or pack them into a patch store',
+                        default=config_options.get('output_format', 'png'))
+    parser.add_argument('-workers', '--workers',
+                        metavar='<number>',
+                        type=int,
+                        help='number of pages split in parallel',
+                        default=config_options.get('workers', None))
 
     return parser.parse_args()
@@ -0,0 +1,154 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from data.utils import TilePlan
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+
+# TIFF tags of the strip layout
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_FILL_ORDER = 266
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_ROWS_PER_STRIP = 278
+_STRIP_BYTE_COUNTS = 279
+_PLANAR_CONFIGURATION = 284
+_TILE_WIDTH = 322
+
+
+def _as_tuple(value):
+    return tuple(value) if isinstance(value, (tuple, list)) else (value,)
+
+
+class RowBandReader:
+    """
+    Decodes horizontal bands of an image. Uncompressed strip TIFFs with 8-bit grayscale or RGB, or bilevel pixels
+    are read one band at a time straight from their strips (located with the TIFF tags), so the whole page is never
+    held in memory. Every other file (PNG, JPEG, compressed or tiled TIFF) is decoded whole to an uint8 array, and
+    its memory grows with the page area.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as image:
+            self.width, self.height = image.size
+            self._layout = self._strip_layout(image)
+
+        self._page = None
+        if self._layout is None:
+            logger.warning(f"{path} is not an uncompressed strip TIFF: decoding the whole page, the memory used "
+                           f"grows with its area")
+            with Image.open(path) as image:
+                self._page = np.asarray(image.convert('RGB'))
+
+    @staticmethod
+    def _strip_layout(image):
+        """:return: the strips of an uncompressed TIFF whose pixels can be decoded with numpy, or None"""
+        if image.format != 'TIFF':
+            return None
+        tags = image.tag_v2
+        if tags.get(_COMPRESSION, 1) != 1 or _TILE_WIDTH in tags or _STRIP_OFFSETS not in tags \
+                or tags.get(_FILL_ORDER, 1) != 1 or tags.get(_PLANAR_CONFIGURATION, 1) != 1:
+            return None
+
+        samples = tags.get(_SAMPLES_PER_PIXEL, 1)
+        bits = set(_as_tuple(tags.get(_BITS_PER_SAMPLE, 1)))
+        photometric = tags.get(_PHOTOMETRIC)
+        grayscale = samples == 1 and bits in ({1}, {8}) and photometric in (0, 1)
+        rgb = samples == 3 and bits == {8} and photometric == 2
+        if not grayscale and not rgb:
+            return None
+
+        offsets = _as_tuple(tags[_STRIP_OFFSETS])
+        byte_counts = _as_tuple(tags[_STRIP_BYTE_COUNTS])
+        rows_per_strip = min(tags.get(_ROWS_PER_STRIP, image.height), image.height)
+        if len(offsets) != len(byte_counts) or len(offsets) * rows_per_strip < image.height:
+            return None
+        return {'offsets': offsets, 'byte_counts': byte_counts, 'rows_per_strip': rows_per_strip,
+                'samples': samples, 'bits': bits.pop(), 'white_is_zero': photometric == 0}
+
+    def _decode_strip(self, data, rows):
+        """:return: uint8 array with shape (rows, width, 3) of the pixels of a strip"""
+        layout = self._layout
+        if layout['bits'] == 1:
+            row_bytes = (self.width + 7) // 8
+            packed = np.frombuffer(data, dtype=np.uint8, count=rows * row_bytes).reshape(rows, row_bytes)
+            pixels = np.unpackbits(packed, axis=1)[:, :self.width] * np.uint8(255)
+        else:
+            pixels = np.frombuffer(data, dtype=np.uint8, count=rows * self.width * layout['samples'])
+            pixels = pixels.reshape(rows, self.width, layout['samples'])
+        if layout['white_is_zero']:
+            pixels = 255 - pixels
+        if layout['samples'] == 1:
+            pixels = np.repeat(pixels.reshape(rows, self.width, 1), 3, axis=2)
+        return pixels
+
+    def read(self, top: int, bottom: int):
+        """
+        :return: uint8 array with shape (bottom - top, width, 3) holding the rows [top, bottom) of the page
+        """
+        if self._page is not None:
+            return self._page[top:bottom]
+
+        rows_per_strip = self._layout['rows_per_strip']
+        first, last = top // rows_per_strip, (bottom - 1) // rows_per_strip
+        strips = []
+        with open(self.path, 'rb') as file:
+            for strip in range(first, last + 1):
+                file.seek(self._layout['offsets'][strip])
+                data = file.read(self._layout['byte_counts'][strip])
+                strips.append(self._decode_strip(data, min(rows_per_strip, self.height - strip * rows_per_strip)))
+        band = np.concatenate(strips)
+        band_top = first * rows_per_strip
+        return band[top - band_top:bottom - band_top]
+
+
+class TileRowStream:
+    """
+    Iterates over the rows of patches of a page, padded and tiled exactly like TestDataset, keeping in memory only the
+    band of rows covered by the current row of patches.
+    """
+
+    def __init__(self, path, patch_size=256, stride=256, tiling='shift'):
+        self.reader = RowBandReader(path)
+        self.patch_size = patch_size
+        self.stride = stride
+
+        self.height, self.width = self.reader.height, self.reader.width
+        plan = TilePlan(self.height, self.width, patch_size, stride, tiling)
+        self.origins_y = plan.origins_y
+        self.origins_x = plan.origins_x
+        self.padded_width = plan.padded_size[1]
+
+    def __len__(self):
+        return len(self.origins_y)
+
+    def _read(self, top: int, bottom: int):
+        band = np.full((bottom - top, self.padded_width, 3), 255, dtype=np.uint8)
+        if top < self.height:
+            rows = self.reader.read(top, min(bottom, self.height))
+            band[:rows.shape[0], :self.width] = rows
+        return band
+
+    def __iter__(self):
+        """
+        :return: generator of (row index, patches) where patches has shape (num_cols, 3, patch_size, patch_size)
+        """
+        band = np.empty((0, self.padded_width, 3), dtype=np.uint8)
+        band_top = 0
+        for row, top in enumerate(self.origins_y):
+            bottom = top + self.patch_size
+            band = band[top - band_top:]
+            band_top = top
+            if band_top + band.shape[0] < bottom:
+                band = np.concatenate([band, self._read(band_top + band.shape[0], bottom)])
+
+            tensor = torch.from_numpy(band).permute(2, 0, 1).float().div(255).unsqueeze(0)
+            patches = tensor.unfold(3, self.patch_size, 1)[:, :, :, self.origins_x]  # (1, 3, p, num_cols, p)
+            patches = patches.permute(0, 3, 1, 2, 4).reshape(-1, 3, self.patch_size, self.patch_size)
+            yield row, patches
@@ -1,11 +1,13 @@
+import functools
+import hashlib
 import math
 import os
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
-from torchvision.transforms import transforms, functional
-from torchvision.utils import make_grid
+from torchvision.transforms import transforms
 
 import data.CustomTransforms as CustomTransform
 
@@ -15,6 +17,28 @@ def get_path(root: str, paths: list, index: int):
     return os.path.join(root, paths[index])
 
 
+def shard_paths(paths: list, num_shards: int, shard: int, by: str = 'index', root=None):
+    """
+    Deterministically split a list of files: every shard gets a disjoint subset and together they cover the list.
+
+    :param by: 'index' deals the sorted files round-robin; 'hash' assigns every file by a hash of its path (relative
+    to root, if given), so the assignment of a file does not change when other files are added or removed
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard {shard} out of range for {num_shards} shards")
+    paths = sorted(paths)
+    if by == 'index':
+        return paths[shard::num_shards]
+    elif by == 'hash':
+        def key(path):
+            name = os.path.relpath(path, root) if root is not None else str(path)
+            return int(hashlib.md5(name.encode()).hexdigest(), 16)
+
+        return [path for path in paths if key(path) % num_shards == shard]
+    else:
+        raise ValueError(f"Unknown sharding {by}")
+
+
 def get_transform(transform_variant: str, output_size: int):
     transform_list = []
     if transform_variant == 'gaussian':
@@ -22,12 +46,11 @@ def get_transform(transform_variant: str, output_size: int):
     elif transform_variant == 'equalize_contrast':
         transform_list.append(CustomTransform.RandomEqualize())
 
+    color_jitter = None
     if transform_variant != 'no_color_jitter':
-        transform_list.append(CustomTransform.ColorJitter(brightness=0.5, contrast=0.5, hue=0.5, saturation=0.5))
-    transform_list.append(CustomTransform.RandomRotation((0, 360)))
-    transform_list.append(CustomTransform.RandomHorizontalFlip())
-    transform_list.append(CustomTransform.RandomVerticalFlip())
-    transform_list.append(CustomTransform.RandomCrop(output_size))
+        color_jitter = transforms.ColorJitter(brightness=0.5, contrast=0.5, hue=0.5, saturation=0.5)
+    # Rotation, flips and crop, jittering only the part of the patch that ends up in the crop
+    transform_list.append(CustomTransform.RandomAffineCrop(output_size, degrees=(0, 360), color_jitter=color_jitter))
     transform_list.append(CustomTransform.ToTensor())
 
     if transform_variant == 'threshold_mask':
@@ -35,8 +58,7 @@ def get_transform(transform_variant: str, output_size: int):
 
     if transform_variant == 'latin':
         transform_list = [
-            CustomTransform.RandomRotation((-10, 10)),
-            CustomTransform.RandomCrop(output_size),
+            CustomTransform.RandomAffineCrop(output_size, degrees=(-10, 10), hflip=0., vflip=0.),
             CustomTransform.ColorJitter(brightness=0.5, contrast=0.5, hue=0.5, saturation=0.5),
             CustomTransform.ToTensor(),
         ]
@@ -66,52 +88,265 @@ def get_patches(image_source: Image, patch_size: int, stride: int):
     return np.array(image_patches), num_rows, num_cols
 
 
-def reconstruct_ground_truth(patches, original, num_rows, config):
-    channels = 1
-    batch_size = 1
+def make_test_stride(patch_size: int, overlap: bool = False, halo: int = None):
+    """
+    Stride between the test patches: patch_size, or patch_size // 2 with overlap. With a halo, the patches overlap by
+    2 * halo pixels, so that with crop blending every patch only contributes its core of patch_size - 2 * halo pixels
+    and the halo is context: the model computes ((core + 2 * halo) / core) ** 2 pixels per page pixel.
+    """
+    if halo is None:
+        return patch_size // 2 if overlap else patch_size
+    if not 0 <= 2 * halo < patch_size:
+        raise ValueError(f"Halo {halo} leaves no core in patches of size {patch_size}")
+    return patch_size - 2 * halo
+
+
+def plan_axis(size: int, patch_size: int, stride: int, tiling: str = 'shift'):
+    """
+    Origins of the patches along one side of a page.
+
+    :param tiling: 'shift' covers the side with the fewest patches: a patch every stride pixels and the last one moved
+    back so that it ends on the last pixel (the side is only padded when it is shorter than a patch); 'pad' pads the
+    side to the next multiple of patch_size past its end, as the original TestDataset, and one more stride when the
+    stride does not divide patch_size (e.g. with a halo)
+    """
+    if tiling == 'pad':
+        padded = ((size // patch_size) + 1) * patch_size
+        origins = list(range(0, padded - patch_size + 1, stride))
+        if origins[-1] + patch_size < padded:
+            origins.append(origins[-1] + stride)
+        return origins
+    elif tiling == 'shift':
+        if size <= patch_size:
+            return [0]
+        origins = list(range(0, size - patch_size, stride))
+        return origins + [size - patch_size]
+    else:
+        raise ValueError(f"Unknown tiling {tiling}")
+
+
+class TilePlan:
+    """The patches that cover a page: their origins along each side and how much work they represent."""
+
+    def __init__(self, height: int, width: int, patch_size: int, stride: int, tiling: str = 'shift'):
+        if stride > patch_size:
+            raise ValueError(f'Stride {stride} leaves gaps between patches of size {patch_size}')
+        self.height, self.width = height, width
+        self.patch_size = patch_size
+        self.origins_y = plan_axis(height, patch_size, stride, tiling)
+        self.origins_x = plan_axis(width, patch_size, stride, tiling)
+        assert self.origins_y[-1] + patch_size >= height and self.origins_x[-1] + patch_size >= width, \
+            f'The {tiling} tiling does not cover a page of {height}x{width} with patches of {patch_size}'
+
+    @property
+    def padded_size(self):
+        return self.origins_y[-1] + self.patch_size, self.origins_x[-1] + self.patch_size
+
+    @property
+    def num_tiles(self):
+        return len(self.origins_y) * len(self.origins_x)
+
+    @property
+    def redundancy(self):
+        """Pixels computed per pixel of the page: 1 means that no pixel is computed twice or padded"""
+        return self.num_tiles * self.patch_size ** 2 / (self.height * self.width)
+
+    def __repr__(self):
+        return (f'TilePlan({self.height}x{self.width}: {len(self.origins_y)}x{len(self.origins_x)} tiles, '
+                f'redundancy {self.redundancy:.2f})')
+
+
+def tile_grid(height: int, width: int, patch_size: int, stride: int, tiling: str = 'shift'):
+    """:return: number of rows and columns of the patches make_test_patches cuts from a page of the given size"""
+    plan = TilePlan(height, width, patch_size, stride, tiling)
+    return len(plan.origins_y), len(plan.origins_x)
+
+
+def make_test_patches(page, patch_size: int, stride: int, tiling: str = 'shift'):
+    """
+    Split a page into the (overlapping) patches of its TilePlan, padding it with white on the bottom and right when it
+    is shorter than a patch (or always, with tiling 'pad').
+
+    :param page: tensor with shape (batch, channels, height, width)
+    :return: patches with shape (batch, channels, num_patches, patch_size, patch_size) in row-major order, and the
+    number of patches along each row of the page
+    """
+    batch, channels, height, width = page.shape
+    plan = TilePlan(height, width, patch_size, stride, tiling)
+    padded_height, padded_width = plan.padded_size
+
+    page = F.pad(page, [0, max(0, padded_width - width), 0, max(0, padded_height - height)], value=1)
+    # Windows of every origin are views: only the windows of the plan are copied
+    origins_y = torch.tensor(plan.origins_y, device=page.device)
+    origins_x = torch.tensor(plan.origins_x, device=page.device)
+    patches = page.unfold(2, patch_size, 1)[:, :, origins_y]  # (batch, channels, rows, width, p)
+    patches = patches.unfold(3, patch_size, 1)[:, :, :, origins_x]  # (batch, channels, rows, cols, p, p)
+    num_rows = len(plan.origins_x)
+    patches = patches.reshape(batch, channels, -1, patch_size, patch_size)
+    return patches, num_rows
+
+
+def blank_tiles(patches, max_std: float, min_mean: float = 0.5, window: int = 8):
+    """
+    Cheap pre-pass over the patches of a page: a patch is background when every window x window block of its grayscale
+    is flat (standard deviation at most max_std) and bright (mean at least min_mean), so that neither strokes nor
+    large inked areas are taken for background. The white padding of the page is always background.
+
+    :param patches: tensor with shape (num_patches, channels, patch_size, patch_size)
+    :return: bool tensor with shape (num_patches,)
+    """
+    gray = patches.float().mean(dim=1, keepdim=True)
+    mean = F.avg_pool2d(gray, window, ceil_mode=True)
+    std = (F.avg_pool2d(gray * gray, window, ceil_mode=True) - mean * mean).clamp_min(0).sqrt()
+    return (std.amax(dim=(1, 2, 3)) <= max_std) & (mean.amin(dim=(1, 2, 3)) >= min_mean)
+
+
+def blank_tiles_mask(blank, original, num_rows, config):
+    """
+    :param blank: bool tensor with shape (num_patches,), as returned by blank_tiles
+    :return: bool tensor with the shape of the reconstructed page, True where the page is taken from blank patches
+    """
     patch_size = config['test_patch_size']
-    stride = config['test_stride']
-
-    _, _, height, width = original.shape
-    width, height = original.shape[-1], original.shape[-2]
-    tmp_patches = patches.view(batch_size, channels, -1, num_rows, patch_size, patch_size)
-    patch_width, patch_height = tmp_patches.shape[-1], tmp_patches.shape[-2]
-    # tensor_padded_width = (patch_width // 2) * tmp_patches.shape[-3] + (patch_width // 2)
-    # tensor_padded_height = (patch_height // 2) * tmp_patches.shape[-4] + (patch_height // 2)
-    tensor_padded_width = patch_width * tmp_patches.shape[-3] - (patch_width - stride) * (tmp_patches.shape[-3] - 1)
-    tensor_padded_height = patch_height * tmp_patches.shape[-4] - (patch_height - stride) * (tmp_patches.shape[-4] - 1)
-    # padding_width = tensor_padded_width - width
-    # padding_height = tensor_padded_height - height
-    # padding_up = math.ceil(padding_height / 2)
-    # padding_left = math.ceil(padding_width / 2)
-
-    padding_up = 0
-    padding_left = 0
-
-    if stride == (patch_size // 2):
-        patches = tmp_patches
-
-        x_steps = [x + (stride // 2) for x in range(0, tensor_padded_height, stride)]
-        x_steps[0], x_steps[-1] = 0, tensor_padded_height
-        y_steps = [y + (stride // 2) for y in range(0, tensor_padded_width, stride)]
-        y_steps[0], y_steps[-1] = 0, tensor_padded_width
-
-        canvas = torch.zeros(batch_size, channels, tensor_padded_height, tensor_padded_width)
-        for j in range(len(x_steps) - 1):
-            for i in range(len(y_steps) - 1):
-                patch = patches[0, :, j, i, :, :]
-                x1_abs, x2_abs = x_steps[j], x_steps[j + 1]
-                y1_abs, y2_abs = y_steps[i], y_steps[i + 1]
-                x1_rel, x2_rel = x1_abs - (j * stride), x2_abs - (j * stride)
-                y1_rel, y2_rel = y1_abs - (i * stride), y2_abs - (i * stride)
-                canvas[0, :, x1_abs:x2_abs, y1_abs:y2_abs] = patch[:, x1_rel:x2_rel, y1_rel:y2_rel]
-        canvas = functional.crop(canvas, top=padding_up, left=padding_left, height=height, width=width)
-        canvas = canvas.to(original.device)
+    tiles = blank.float()[:, None, None, None].expand(-1, 1, patch_size, patch_size)
+    return reconstruct_ground_truth(tiles, original, num_rows, config) > 0.5
+
+
+def pad_to_multiple(page, multiple: int):
+    """
+    Reflect-pad a page on the bottom and right to a multiple of multiple pixels, as a fully convolutional LaMa with
+    n_downsampling down-sampling layers needs (multiple = 2 ** n_downsampling) to give back an output of its size.
+
+    :param page: tensor with shape (batch, channels, height, width)
+    """
+    height, width = page.shape[-2:]
+    pad_bottom, pad_right = -height % multiple, -width % multiple
+    if pad_bottom == 0 and pad_right == 0:
+        return page
+    # The reflection must be shorter than the page
+    mode = 'reflect' if pad_bottom < height and pad_right < width else 'replicate'
+    return F.pad(page, [0, pad_right, 0, pad_bottom], mode=mode)
+
+
+def _axis_weights(origins: list, patch_size: int, blending: str):
+    """Blending window of every tile along one axis, with shape (len(origins), patch_size)."""
+    if blending == 'crop':
+        # Every pixel is taken from the tile whose centre is closest: tile k keeps the pixels between the middle of
+        # its overlap with tile k - 1 and the middle of its overlap with tile k + 1
+        weights = torch.zeros(len(origins), patch_size)
+        for k, origin in enumerate(origins):
+            start = 0 if k == 0 else (origins[k - 1] + patch_size + origin) // 2 - origin
+            end = patch_size if k == len(origins) - 1 else (origin + patch_size + origins[k + 1]) // 2 - origin
+            weights[k, start:end] = 1.
+        return weights
+
+    if blending == 'mean':
+        window = torch.ones(patch_size)
+    elif blending == 'gaussian':
+        coords = torch.arange(patch_size, dtype=torch.float32) - (patch_size - 1) / 2
+        window = torch.exp(-0.5 * (coords / (patch_size / 8)) ** 2)
+    elif blending == 'hann':
+        window = torch.hann_window(patch_size + 2, periodic=False)[1:-1]
     else:
-        tensor = make_grid(patches, nrow=num_rows, padding=0, value_range=(0, 1))
-        tensor = functional.rgb_to_grayscale(tensor)
-        _, _, height, width = original.shape
-        canvas = functional.crop(tensor, top=padding_up, left=padding_left, height=height, width=width)
-        canvas = canvas.unsqueeze(0)
+        raise ValueError(f'Unknown blending {blending}')
+    return window.expand(len(origins), -1)
+
+
+@functools.lru_cache(maxsize=64)
+def _axis_overlap(origins: tuple, patch_size: int, blending: str, device):
+    """
+    :return: blending weights of every tile along one axis (len(origins), patch_size), the position on the page of
+    every pixel of every tile (len(origins) * patch_size) and the sum of the weights at every position of the page
+    """
+    weights = _axis_weights(list(origins), patch_size, blending).to(device)
+    index = (torch.tensor(origins)[:, None] + torch.arange(patch_size)[None, :]).reshape(-1).to(device)
+    norm = torch.zeros(origins[-1] + patch_size, device=device).index_add_(0, index, weights.reshape(-1))
+    return weights, index, norm
+
+
+def reconstruct_ground_truth(patches, original, num_rows, config):
+    """
+    Overlap-add the predicted patches of a page back into a single image.
+
+    :param patches: tensor with shape (num_patches, channels, patch_size, patch_size), in row-major order
+    :param original: tensor with the page shape (batch, channels, height, width), or the (height, width) of the page
+    :param num_rows: number of patches along each row of the page (as returned by TestDataset)
+    :param config: uses 'test_patch_size', 'test_stride', 'test_tiling' (shift or pad, as make_test_patches) and
+    'test_blending' (crop, mean, gaussian or hann)
+    :return: tensor with shape (1, channels, height, width)
+    """
+    patch_size = config['test_patch_size']
+    blending = config.get('test_blending', 'crop')
+
+    height, width = original.shape[-2:] if torch.is_tensor(original) else original
+    plan = TilePlan(height, width, patch_size, config['test_stride'], config.get('test_tiling', 'shift'))
+    num_patches, channels = patches.shape[:2]
+    tile_rows, tiles_per_row = len(plan.origins_y), len(plan.origins_x)
+    if num_rows != tiles_per_row or num_patches != plan.num_tiles:
+        raise ValueError(f'{num_patches} patches ({num_rows} per row) do not match {plan}')
+
+    weights_y, index_y, norm_y = _axis_overlap(tuple(plan.origins_y), patch_size, blending, patches.device)
+    weights_x, index_x, norm_x = _axis_overlap(tuple(plan.origins_x), patch_size, blending, patches.device)
+
+    # The weights are separable: add the tiles of every row along the width, then the rows along the height
+    tiles = patches.reshape(tile_rows, tiles_per_row, channels, patch_size, patch_size)
+    tiles = tiles * weights_x.to(tiles.dtype)[None, :, None, None, :]
+    tiles = tiles.permute(0, 2, 3, 1, 4).reshape(tile_rows, channels, patch_size, tiles_per_row * patch_size)
+    rows = tiles.new_zeros(tile_rows, channels, patch_size, norm_x.shape[0]).index_add_(3, index_x, tiles)
+
+    rows = rows * weights_y.to(rows.dtype)[:, None, :, None]
+    rows = rows.permute(1, 0, 2, 3).reshape(channels, tile_rows * patch_size, norm_x.shape[0])
+    canvas = rows.new_zeros(channels, norm_y.shape[0], norm_x.shape[0]).index_add_(1, index_y, rows)
+
+    canvas = canvas / (norm_y[:, None] * norm_x[None, :]).to(canvas.dtype)
+    canvas = canvas[None, :, :height, :width]
+
+    return canvas.to(original.device) if torch.is_tensor(original) else canvas
+
+
+class RowReconstructor:
+    """
+    Streaming counterpart of reconstruct_ground_truth: the rows of patches of a page are added one at a time and the
+    rows of the page that no later patch can touch are returned as soon as they are complete.
+    """
+
+    def __init__(self, height, width, origins_y, origins_x, patch_size, stride, blending='crop'):
+        self.height, self.width = height, width
+        self.origins_y = origins_y
+        self.patch_size = patch_size
+        self.stride = stride
+
+        self.origins_x = tuple(origins_x)
+        self.blending = blending
+        self.weights_y, _, self.norm_y = _axis_overlap(tuple(origins_y), patch_size, blending, torch.device('cpu'))
+        self.padded_height = origins_y[-1] + patch_size
+        self.padded_width = origins_x[-1] + patch_size
+
+        self.canvas = None
+        self.top = 0
+
+    def add_row(self, row, patches):
+        """
+        :param row: index of the row of patches
+        :param patches: tensor with shape (num_cols, 1, patch_size, patch_size)
+        :return: tensor with shape (n, width) holding the finished rows of the page (possibly n == 0)
+        """
+        patch_size = self.patch_size
+        if self.canvas is None:
+            self.canvas = torch.zeros(patch_size, self.padded_width, device=patches.device)
+            self.weights_y = self.weights_y.to(patches.device)
+            self.norm_y = self.norm_y.to(patches.device)
+            self.weights_x, self.index_x, self.norm_x = _axis_overlap(self.origins_x, patch_size, self.blending,
+                                                                      patches.device)
+
+        blocks = patches[:, 0] * self.weights_x[:, None, :]  # (num_cols, patch_size, patch_size)
+        blocks = blocks.permute(1, 0, 2).reshape(patch_size, -1)
+        strip = torch.zeros_like(self.canvas).index_add_(1, self.index_x, blocks)
+        self.canvas += strip * self.weights_y[row][:, None]
+
+        top = self.top
+        next_top = self.origins_y[row + 1] if row + 1 < len(self.origins_y) else self.padded_height
+        rows = self.canvas[:next_top - top] / (self.norm_y[top:next_top, None] * self.norm_x[None, :])
+        self.canvas = torch.cat([self.canvas[next_top - top:], self.canvas.new_zeros(next_top - top, self.padded_width)])
+        self.top = next_top
 
-    return canvas
+        return rows[:max(0, min(next_top, self.height) - top), :self.width]
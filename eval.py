@@ -1,39 +1,161 @@
 import argparse
+import multiprocessing
+import os
 import torch
 from pathlib import Path
-from trainer.LaMaTrainer import LaMaTrainingModule
 from data.TestDataset import FolderDataset
-from torchvision import transforms
+from data.utils import shard_paths, make_test_stride
+from trainer.Runtime import Binarizer, whole_page_pixels
+from utils.ioutils import PngStreamWriter, AsyncImageWriter
+
+
+def output_path(dst, src_img_path):
+    return dst / (Path(src_img_path).stem + '.png')
+
+
+def pin_worker(worker, num_workers, threads=None):
+    """Pin the worker to its share of the cores available to this process and size the torch thread pool on it."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    per_worker = max(1, len(cores) // num_workers)
+    start = (worker * per_worker) % len(cores)
+    worker_cores = cores[start:start + per_worker]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cores)
+    torch.set_num_threads(threads if threads else len(worker_cores))
+    return worker_cores
+
+
+def binarize_folder(args, paths, worker=0, num_workers=1):
+    prefix = f'[{args.node_rank}.{worker}] ' if args.num_nodes * num_workers > 1 else ''
+    if num_workers > 1:
+        cores = pin_worker(worker, num_workers, args.threads)
+        print(f'{prefix}Pinned to cores {cores}')
+    elif args.threads:
+        torch.set_num_threads(args.threads)
+
+    device = torch.device('cuda' if torch.cuda.is_available() and args.backend != 'onnx' else 'cpu')
+    kwargs = {'fuse': True} if args.backend == 'eager' and args.fuse else {}
+    chunked = args.backend == 'eager' and args.whole_page and args.chunk_size > 0
+    if chunked:
+        kwargs['chunk_size'] = args.chunk_size
+    binarizer = Binarizer.from_file(args.model, backend=args.backend, device=device, **kwargs)
+    config = binarizer.config
+
+    src = Path(args.src)
+    dst = Path(args.dst)
+
+    config['test_patch_size'] = args.patch_size
+    config['test_stride'] = make_test_stride(args.patch_size, args.overlap, args.halo)
+    config['test_blending'] = 'crop' if args.halo is not None else args.blending
+    config['test_tiling'] = args.tiling
+    config['blank_tile_std'] = args.blank_tile_std
+    config['blank_tile_min_mean'] = args.blank_tile_min_mean
+
+    if args.stream:
+        dataset = FolderDataset(src, patch_size=args.patch_size, stride=config['test_stride'], load_data=False,
+                                paths=paths, tiling=args.tiling)
+        for i, src_img_path in enumerate(dataset.imgs_path):
+            stream = dataset.stream(i)
+            dst_img_path = output_path(dst, src_img_path)
+            tmp_img_path = Path(f'{dst_img_path}.tmp')
+            with PngStreamWriter(tmp_img_path, stream.width, stream.height) as writer:
+                binarizer.stream_binarize(stream, writer, config['threshold'])
+            os.replace(tmp_img_path, dst_img_path)
+            print(f'{prefix}({i + 1}/{len(dataset)}) Saving {dst_img_path}')
+    else:
+        max_pixels = whole_page_pixels(config, args.memory_budget_mb * 1024 ** 2, chunked) if args.whole_page else 0
+        if args.whole_page and not max_pixels:
+            print(f'{prefix}The model is not fully convolutional: binarizing every page by patches')
+        dataset = FolderDataset(src, patch_size=args.patch_size, stride=config['test_stride'], load_data=False,
+                                with_targets=False, paths=paths, tiling=args.tiling, whole_page_pixels=max_pixels,
+                                page_multiple=2 ** config['n_downsampling'])
+        loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=args.decode_workers,
+                                             pin_memory=device.type == 'cuda')
+
+        # Decoding runs in the loader workers and encoding in the writer threads, both overlapping with the model
+        with AsyncImageWriter(max_workers=args.encode_workers, max_pending=args.max_pending) as writer:
+            for i, (image_name, pred) in enumerate(binarizer.binarize(loader, config['threshold'])):
+                mask = pred[0, 0].mul(255).to(torch.uint8).cpu().numpy()
+                dst_img_path = output_path(dst, image_name)
+                writer.submit(mask, dst_img_path)
+                print(f'{prefix}({i + 1}/{len(dataset)}) Saving {dst_img_path}')
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Binarize a folder of images')
-    parser.add_argument('model', type=str, metavar='PATH', help='path to the model file')
+    parser.add_argument('model', type=str, metavar='PATH',
+                        help='path to the model file: a checkpoint, or a model exported by export_inference.py')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnx'],
+                        help='runtime used to run the model')
+    parser.add_argument('--fuse', action='store_true', help='fold the batch norms of an eager checkpoint')
     parser.add_argument('--src', type=str, required=True, help='path to the folder of input images')
     parser.add_argument('--dst', type=str, required=True, help='path to the folder of output images')
     parser.add_argument('--patch_size', type=int, default=256, help='patch size')
     parser.add_argument('--overlap', action='store_true', help='use overlapping patches')
+    parser.add_argument('--halo', type=int, default=None,
+                        help='overlap the patches by twice this many pixels and keep only their core (see halo_probe.py)')
+    parser.add_argument('--blending', type=str, default='crop', choices=['crop', 'mean', 'gaussian', 'hann'],
+                        help='how overlapping patches are merged')
+    parser.add_argument('--tiling', type=str, default='shift', choices=['shift', 'pad'],
+                        help='move the last patches inside the page, or pad the page past its end')
+    parser.add_argument('--blank_tile_std', type=float, default=0.,
+                        help='skip the patches whose 8x8 blocks all have a standard deviation at most this and fill '
+                             'them with white (0 to run every patch)')
+    parser.add_argument('--blank_tile_min_mean', type=float, default=0.5,
+                        help='minimum brightness of every 8x8 block of a skipped patch')
+    parser.add_argument('--stream', action='store_true',
+                        help='binarize one row of patches at a time, for pages too large to fit in memory. Only '
+                             'uncompressed strip TIFFs are read by bands: other files are still decoded whole')
+    parser.add_argument('--whole_page', action='store_true',
+                        help='binarize every page in a single forward pass when the model is fully convolutional '
+                             '(use_convolutions) and its activations fit in --memory_budget_mb, by patches otherwise')
+    parser.add_argument('--memory_budget_mb', type=int, default=4096,
+                        help='estimated activation memory allowed for a whole page forward pass')
+    parser.add_argument('--chunk_size', type=int, default=0,
+                        help='with --whole_page and the eager backend, run every stage of the model over chunks of '
+                             'this many pixels, keeping the stage outputs in host memory (--memory_budget_mb then '
+                             'bounds the host memory)')
+    parser.add_argument('--decode_workers', type=int, default=4,
+                        help='processes decoding and tiling the pages while the model runs')
+    parser.add_argument('--encode_workers', type=int, default=2, help='threads encoding and writing the outputs')
+    parser.add_argument('--max_pending', type=int, default=8,
+                        help='maximum number of outputs waiting to be written')
+    parser.add_argument('--num_nodes', type=int, default=1, help='number of machines sharing the folder')
+    parser.add_argument('--node_rank', type=int, default=0, help='index of this machine among the num_nodes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='binarization processes on this machine, each pinned to its share of the cores')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads of every process')
+    parser.add_argument('--shard_by', type=str, default='index', choices=['index', 'hash'],
+                        help='deal the sorted files round-robin, or assign them by a hash of their path')
+    parser.add_argument('--skip_existing', action='store_true',
+                        help='skip the images whose output already exists, to resume an interrupted run')
     args = parser.parse_args()
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    fourbi = LaMaTrainingModule(config={'resume': args.model}, device=device, make_loaders=False)
-
     src = Path(args.src)
     dst = Path(args.dst)
     dst.mkdir(parents=True, exist_ok=True)
 
-    dataset = FolderDataset(src, patch_size=args.patch_size, overlap=args.overlap, transform=transforms.ToTensor())
-    fourbi.test_data_loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=0)
-
-    fourbi.config['test_patch_size'] = args.patch_size
-    fourbi.config['test_stride'] = args.patch_size // 2 if args.overlap else args.patch_size
+    # Shard before skipping: the shards only depend on the folder, not on how far every worker got
+    paths = FolderDataset.list_images(src)
+    num_shards = args.num_nodes * args.workers
+    shards = [shard_paths(paths, num_shards, args.node_rank * args.workers + worker, by=args.shard_by, root=src)
+              for worker in range(args.workers)]
+    if args.skip_existing:
+        num_paths = sum(len(shard) for shard in shards)
+        shards = [[path for path in shard if not output_path(dst, path).exists()] for shard in shards]
+        print(f'Skipping {num_paths - sum(len(shard) for shard in shards)} images already binarized')
 
-    for i, sample in enumerate(fourbi.folder_test()):
-        key = list(sample.keys())[0]
-        img, pred, gt = sample[key]
-        src_img_path = Path(key)
-
-        dst_img_path = dst / (src_img_path.stem + '.png')
-        pred.save(str(dst_img_path))
-        print(f'({i + 1}/{len(dataset)}) Saving {dst_img_path}')
+    if args.workers == 1:
+        binarize_folder(args, shards[0])
+    else:
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=binarize_folder, args=(args, shard, worker, args.workers))
+                     for worker, shard in enumerate(shards)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [worker for worker, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'Workers {failed} failed')
     print('Done.')
-
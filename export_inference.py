@@ -0,0 +1,87 @@
+import argparse
+import warnings
+from pathlib import Path
+
+import torch
+
+from modules.fusion import make_inference_model, check_inference_model
+from trainer.LaMaTrainer import LaMaTrainingModule
+from trainer.Runtime import save_config, make_backend
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+SUFFIXES = {'pickle': '.inference.pth', 'torchscript': '.ts', 'onnx': '.onnx'}
+
+
+def export_torchscript(model, example, dst):
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(model, example, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, str(dst))
+
+
+def export_onnx(model, example, dst, opset):
+    with torch.no_grad():
+        torch.onnx.export(model, example, str(dst), input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'output': {0: 'batch', 2: 'height', 3: 'width'}},
+                          opset_version=opset, do_constant_folding=True)
+
+
+@torch.no_grad()
+def check_export(model, backend, input_size):
+    inputs = torch.rand(input_size)
+    return (model(inputs) - backend(inputs)).abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a frozen inference model from a training checkpoint')
+    parser.add_argument('model', type=str, metavar='PATH', help='path to the checkpoint file')
+    parser.add_argument('--dst', type=str, default=None, help='path of the exported model')
+    parser.add_argument('--format', type=str, default='pickle', choices=['pickle', 'torchscript', 'onnx'])
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--patch_size', type=int, default=256, help='patch size used for the numerical check')
+    parser.add_argument('--atol', type=float, default=1e-4, help='tolerance of the numerical check')
+    args = parser.parse_args()
+
+    fourbi = LaMaTrainingModule(config={'resume': args.model}, device=torch.device('cpu'), make_loaders=False)
+    fourbi.model.eval()
+
+    inference_model = make_inference_model(fourbi.model)
+    difference = check_inference_model(fourbi.model, inference_model,
+                                       input_size=(2, 3, args.patch_size, args.patch_size), atol=args.atol)
+    print(f'Max absolute difference from the original model: {difference:.2e}')
+
+    dst = Path(args.dst) if args.dst else Path(args.model).with_suffix(SUFFIXES[args.format])
+    if args.format == 'pickle':
+        torch.save({'model': inference_model, 'config': fourbi.config}, dst)
+        print(f'Saved {dst}')
+    else:
+        example = torch.rand(1, 3, args.patch_size, args.patch_size)
+        if args.format == 'torchscript':
+            export_torchscript(inference_model, example, dst)
+        else:
+            export_onnx(inference_model, example, dst, args.opset)
+        save_config(fourbi.config, dst)
+
+        # The exported graph is traced on a single size: check it on the traced size and on a different one, since
+        # the split of the local Fourier unit and the FFT shapes can be recorded as constants
+        backend = make_backend(args.format, dst, torch.device('cpu'))
+        difference = check_export(inference_model, backend, (1, 3, args.patch_size, args.patch_size))
+        print(f'Max absolute difference of the {args.format} export: {difference:.2e}')
+        if difference > args.atol:
+            raise ValueError(f"The {args.format} export differs from the inference model by {difference:.2e}")
+
+        other_size = args.patch_size + 2 ** fourbi.config['n_downsampling'] * 4
+        try:
+            difference = check_export(inference_model, backend, (2, 3, other_size, other_size))
+        except Exception as e:
+            difference = float('inf')
+            logger.warning(f"The export failed on a {other_size}x{other_size} input: {e}")
+        if difference > args.atol:
+            logger.warning(f"The export is specialized to {args.patch_size}x{args.patch_size} inputs: "
+                           f"run it with --test_patch_size {args.patch_size}")
+
+        print(f'Saved {dst} and {dst}.json')
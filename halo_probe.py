@@ -0,0 +1,99 @@
+import argparse
+
+import torch
+
+from data.TestDataset import FolderDataset
+from data.utils import make_test_stride, TilePlan
+from trainer.Runtime import EagerBackend
+from trainer.TileScheduler import TileScheduler
+
+
+def effective_receptive_field(model, patch, mass=0.99):
+    """
+    :param patch: tensor with shape (1, 3, patch_size, patch_size)
+    :return: smallest radius (in pixels, Chebyshev distance) around the central output pixel that holds mass of the
+    gradient of that pixel with respect to the input. The Fourier units make the receptive field global, so the
+    effective one is measured instead.
+    """
+    patch_size = patch.shape[-1]
+    centre = patch_size // 2
+    inputs = patch.clone().requires_grad_(True)
+    with torch.enable_grad():
+        model(inputs)[0, 0, centre, centre].backward()
+    grad = inputs.grad.abs().sum(dim=1)[0]
+
+    coords = torch.arange(patch_size, device=grad.device)
+    distance = torch.maximum((coords[:, None] - centre).abs(), (coords[None, :] - centre).abs())
+    per_radius = torch.bincount(distance.reshape(-1), weights=grad.reshape(-1).double())
+    cumulative = per_radius.cumsum(0) / per_radius.sum()
+    return int(torch.searchsorted(cumulative, torch.tensor(mass, dtype=cumulative.dtype, device=grad.device)))
+
+
+@torch.no_grad()
+def binarize(model, config, dataset, threshold, device):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=0)
+    scheduler = TileScheduler(model, config, device=device)
+    return [(pred > threshold).cpu() for _, pred in scheduler.run(loader)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the smallest halo that leaves the binarization unchanged')
+    parser.add_argument('model', type=str, metavar='PATH', help='path to the checkpoint file')
+    parser.add_argument('--src', type=str, required=True, help='folder of pages to probe on')
+    parser.add_argument('--max_pages', type=int, default=8)
+    parser.add_argument('--patch_size', type=int, default=256)
+    parser.add_argument('--halos', type=int, nargs='+', default=[0, 8, 16, 24, 32, 48, 64])
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='maximum fraction of pixels allowed to differ from the reference')
+    parser.add_argument('--mass', type=float, default=0.99,
+                        help='fraction of the gradient inside the effective receptive field')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    backend = EagerBackend(args.model, device)
+    config = backend.config
+    threshold = config['threshold']
+    patch_size = args.patch_size
+    config['test_patch_size'] = patch_size
+
+    paths = FolderDataset.list_images(args.src)[:args.max_pages]
+
+    # Effective receptive field, on the centre patch of the first page
+    dataset = FolderDataset(args.src, patch_size=patch_size, stride=patch_size, load_data=False, with_targets=False,
+                            paths=paths[:1])
+    item = dataset[0]
+    patches = item['samples_patches'][0].permute(1, 0, 2, 3)
+    radius = effective_receptive_field(backend.model, patches[len(patches) // 2:len(patches) // 2 + 1].to(device),
+                                       args.mass)
+    print(f'Effective receptive field: {args.mass:.0%} of the gradient within {radius} pixels')
+
+    # Reference: half-stride overlapping patches, the default of the test passes
+    def run(stride):
+        config['test_stride'] = stride
+        config['test_blending'] = 'crop'
+        dataset = FolderDataset(args.src, patch_size=patch_size, stride=stride, load_data=False, with_targets=False,
+                                paths=paths)
+        return binarize(backend.model, config, dataset, threshold, device)
+
+    def tiles(stride):
+        return sum(TilePlan(*page.shape[-2:], patch_size, stride).num_tiles for page in reference)
+
+    reference = run(patch_size // 2)
+    reference_tiles = tiles(patch_size // 2)
+
+    recommended = None
+    print(f'{"halo":>6} {"stride":>6} {"tiles":>8} {"work":>6} {"differing pixels":>18}')
+    for halo in sorted(h for h in args.halos if 2 * h < patch_size):
+        stride = make_test_stride(patch_size, halo=halo)
+        masks = run(stride)
+        differing = sum((mask != ref).sum().item() for mask, ref in zip(masks, reference))
+        fraction = differing / sum(ref.numel() for ref in reference)
+        num_tiles = tiles(stride)
+        print(f'{halo:>6} {stride:>6} {num_tiles:>8} {num_tiles / reference_tiles:>5.2f}x {fraction:>18.2e}')
+        if recommended is None and fraction <= args.tolerance:
+            recommended = halo
+
+    if recommended is None:
+        print(f'No halo keeps the differing pixels within {args.tolerance:.0e}')
+    else:
+        print(f'Recommended halo: {recommended} (--halo {recommended}, or --test_halo {recommended} in train.py)')
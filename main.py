@@ -17,7 +17,9 @@ def create_patches(args):
     patcher = PatchImage(patch_size=patch_size,
                          patch_size_valid=patch_size_valid,
                          overlap_size=overlap_size,
-                         destination_root=destination)
+                         destination_root=destination,
+                         output_format=args.output_format,
+                         workers=args.workers)
     patcher.create_patches(root_original=root_original,
                            root_ground_truth=root_ground_truth,
                            validation_dataset=validation_dataset,
@@ -40,18 +40,39 @@ class FFCSE_block(nn.Module):
         return x_l, x_g
 
 
+def _is_power_of_two(n):
+    return n > 0 and n & (n - 1) == 0
+
+
+def set_fft_plan_cache_size(max_size, device=None):
+    """
+    Set how many cuFFT plans are kept for reuse on a CUDA device. Tiles have a handful of distinct shapes, so a small
+    cache makes every FourierUnit call after the first reuse its plan. On CPU pocketfft keeps its own plan cache.
+    """
+    device = torch.device(device) if device is not None else None
+    if device is None or device.type != 'cuda' or not torch.cuda.is_available():
+        return
+    index = device.index if device.index is not None else torch.cuda.current_device()
+    torch.backends.cuda.cufft_plan_cache[index].max_size = max_size
+
+
 class FourierUnit(nn.Module):
 
     def __init__(self, in_channels, out_channels, groups=1, spatial_scale_factor=None, spatial_scale_mode='bilinear',
-                 spectral_pos_encoding=False, use_se=False, se_kwargs=None, ffc3d=False, fft_norm='ortho'):
+                 spectral_pos_encoding=False, use_se=False, se_kwargs=None, ffc3d=False, fft_norm='ortho',
+                 use_fft=False, fft_precision='float32'):
         # bn_layer not used
         super(FourierUnit, self).__init__()
         self.groups = groups
+        assert fft_precision in ['float32', 'half'], f"Unknown FFT precision {fft_precision}"
 
-        self.conv_layer = torch.nn.Conv2d(in_channels=in_channels + (2 if spectral_pos_encoding else 0),
-                                          out_channels=out_channels,
+        # The spectral path convolves the real and imaginary parts stacked along the channels
+        spectral_channels = 2 if use_fft else 1
+        self.conv_layer = torch.nn.Conv2d(in_channels=in_channels * spectral_channels +
+                                                      (2 if spectral_pos_encoding else 0),
+                                          out_channels=out_channels * spectral_channels,
                                           kernel_size=1, stride=1, padding=0, groups=self.groups, bias=False)
-        self.bn = torch.nn.BatchNorm2d(out_channels)
+        self.bn = torch.nn.BatchNorm2d(out_channels * spectral_channels)
         self.relu = torch.nn.ReLU(inplace=True)
 
         # squeeze and excitation block
@@ -66,6 +87,12 @@ class FourierUnit(nn.Module):
         self.spectral_pos_encoding = spectral_pos_encoding
         self.ffc3d = ffc3d
         self.fft_norm = fft_norm
+        self.use_fft = use_fft
+        self.fft_precision = fft_precision
+
+    def _use_half_fft(self, x, fft_dim):
+        # cuFFT only supports half precision transforms of power of two sizes, everything else runs in float32
+        return self.fft_precision == 'half' and x.is_cuda and all(_is_power_of_two(x.shape[d]) for d in fft_dim)
 
     def forward(self, x):
         batch = x.shape[0]
@@ -75,33 +102,38 @@ class FourierUnit(nn.Module):
             x = F.interpolate(x, scale_factor=self.spatial_scale_factor, mode=self.spatial_scale_mode,
                               align_corners=False)
 
-        r_size = x.size()
-        # (batch, c, h, w/2+1, 2)
-        fft_dim = (-3, -2, -1) if self.ffc3d else (-2, -1)
-        ffted = x
-        # ffted = torch.fft.rfftn(x, dim=fft_dim, norm=self.fft_norm)
-        # ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
-        # ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
-        # ffted = ffted.view((batch, -1,) + ffted.size()[3:])
+        if not self.use_fft:
+            output = self.relu(self.bn(self.conv_layer(x)))
+        else:
+            # (batch, c, h, w/2+1, 2)
+            fft_dim = (-3, -2, -1) if self.ffc3d else (-2, -1)
+            half_fft = self._use_half_fft(x, fft_dim)
+            dtype = x.dtype
+
+            ffted = torch.fft.rfftn(x.half() if half_fft else x.float(), dim=fft_dim, norm=self.fft_norm)
+            ffted = torch.stack((ffted.real, ffted.imag), dim=-1).to(dtype)
+            ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
+            ffted = ffted.view((batch, -1,) + ffted.size()[3:])
 
-        # if self.spectral_pos_encoding:
-        #     height, width = ffted.shape[-2:]
-        #     coords_vert = torch.linspace(0, 1, height)[None, None, :, None].expand(batch, 1, height, width).to(ffted)
-        #     coords_hor = torch.linspace(0, 1, width)[None, None, None, :].expand(batch, 1, height, width).to(ffted)
-        #     ffted = torch.cat((coords_vert, coords_hor, ffted), dim=1)
+            if self.spectral_pos_encoding:
+                height, width = ffted.shape[-2:]
+                coords_vert = torch.linspace(0, 1, height)[None, None, :, None].expand(batch, 1, height, width).to(ffted)
+                coords_hor = torch.linspace(0, 1, width)[None, None, None, :].expand(batch, 1, height, width).to(ffted)
+                ffted = torch.cat((coords_vert, coords_hor, ffted), dim=1)
 
-        # if self.use_se:
-        #     ffted = self.se(ffted)
+            if self.use_se:
+                ffted = self.se(ffted)
 
-        ffted = self.conv_layer(ffted)  # (batch, c*2, h, w/2+1)
-        output = self.relu(self.bn(ffted))
+            ffted = self.conv_layer(ffted)  # (batch, c*2, h, w/2+1)
+            ffted = self.relu(self.bn(ffted))
 
-        # ffted = ffted.view((batch, -1, 2,) + ffted.size()[2:]).permute(
-        #     0, 1, 3, 4, 2).contiguous()  # (batch,c, t, h, w/2+1, 2)
-        # ffted = torch.complex(ffted[..., 0], ffted[..., 1])
+            ffted = ffted.view((batch, -1, 2,) + ffted.size()[2:]).permute(
+                0, 1, 3, 4, 2).contiguous()  # (batch,c, t, h, w/2+1, 2)
+            ffted = ffted.half() if half_fft else ffted.float()
+            ffted = torch.complex(ffted[..., 0], ffted[..., 1])
 
-        # ifft_shape_slice = x.shape[-3:] if self.ffc3d else x.shape[-2:]
-        # output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm)
+            ifft_shape_slice = x.shape[-3:] if self.ffc3d else x.shape[-2:]
+            output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm).to(dtype)
 
         if self.spatial_scale_factor is not None:
             output = F.interpolate(output, size=orig_size, mode=self.spatial_scale_mode, align_corners=False)
@@ -129,7 +161,9 @@ class SpectralTransform(nn.Module):
         )
         self.fu = FourierUnit(out_channels // 2, out_channels // 2, groups, **fu_kwargs)
         if self.enable_lfu:
-            self.lfu = FourierUnit(out_channels // 2, out_channels // 2, groups)
+            self.lfu = FourierUnit(out_channels // 2, out_channels // 2, groups,
+                                   use_fft=fu_kwargs.get('use_fft', False),
+                                   fft_precision=fu_kwargs.get('fft_precision', 'float32'))
         self.conv2 = torch.nn.Conv2d(
             out_channels // 2, out_channels, kernel_size=1, groups=groups, bias=False)
 
@@ -0,0 +1,164 @@
+import math
+
+import torch
+import torch.nn as nn
+
+from modules.FFC import LaMa, FFC, FourierUnit, SpectralTransform, CrossAttentionBlock
+from modules.fusion import FusedFFC_BN_ACT
+from modules.spatial_transform import LearnableSpatialTransformWrapper
+
+# Layers whose output pixels depend on the whole input: they cannot run over chunks
+_GLOBAL_LAYERS = (FourierUnit, SpectralTransform, CrossAttentionBlock, LearnableSpatialTransformWrapper)
+
+
+def _receptive_field(module, units=1.):
+    """
+    :param units: input pixels of the stage per pixel of the input of module
+    :return: radius of the receptive field of module, in input pixels of the stage, and the input pixels of the stage
+    per pixel of the output of module
+    """
+    if isinstance(module, (FFC, FusedFFC_BN_ACT)):
+        # Parallel branches reading the same input
+        convs = [conv for conv in module.modules() if isinstance(conv, nn.Conv2d)]
+        radius = max(((conv.kernel_size[0] - 1) // 2) * conv.dilation[0] for conv in convs)
+        return radius * units, units * max(conv.stride[0] for conv in convs)
+    if isinstance(module, nn.ConvTranspose2d):
+        stride = module.stride[0]
+        return math.ceil((module.kernel_size[0] // 2) / stride) * units, units / stride
+    if isinstance(module, nn.Conv2d):
+        return ((module.kernel_size[0] - 1) // 2) * module.dilation[0] * units, units * module.stride[0]
+
+    radius = 0.
+    for child in module.children():
+        child_radius, units = _receptive_field(child, units)
+        radius += child_radius
+    return radius, units
+
+
+def _crop(x, ys, xs):
+    if isinstance(x, tuple):
+        return tuple(_crop(element, ys, xs) for element in x)
+    return x[..., ys, xs] if torch.is_tensor(x) else x
+
+
+def _to(x, device):
+    if isinstance(x, tuple):
+        return tuple(_to(element, device) for element in x)
+    return x.to(device) if torch.is_tensor(x) else x
+
+
+def _empty_like(x, height, width, device):
+    """Buffer with the structure of the output x of a stage (a tensor or a tuple of tensors and zeros)."""
+    if isinstance(x, tuple):
+        return tuple(_empty_like(element, height, width, device) for element in x)
+    return x.new_empty(x.shape[:-2] + (height, width), device=device) if torch.is_tensor(x) else x
+
+
+def _write(buffer, x, ys, xs):
+    if isinstance(buffer, tuple):
+        for buffer_element, element in zip(buffer, x):
+            _write(buffer_element, element, ys, xs)
+    elif torch.is_tensor(buffer):
+        buffer[..., ys, xs] = x
+
+
+class _Stage:
+
+    def __init__(self, function, modules):
+        self.function = function
+        radius, units = _receptive_field(nn.ModuleList(modules))
+        # Chunks of a down-sampling stage start on its stride, so that their outputs are on the grid of the page
+        self.align = max(1, int(units))
+        self.scale = 1 / units
+        self.halo = math.ceil(math.ceil(radius) / self.align) * self.align
+
+
+class ChunkedLaMa(nn.Module):
+    """
+    Inference-only execution of a fully convolutional LaMa (use_convolutions, no attention) that gives the same output
+    as a forward pass on the whole input, with bounded memory.
+
+    Every stage of down_sampling_layers, resnet_layers and up_sampling_layers runs over chunks of at most chunk_size x
+    chunk_size pixels of its input, each extended by a halo as wide as the receptive field of the stage, and only the
+    core of every output chunk is written into the preallocated output buffer of the stage: the activations inside a
+    stage never exceed a chunk. The buffers, including the outputs kept for the skip connections, are allocated on
+    buffer_device (the device of the input by default), e.g. the host memory while the chunks run on the GPU.
+
+    The height and width of the input must be multiples of 2 ** n_downsampling, as for LaMa.
+    """
+
+    def __init__(self, model: LaMa, chunk_size=512, buffer_device=None):
+        super(ChunkedLaMa, self).__init__()
+        if any(isinstance(module, _GLOBAL_LAYERS) for module in model.modules()):
+            raise ValueError("Only fully convolutional models can run over chunks: Fourier units, attention and "
+                             "spatial transforms see the whole input")
+        self.model = model
+        self.chunk_size = chunk_size
+        self.buffer_device = buffer_device
+
+        down = list(model.down_sampling_layers)
+        up = list(model.up_sampling_layers)
+        self.down_stages = [_Stage(lambda x, layer=down[0]: layer(model.reflect(x)), [model.reflect, down[0]])]
+        self.down_stages += [_Stage(layer, [layer]) for layer in down[1:]]
+        self.resnet_stages = [_Stage(layer, [layer]) for layer in model.resnet_layers]
+        self.up_stages = [_Stage(lambda x, skip, layer=layer: layer(self._merge(x, skip)), [layer])
+                          for layer in up[:-1]]
+        self.up_stages.append(_Stage(lambda x, skip, layer=up[-1]: model.final_act(layer(self._merge(x, skip))),
+                                     [up[-1]]))
+
+    def _merge(self, x, skip):
+        if skip is None:
+            return x
+        skip = torch.cat(skip if isinstance(skip[1], torch.Tensor) else (skip[0],), dim=1)
+        if self.model.skip_connections == 'cat':
+            return torch.cat([x, skip], dim=1)
+        return x + skip
+
+    @torch.no_grad()
+    def forward(self, input):
+        if self.model.training:
+            raise RuntimeError("ChunkedLaMa only runs in eval mode: batch norms in training mode see the whole batch")
+        device = input.device
+        buffer_device = self.buffer_device if self.buffer_device is not None else device
+        skip_connections = self.model.skip_connections != 'none'
+
+        intermediate_outputs = []
+        for stage in self.down_stages:
+            input = self._run(stage, (input,), device, buffer_device)
+            if skip_connections:
+                intermediate_outputs.append(input)
+        for stage in self.resnet_stages:
+            input = self._run(stage, (input,), device, buffer_device)
+        for stage in self.up_stages:
+            skip = intermediate_outputs.pop() if skip_connections else None
+            input = self._run(stage, (input, skip), device, buffer_device)
+        return input
+
+    def _run(self, stage, inputs, device, buffer_device):
+        """Run stage over the chunks of its inputs, which all have the size of the first one."""
+        reference = inputs[0][0] if isinstance(inputs[0], tuple) else inputs[0]
+        height, width = reference.shape[-2:]
+        core = max(stage.align, self.chunk_size // stage.align * stage.align)
+        halo = stage.halo
+
+        output = None
+        for y0 in range(0, height, core):
+            y1 = min(y0 + core, height)
+            in_y0, in_y1 = max(0, y0 - halo), min(height, y1 + halo)
+            for x0 in range(0, width, core):
+                x1 = min(x0 + core, width)
+                in_x0, in_x1 = max(0, x0 - halo), min(width, x1 + halo)
+
+                chunk = _to(_crop(inputs, slice(in_y0, in_y1), slice(in_x0, in_x1)), device)
+                out = stage.function(*chunk)
+                if output is None:
+                    output = _empty_like(out, round(height * stage.scale), round(width * stage.scale),
+                                         buffer_device)
+
+                # Keep the core of the chunk: its border saw the padding of the chunk instead of the page
+                core_ys = slice(round((y0 - in_y0) * stage.scale), round((y1 - in_y0) * stage.scale))
+                core_xs = slice(round((x0 - in_x0) * stage.scale), round((x1 - in_x0) * stage.scale))
+                _write(output, _to(_crop(out, core_ys, core_xs), buffer_device),
+                       slice(round(y0 * stage.scale), round(y1 * stage.scale)),
+                       slice(round(x0 * stage.scale), round(x1 * stage.scale)))
+        return output
@@ -0,0 +1,216 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from modules.FFC import FFC_BN_ACT, FourierUnit, SpectralTransform
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+
+def _scale_shift(norm, channels, reference):
+    """Per-channel (scale, shift) equivalent to an eval-mode BatchNorm2d, or to the identity."""
+    if isinstance(norm, nn.BatchNorm2d):
+        std = torch.sqrt(norm.running_var + norm.eps)
+        weight = norm.weight if norm.weight is not None else torch.ones_like(std)
+        bias = norm.bias if norm.bias is not None else torch.zeros_like(std)
+        scale = weight / std
+        return scale, bias - norm.running_mean * scale
+    return reference.new_ones(channels), reference.new_zeros(channels)
+
+
+def _fold_conv_bn(conv, norm):
+    """Return a copy of conv (Conv2d or ConvTranspose2d) with the following BatchNorm2d folded in."""
+    out_channels = conv.out_channels
+    scale, shift = _scale_shift(norm, out_channels, conv.weight)
+    fused = copy.deepcopy(conv)
+    if isinstance(conv, nn.ConvTranspose2d):
+        fused.weight.data = _scale_transposed(conv, scale)
+    else:
+        fused.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(scale)
+    fused.bias = nn.Parameter(bias * scale + shift)
+    return fused
+
+
+def _scale_transposed(conv, scale):
+    # ConvTranspose2d weights have shape (in_channels, out_channels // groups, k, k)
+    in_per_group = conv.in_channels // conv.groups
+    weight = conv.weight.data.view(conv.groups, in_per_group, *conv.weight.shape[1:])
+    return (weight * scale.view(conv.groups, 1, -1, 1, 1)).view_as(conv.weight)
+
+
+def _embed_kernel(weight, kernel_size):
+    """Zero-pad a 1x1 kernel to kernel_size x kernel_size, keeping the weights in the centre tap."""
+    padded = weight.new_zeros(weight.shape[0], weight.shape[1], *kernel_size)
+    padded[:, :, kernel_size[0] // 2, kernel_size[1] // 2] = weight[:, :, 0, 0]
+    return padded
+
+
+def _is_same_size(conv):
+    return all(s == 1 for s in conv.stride) and \
+        all(p == d * (k - 1) // 2 for p, d, k in zip(conv.padding, conv.dilation, conv.kernel_size))
+
+
+class FusedFFC_BN_ACT(nn.Module):
+    """
+    Inference-only replacement of FFC_BN_ACT: the batch norms are folded into the convolutions and the convolutions
+    reading the same input (local or global) are merged into a single convolution whose output channels are split
+    between the local and the global outputs.
+    """
+
+    def __init__(self, local_conv, global_conv, global_to_global, out_cl, out_cg, act_l, act_g):
+        super(FusedFFC_BN_ACT, self).__init__()
+        self.local_conv = local_conv
+        self.global_conv = global_conv
+        self.global_to_global = global_to_global
+        self.out_cl = out_cl
+        self.out_cg = out_cg
+        self.act_l = act_l
+        self.act_g = act_g
+
+    def forward(self, x):
+        x_l, x_g = x if type(x) is tuple else (x, 0)
+
+        out = self.local_conv(x_l)
+        if self.global_conv is not None:
+            out_global = self.global_conv(x_g)
+            out[:, :out_global.shape[1]] += out_global
+
+        out_l, out_g = out[:, :self.out_cl], out[:, self.out_cl:]
+        if self.global_to_global is not None:
+            out_g = out_g + self.global_to_global(x_g)
+
+        out_l = self.act_l(out_l) if self.out_cl > 0 else 0
+        out_g = self.act_g(out_g) if self.out_cg > 0 else 0
+        return out_l, out_g
+
+    @classmethod
+    def from_module(cls, module: FFC_BN_ACT):
+        """
+        :return: the fused module, or None if the configuration of module is not supported (gated or cross-attention
+        FFC, grouped convolutions or no local input channels)
+        """
+        ffc = module.ffc
+        if ffc.gated or ffc.cross_attention != 'none':
+            return None
+
+        convs = [ffc.convl2l, ffc.convl2g, ffc.convg2l]
+        convs = [conv for conv in convs if isinstance(conv, nn.Conv2d)]
+        if any(conv.groups != 1 for conv in convs):
+            return None
+        local_convs = [conv for conv in (ffc.convl2l, ffc.convl2g) if isinstance(conv, nn.Conv2d)]
+        if not local_convs:
+            return None
+
+        out_cl = ffc.convl2l.out_channels if isinstance(ffc.convl2l, nn.Conv2d) else 0
+        out_cg = ffc.convl2g.out_channels if isinstance(ffc.convl2g, nn.Conv2d) else 0
+        if (out_cl == 0 and ffc.ratio_gout != 1) or (out_cg == 0 and ffc.ratio_gout != 0):
+            return None
+        reference = local_convs[0].weight
+        scale_l, shift_l = _scale_shift(module.bn_l, out_cl, reference)
+        scale_g, shift_g = _scale_shift(module.bn_g, out_cg, reference)
+        scale = torch.cat([scale_l, scale_g])
+
+        # Local input: convl2l and convl2g share input, kernel and padding
+        template = local_convs[0]
+        weight = torch.cat([conv.weight.data for conv in local_convs]) * scale.view(-1, 1, 1, 1)
+        bias = torch.cat([shift_l, shift_g])
+        local_conv = nn.Conv2d(template.in_channels, out_cl + out_cg, kernel_size=template.kernel_size,
+                               stride=template.stride, padding=template.padding, dilation=template.dilation,
+                               bias=True, padding_mode=template.padding_mode)
+        local_conv.weight.data = weight
+        local_conv.bias.data = bias
+
+        # Global input: convg2l, merged with convg2g when the latter is a 1x1 convolution that can be embedded in
+        # the kernel of convg2l
+        global_conv, global_to_global = None, None
+        g2l = ffc.convg2l if isinstance(ffc.convg2l, nn.Conv2d) else None
+        g2g = ffc.convg2g if not isinstance(ffc.convg2g, nn.Identity) else None
+
+        if g2l is not None:
+            weights = [g2l.weight.data * scale_l.view(-1, 1, 1, 1)]
+            if isinstance(g2g, nn.Conv2d) and g2g.kernel_size == (1, 1) and g2g.stride == (1, 1) \
+                    and _is_same_size(g2l) and g2g.bias is None:
+                weights.append(_embed_kernel(g2g.weight.data, g2l.kernel_size) * scale_g.view(-1, 1, 1, 1))
+                g2g = None
+            weight = torch.cat(weights)
+            global_conv = nn.Conv2d(g2l.in_channels, weight.shape[0], kernel_size=g2l.kernel_size,
+                                    stride=g2l.stride, padding=g2l.padding, dilation=g2l.dilation,
+                                    bias=False, padding_mode=g2l.padding_mode)
+            global_conv.weight.data = weight
+
+        if g2g is not None:
+            global_to_global = copy.deepcopy(g2g)
+            last_conv = global_to_global.conv2 if isinstance(g2g, SpectralTransform) else global_to_global
+            if not isinstance(last_conv, nn.Conv2d) or last_conv.bias is not None:
+                return None
+            if isinstance(g2g, SpectralTransform) and last_conv.groups != 1:
+                return None
+            last_conv.weight.data = last_conv.weight.data * scale_g.view(-1, 1, 1, 1)
+
+        return cls(local_conv, global_conv, global_to_global, out_cl, out_cg, module.act_l, module.act_g)
+
+
+def _fold_fourier_unit(unit: FourierUnit):
+    unit.conv_layer = _fold_conv_bn(unit.conv_layer, unit.bn)
+    unit.bn = nn.Identity()
+
+
+def _fold_sequential(sequential: nn.Sequential):
+    names = list(sequential._modules.keys())
+    for name, next_name in zip(names[:-1], names[1:]):
+        layer, next_layer = sequential._modules[name], sequential._modules[next_name]
+        if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(next_layer, nn.BatchNorm2d):
+            sequential._modules[name] = _fold_conv_bn(layer, next_layer)
+            sequential._modules[next_name] = nn.Identity()
+
+
+def _fuse(module):
+    for name, child in module.named_children():
+        if isinstance(child, FFC_BN_ACT):
+            fused = FusedFFC_BN_ACT.from_module(child)
+            if fused is not None:
+                setattr(module, name, fused)
+                child = fused
+            else:
+                logger.warning(f"Keeping {name} unfused: configuration not supported")
+        elif isinstance(child, FourierUnit):
+            _fold_fourier_unit(child)
+        _fuse(child)
+
+    if isinstance(module, nn.Sequential):
+        _fold_sequential(module)
+
+
+@torch.no_grad()
+def make_inference_model(model):
+    """
+    :param model: LaMa model
+    :return: a frozen copy of model where batch norms are folded and the FFC branches are fused
+    """
+    inference_model = copy.deepcopy(model).eval()
+    _fuse(inference_model)
+    for param in inference_model.parameters():
+        param.requires_grad_(False)
+    return inference_model.eval()
+
+
+@torch.no_grad()
+def check_inference_model(model, inference_model, input_size=(2, 3, 256, 256), atol=1e-4):
+    """
+    Compare the outputs of the original and of the fused model on a random input.
+
+    :return: the maximum absolute difference between the two outputs
+    """
+    was_training = model.training
+    model.eval()
+    reference = next(model.parameters())
+    inputs = torch.rand(input_size, device=reference.device, dtype=reference.dtype)
+    difference = (model(inputs) - inference_model(inputs)).abs().max().item()
+    model.train(was_training)
+
+    if difference > atol:
+        raise ValueError(f"The inference model differs from the original one by {difference:.2e} (atol {atol:.0e})")
+    return difference
@@ -0,0 +1,82 @@
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+from modules.FFC import SpectralTransform
+from modules.fusion import make_inference_model
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+
+def _default_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('No quantized engine is available in this build of PyTorch')
+
+
+def _wrap_convolutions(module, qconfig):
+    """Replace every spatial convolution with a quantize -> int8 conv -> dequantize block."""
+    for name, child in module.named_children():
+        if isinstance(child, SpectralTransform):
+            # Convolutions in the frequency domain have a much wider dynamic range: keep them in float
+            continue
+        if type(child) is nn.Conv2d and child.padding_mode in ('zeros', 'reflect'):
+            wrapper = quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convolutions(child, qconfig)
+
+
+@torch.no_grad()
+def quantize_int8(model, calibration_batches, engine=None):
+    """
+    Post-training static int8 quantization for CPU inference.
+
+    The batch norms are folded first (see modules.fusion), then every convolution runs on int8 kernels with
+    activation ranges calibrated on calibration_batches. The element-wise operations between the convolutions (the
+    residual and skip additions, the padding and the output activation) stay in float.
+
+    :param model: LaMa model
+    :param calibration_batches: iterable of input batches with shape (batch, channels, h, w)
+    :return: the quantized copy of the model
+    """
+    engine = engine if engine else _default_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = quantization.get_default_qconfig(engine)
+
+    quantized = make_inference_model(model).cpu()
+    _wrap_convolutions(quantized, qconfig)
+    quantization.prepare(quantized, inplace=True)
+
+    num_batches = 0
+    for batch in calibration_batches:
+        quantized(batch.cpu())
+        num_batches += 1
+    if num_batches == 0:
+        raise ValueError('At least one calibration batch is needed to quantize the model')
+    logger.info(f"Calibrated the int8 model on {num_batches} batches")
+
+    quantization.convert(quantized, inplace=True)
+    return quantized.eval()
+
+
+class AutocastModel(nn.Module):
+    """Runs model under CPU autocast (bfloat16 by default) and returns float32 outputs."""
+
+    def __init__(self, model, dtype=torch.bfloat16, device_type='cpu'):
+        super(AutocastModel, self).__init__()
+        self.model = model
+        self.dtype = dtype
+        self.device_type = device_type
+
+    def forward(self, x):
+        with torch.autocast(self.device_type, dtype=self.dtype):
+            return self.model(x).float()
+
+
+def make_bf16_model(model):
+    return AutocastModel(make_inference_model(model).cpu()).eval()
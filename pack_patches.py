@@ -0,0 +1,18 @@
+import argparse
+from pathlib import Path
+
+from data.PatchStore import build_patch_store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the training patches of datasets into memory-mapped stores')
+    parser.add_argument('datasets', type=str, nargs='+', help='dataset folders, as passed to train.py --datasets')
+    parser.add_argument('--patch_size', type=int, default=384,
+                        help='size of the patches to pack (the imgs_{patch_size} folders), i.e. train_patch_size_raw')
+    parser.add_argument('--workers', type=int, default=8, help='processes decoding the patches')
+    args = parser.parse_args()
+
+    for path in args.datasets:
+        # Same lookup of the train split as make_train_dataset
+        data_path = Path(path) / 'train' if (Path(path) / 'train').exists() else Path(path)
+        dst = build_patch_store(data_path, args.patch_size, workers=args.workers)
+        print(f'Saved {dst}')
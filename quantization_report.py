@@ -0,0 +1,96 @@
+import argparse
+import csv
+import itertools
+import time
+from pathlib import Path
+
+import torch
+from torchvision import transforms
+
+from data.TestDataset import TestDataset
+from modules.quantization import quantize_int8, make_bf16_model
+from trainer.Runtime import EagerBackend
+from trainer.TileScheduler import TileScheduler
+from trainer.Validator import Validator
+
+
+def calibration_batches(dataset, num_pages, batch_size):
+    for i in range(min(num_pages, len(dataset))):
+        patches = dataset[i]['samples_patches'].squeeze(0).permute(1, 0, 2, 3)
+        yield from torch.split(patches, batch_size)
+
+
+@torch.no_grad()
+def evaluate(model, config, loader, threshold):
+    validator = Validator(apply_threshold=True, threshold=threshold)
+    scheduler = TileScheduler(model, config, device=torch.device('cpu'))
+    num_tiles = 0
+    start = time.perf_counter()
+    for item, pred in scheduler.run(loader):
+        num_tiles += item['samples_patches'].shape[3]
+        validator.compute(torch.where(pred > threshold, 1., 0.), item['gt_sample'])
+    elapsed = time.perf_counter() - start
+    return validator.get_metrics()['psnr'], elapsed / num_tiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare PSNR and CPU speed of the fp32, int8 and bf16 models')
+    parser.add_argument('model', type=str, metavar='PATH', help='path to the checkpoint file')
+    parser.add_argument('--datasets', type=str, nargs='+', required=True,
+                        help='test folders (with imgs and gt_imgs subfolders), e.g. the DIBCO years')
+    parser.add_argument('--modes', type=str, nargs='+', default=['fp32', 'int8', 'bf16'],
+                        choices=['fp32', 'int8', 'bf16'])
+    parser.add_argument('--patch_size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--calibration_pages', type=int, default=4,
+                        help='pages of the first dataset used to calibrate the int8 model')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--csv', type=str, default=None, help='write the report to this csv file')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    backend = EagerBackend(args.model, torch.device('cpu'))
+    config = backend.config
+    config['test_patch_size'] = args.patch_size
+    config['test_stride'] = args.stride
+    config['tile_batch_size'] = args.batch_size
+    threshold = config['threshold']
+
+    datasets = {Path(path).name: TestDataset(path, patch_size=args.patch_size, stride=args.stride,
+                                             transform=transforms.ToTensor(), is_validation=True)
+                for path in args.datasets}
+
+    models = {}
+    for mode in args.modes:
+        if mode == 'fp32':
+            models[mode] = backend.model
+        elif mode == 'int8':
+            calibration = next(iter(datasets.values()))
+            models[mode] = quantize_int8(backend.model,
+                                         calibration_batches(calibration, args.calibration_pages, args.batch_size))
+        elif mode == 'bf16':
+            models[mode] = make_bf16_model(backend.model)
+
+    rows = []
+    for (name, dataset), (mode, model) in itertools.product(datasets.items(), models.items()):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=0)
+        psnr, seconds_per_tile = evaluate(model, config, loader, threshold)
+        rows.append({'dataset': name, 'mode': mode, 'psnr': psnr, 'ms_per_tile': seconds_per_tile * 1000})
+
+    reference = {row['dataset']: row for row in rows if row['mode'] == 'fp32'}
+    print(f'{"dataset":>16} {"mode":>6} {"psnr":>8} {"delta":>8} {"ms/tile":>10} {"speedup":>8}')
+    for row in rows:
+        fp32 = reference.get(row['dataset'])
+        row['psnr_delta'] = row['psnr'] - fp32['psnr'] if fp32 else float('nan')
+        row['speedup'] = fp32['ms_per_tile'] / row['ms_per_tile'] if fp32 else float('nan')
+        print(f'{row["dataset"]:>16} {row["mode"]:>6} {row["psnr"]:>8.3f} {row["psnr_delta"]:>+8.3f} '
+              f'{row["ms_per_tile"]:>10.2f} {row["speedup"]:>7.2f}x')
+
+    if args.csv:
+        with open(args.csv, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=rows[0].keys())
+            writer.writeheader()
+            writer.writerows(rows)
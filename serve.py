@@ -0,0 +1,348 @@
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import torch
+from PIL import Image
+from torchvision.transforms import functional
+
+from data.utils import make_test_patches, make_test_stride, reconstruct_ground_truth, pad_to_multiple
+from trainer.Runtime import make_backend, whole_page_pixels
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+
+class _Job:
+
+    def __init__(self, patches, height, width, num_rows, whole_page=False):
+        self.patches = patches
+        self.whole_page = whole_page
+        self.height = height
+        self.width = width
+        self.num_rows = num_rows
+        self.outputs = None
+        self.done = 0
+        self.result = None
+        self.error = None
+        self.submitted = time.perf_counter()
+        self.finished = threading.Event()
+
+    @property
+    def num_tiles(self):
+        return self.patches.shape[0]
+
+
+class MicroBatcher:
+    """
+    Runs the model on a background thread. The tiles of the pages submitted by concurrent requests are packed into
+    batches of at most max_batch tiles: a batch is started as soon as it is full, or when its oldest page has waited
+    max_wait seconds. Pages of at most whole_page_pixels pixels (once padded) are binarized alone in a single forward
+    pass instead, which needs a fully convolutional model.
+    """
+
+    def __init__(self, model, config, device, max_batch, max_wait, whole_page_pixels=0):
+        self.model = model
+        self.config = config
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.whole_page_pixels = whole_page_pixels
+
+        self._incoming = queue.Queue()
+        self._pending = deque()  # (job, index of the first tile still to run)
+        self._pending_tiles = 0
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._num_requests = 0
+        self._num_errors = 0
+        self._num_batches = 0
+        self._num_tiles = 0
+        self._num_whole_pages = 0
+
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def binarize(self, page):
+        """
+        :param page: tensor with shape (1, channels, height, width)
+        :return: the prediction of the model with shape (1, 1, height, width)
+        """
+        padded = pad_to_multiple(page, 2 ** self.config['n_downsampling'])
+        if padded.shape[-2] * padded.shape[-1] <= self.whole_page_pixels:
+            job = _Job(padded, page.shape[-2], page.shape[-1], None, whole_page=True)
+        else:
+            patches, num_rows = make_test_patches(page, self.config['test_patch_size'], self.config['test_stride'],
+                                                  self.config.get('test_tiling', 'shift'))
+            job = _Job(patches[0].permute(1, 0, 2, 3), page.shape[-2], page.shape[-1], num_rows)
+        self._incoming.put(job)
+        job.finished.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = {
+                'queue_depth_pages': self._incoming.qsize() + len(self._pending),
+                'queue_depth_tiles': self._pending_tiles,
+                'requests': self._num_requests,
+                'errors': self._num_errors,
+                'batches': self._num_batches,
+                'mean_batch_size': self._num_tiles / self._num_batches if self._num_batches else 0.,
+                'whole_pages': self._num_whole_pages,
+            }
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            metrics[f'latency_{name}_ms'] = latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0.
+        return metrics
+
+    def _run(self):
+        while True:
+            self._collect()
+            self._step()
+
+    def _enqueue(self, job):
+        self._pending.append((job, 0))
+        self._pending_tiles += job.num_tiles
+
+    def _collect(self):
+        if not self._pending:
+            self._enqueue(self._incoming.get())
+
+        deadline = self._pending[0][0].submitted + self.max_wait
+        while self._pending_tiles < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                job = self._incoming.get(timeout=timeout) if timeout > 0 else self._incoming.get_nowait()
+            except queue.Empty:
+                break
+            self._enqueue(job)
+
+    @torch.no_grad()
+    def _step(self):
+        if self._pending[0][0].whole_page:
+            self._step_whole_page()
+            return
+
+        chunks, owners = [], []
+        needed = self.max_batch
+        while needed > 0 and self._pending and not self._pending[0][0].whole_page:
+            job, start = self._pending[0]
+            take = min(needed, job.num_tiles - start)
+            chunks.append(job.patches[start:start + take])
+            owners.append((job, start, take))
+            if start + take == job.num_tiles:
+                self._pending.popleft()
+            else:
+                self._pending[0] = (job, start + take)
+            needed -= take
+        batch_size = self.max_batch - needed
+        self._pending_tiles -= batch_size
+
+        try:
+            pred = self.model(torch.cat(chunks).to(self.device))
+        except Exception as e:
+            logger.exception('Inference failed')
+            self._fail({job for job, _, _ in owners}, e)
+            return
+
+        with self._lock:
+            self._num_batches += 1
+            self._num_tiles += batch_size
+
+        offset = 0
+        for job, start, take in owners:
+            if job.outputs is None:
+                job.outputs = pred.new_empty((job.num_tiles,) + pred.shape[1:])
+            job.outputs[start:start + take] = pred[offset:offset + take]
+            job.done += take
+            offset += take
+            if job.done == job.num_tiles:
+                self._finish(job)
+
+    def _step_whole_page(self):
+        job, _ = self._pending.popleft()
+        self._pending_tiles -= 1
+        try:
+            job.outputs = self.model(job.patches.to(self.device))
+        except Exception as e:
+            logger.exception('Inference failed')
+            self._fail({job}, e)
+            return
+
+        with self._lock:
+            self._num_whole_pages += 1
+        job.done = 1
+        self._finish(job)
+
+    def _finish(self, job):
+        try:
+            if job.whole_page:
+                job.result = job.outputs[:, :, :job.height, :job.width]
+            else:
+                job.result = reconstruct_ground_truth(job.outputs, (job.height, job.width), num_rows=job.num_rows,
+                                                      config=self.config)
+        except Exception as e:
+            job.error = e
+        job.outputs = None
+        with self._lock:
+            self._num_requests += 1
+            self._num_errors += job.error is not None
+            self._latencies.append(time.perf_counter() - job.submitted)
+        job.finished.set()
+
+    def _fail(self, jobs, error):
+        # Drop the remaining tiles of the failed pages
+        self._pending = deque((job, start) for job, start in self._pending if job not in jobs)
+        self._pending_tiles = sum(job.num_tiles - start for job, start in self._pending)
+        for job in jobs:
+            job.error = error
+            with self._lock:
+                self._num_requests += 1
+                self._num_errors += 1
+            job.finished.set()
+
+
+def encode_png(pred, threshold):
+    mask = torch.where(pred > threshold, 255, 0).to(torch.uint8)
+    image = Image.fromarray(mask[0, 0].cpu().numpy(), mode='L')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+class BinarizationHandler(BaseHTTPRequestHandler):
+    """
+    POST /binarize with the encoded page image as body returns the binarized page as PNG. The threshold can be set
+    with the query parameter threshold. GET /metrics returns the metrics of the batcher as JSON.
+    """
+    protocol_version = 'HTTP/1.1'
+    batcher: MicroBatcher = None
+    threshold = 0.5
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self._send(404, b'Not found\n', 'text/plain')
+            return
+        self._send(200, json.dumps(self.batcher.metrics()).encode() + b'\n', 'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/binarize':
+            self._send(404, b'Not found\n', 'text/plain')
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        try:
+            threshold = float(parse_qs(url.query).get('threshold', [self.threshold])[0])
+            page = Image.open(io.BytesIO(body)).convert('RGB')
+        except Exception as e:
+            self._send(400, f'Invalid request: {e}\n'.encode(), 'text/plain')
+            return
+
+        start = time.perf_counter()
+        try:
+            pred = self.batcher.binarize(functional.to_tensor(page).unsqueeze(0))
+        except Exception as e:
+            self._send(500, f'Binarization failed: {e}\n'.encode(), 'text/plain')
+            return
+        elapsed = time.perf_counter() - start
+        self._send(200, encode_png(pred, threshold), 'image/png',
+                   headers={'X-Processing-Time-Ms': f'{elapsed * 1000:.1f}'})
+
+    def _send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket connections have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} - {format % args}')
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the binarization model over HTTP')
+    parser.add_argument('model', type=str, metavar='PATH',
+                        help='path to the model file: a checkpoint, or a model exported by export_inference.py')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnx'])
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', type=str, default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--patch_size', type=int, default=256)
+    parser.add_argument('--overlap', action='store_true', help='use overlapping patches')
+    parser.add_argument('--halo', type=int, default=None,
+                        help='overlap the patches by twice this many pixels and keep only their core (see halo_probe.py)')
+    parser.add_argument('--blending', type=str, default='crop', choices=['crop', 'mean', 'gaussian', 'hann'])
+    parser.add_argument('--tiling', type=str, default='shift', choices=['shift', 'pad'],
+                        help='move the last patches inside the page, or pad the page past its end')
+    parser.add_argument('--whole_page', action='store_true',
+                        help='binarize every page in a single forward pass when the model is fully convolutional '
+                             '(use_convolutions) and its activations fit in --memory_budget_mb, by patches otherwise')
+    parser.add_argument('--memory_budget_mb', type=int, default=4096,
+                        help='estimated activation memory allowed for a whole page forward pass')
+    parser.add_argument('--max_batch', type=int, default=16, help='maximum number of tiles per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=10.,
+                        help='how long the first page of a batch waits for tiles of other requests')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    device = torch.device('cuda' if torch.cuda.is_available() and args.backend != 'onnx' else 'cpu')
+    model = make_backend(args.backend, args.model, device)
+    model.eval()
+    config = model.config
+    config['test_patch_size'] = args.patch_size
+    config['test_stride'] = make_test_stride(args.patch_size, args.overlap, args.halo)
+    config['test_blending'] = 'crop' if args.halo is not None else args.blending
+    config['test_tiling'] = args.tiling
+
+    # Warm up the model on a full batch, so that the first request does not pay for it
+    with torch.no_grad():
+        model(torch.ones((args.max_batch, 3, args.patch_size, args.patch_size), device=device))
+
+    max_pixels = whole_page_pixels(config, args.memory_budget_mb * 1024 ** 2) if args.whole_page else 0
+    if args.whole_page and not max_pixels:
+        logger.warning('The model is not fully convolutional: binarizing every page by patches')
+    BinarizationHandler.batcher = MicroBatcher(model, config, device, args.max_batch, args.max_wait_ms / 1000,
+                                               whole_page_pixels=max_pixels)
+    BinarizationHandler.threshold = config['threshold']
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, BinarizationHandler)
+        logger.info(f'Listening on {args.socket}')
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), BinarizationHandler)
+        logger.info(f'Listening on http://{args.host}:{args.port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -13,7 +13,9 @@ import wandb
 import yaml
 from torchvision.transforms import functional
 
+from data.utils import make_test_stride
 from trainer.LaMaTrainer import LaMaTrainingModule, set_seed
+from trainer.ValidationScheduler import ValidationScheduler
 from trainer.Validator import Validator
 from utils.WandbLog import WandbLog
 from utils.htr_logging import get_logger, DEBUG
@@ -52,6 +54,13 @@ def train(config_args, config):
     threshold = config['threshold'] if config['threshold'] else 0.5
     train_validator = Validator(apply_threshold=config['apply_threshold_to_train'], threshold=threshold)
 
+    validation_scheduler = ValidationScheduler(trainer, every_epochs=config.get('eval_every_epochs', 1),
+                                               every_steps=config.get('eval_every_steps', 0),
+                                               subset_tiles=config.get('eval_subset_tiles', 0),
+                                               confidence=config.get('eval_subset_confidence', 0.95),
+                                               seed=config.get('seed', 0) or 0)
+    steps = 0
+
     try:
         start_time = time.time()
         patience = config['patience']
@@ -76,9 +85,14 @@ def train(config_args, config):
                 start_epoch_time = time.time()
 
                 for batch_idx, (train_in, train_out) in enumerate(trainer.train_data_loader):
+                    steps += 1
                     data_times.append(time.time() - start_data_time)
                     start_train_time = time.time()
                     inputs, outputs = train_in.to(device), train_out.to(device)
+                    if trainer.batch_transform is not None:
+                        inputs, outputs = trainer.batch_transform(inputs, outputs)
+                    if trainer.batch_merge is not None:
+                        inputs, outputs = trainer.batch_merge(inputs, outputs)
 
                     trainer.optimizer.zero_grad()
                     predictions = trainer.model(inputs)
@@ -148,114 +162,127 @@ def train(config_args, config):
 
                 train_validator.reset()
 
-                with torch.no_grad():
-                    start_test_time = time.time()
-                    test_metrics, test_loss, _ = trainer.test()
-
-                    if trainer.ema_rate:
-                        trainer.load_ema()
-                        ema_valid_metrics, ema_valid_loss, _ = trainer.validation()
-                        ema_test_metrics, ema_test_loss, _ = trainer.test()
-                        trainer.load_model()
-
-                        wandb_logs[f'test/avg_ema_{trainer.ema_rate}_psnr'] = ema_test_metrics['psnr']
-                        wandb_logs[f'test/avg_ema_{trainer.ema_rate}_loss'] = ema_test_loss
-
-                        if ema_test_metrics['psnr'] > trainer.ema_best_psnr_test:
-                            trainer.ema_best_psnr_test = ema_test_metrics['psnr']
-                            wandb_logs[f'test/best_ema_{trainer.ema_rate}_psnr'] = trainer.ema_best_psnr_test
-                            trainer.save_checkpoints(filename=config_args.experiment_name + f'_best_psnr_test')
-
-                    wandb_logs['test/time'] = time.time() - start_test_time
-                    wandb_logs['test/avg_loss'] = test_loss
-                    wandb_logs['test/avg_psnr'] = test_metrics['psnr']
-
-                    if test_metrics['psnr'] > trainer.best_psnr_test:
-                        trainer.best_psnr_test = test_metrics['psnr']
-                        wandb_logs['test/best_psnr'] = trainer.best_psnr_test
-                        if not trainer.ema_rate:
-                            trainer.save_checkpoints(filename=config_args.experiment_name + '_best_psnr_test')
-
-                    aux_metrics = trainer.aux_test()
-                    for key, value in aux_metrics.items():
-                        wandb_logs[f'aux/{key}'] = value[0]['psnr']
-
-                    # name_image, (test_img, pred_img, gt_test_img) = list(images.items())[0]
-                    # target_height = 512
-                    # test_img = test_img.resize((target_height, int(target_height * test_img.height / test_img.width)))
-                    # pred_img = pred_img.resize((target_height, int(target_height * pred_img.height / pred_img.width)))
-                    # gt_test_img = gt_test_img.resize(
-                    #     (target_height, int(target_height * gt_test_img.height / gt_test_img.width)))
-                    # wandb_logs['test/results'] = [wandb.Image(test_img, caption=f"Sample: {name_image}"),
-                    #                               wandb.Image(pred_img, caption=f"Predicted Sample: {name_image}"),
-                    #                               wandb.Image(gt_test_img,
-                    #                                           caption=f"Ground Truth Sample: {name_image}")]
-
-                    ##########################################
-                    #               Validation               #
-                    ##########################################
-
-                    start_valid_time = time.time()
-                    valid_metrics, valid_loss, _ = trainer.validation()
-
-                    wandb_logs['valid/time'] = time.time() - start_valid_time
-                    wandb_logs['valid/avg_loss'] = valid_loss
-                    wandb_logs['valid/avg_psnr'] = valid_metrics['psnr']
+                evaluate, schedule_logs = validation_scheduler.should_evaluate(epoch, steps)
+                wandb_logs.update(schedule_logs)
+                if not evaluate:
+                    patience -= 1
                     wandb_logs['valid/patience'] = patience
+                    logger.info(f"Skipping validation and test at epoch {epoch}")
+                else:
+                    with torch.no_grad():
+                        start_test_time = time.time()
+                        test_metrics, test_loss, _ = trainer.test()
 
-                    trainer.psnr_list.append(valid_metrics['psnr'])
-                    psnr_running_mean = sum(trainer.psnr_list[-3:]) / len(trainer.psnr_list[-3:])
-                    reset_patience = False
-                    if valid_metrics['psnr'] > trainer.best_psnr:
-                        trainer.best_psnr = valid_metrics['psnr']
-                        wandb_logs['test/best_psnr_wrt_valid'] = wandb_logs['test/avg_psnr']
-                        reset_patience = True
-                    if psnr_running_mean > trainer.best_psnr_running_mean:
-                        trainer.best_psnr_running_mean = psnr_running_mean
-
-                    wandb_logs['Best PSNR Running Mean'] = trainer.best_psnr_running_mean
-                    wandb_logs['Psnr Running Mean'] = psnr_running_mean
-                    wandb_logs['Best PSNR'] = trainer.best_psnr
-
-                    if trainer.ema_rate:
+                        if trainer.ema_rate:
+                            trainer.load_ema()
+                            ema_valid_metrics, ema_valid_loss, _ = trainer.validation()
+                            ema_test_metrics, ema_test_loss, _ = trainer.test()
+                            trainer.load_model()
+
+                            wandb_logs[f'test/avg_ema_{trainer.ema_rate}_psnr'] = ema_test_metrics['psnr']
+                            wandb_logs[f'test/avg_ema_{trainer.ema_rate}_loss'] = ema_test_loss
+
+                            if ema_test_metrics['psnr'] > trainer.ema_best_psnr_test:
+                                trainer.ema_best_psnr_test = ema_test_metrics['psnr']
+                                wandb_logs[f'test/best_ema_{trainer.ema_rate}_psnr'] = trainer.ema_best_psnr_test
+                                trainer.save_checkpoints(filename=config_args.experiment_name + f'_best_psnr_test')
+
+                        wandb_logs['test/time'] = time.time() - start_test_time
+                        wandb_logs['test/avg_loss'] = test_loss
+                        wandb_logs['test/avg_psnr'] = test_metrics['psnr']
+                        for key in ('skip_ratio', 'skipped_ink', 'skip_psnr_cost'):
+                            if key in test_metrics:
+                                wandb_logs[f'test/{key}'] = test_metrics[key]
+
+                        if test_metrics['psnr'] > trainer.best_psnr_test:
+                            trainer.best_psnr_test = test_metrics['psnr']
+                            wandb_logs['test/best_psnr'] = trainer.best_psnr_test
+                            if not trainer.ema_rate:
+                                trainer.save_checkpoints(filename=config_args.experiment_name + '_best_psnr_test')
+
+                        aux_metrics = trainer.aux_test()
+                        for key, value in aux_metrics.items():
+                            wandb_logs[f'aux/{key}'] = value[0]['psnr']
+
+                        # name_image, (test_img, pred_img, gt_test_img) = list(images.items())[0]
+                        # target_height = 512
+                        # test_img = test_img.resize((target_height, int(target_height * test_img.height / test_img.width)))
+                        # pred_img = pred_img.resize((target_height, int(target_height * pred_img.height / pred_img.width)))
+                        # gt_test_img = gt_test_img.resize(
+                        #     (target_height, int(target_height * gt_test_img.height / gt_test_img.width)))
+                        # wandb_logs['test/results'] = [wandb.Image(test_img, caption=f"Sample: {name_image}"),
+                        #                               wandb.Image(pred_img, caption=f"Predicted Sample: {name_image}"),
+                        #                               wandb.Image(gt_test_img,
+                        #                                           caption=f"Ground Truth Sample: {name_image}")]
+
+                        ##########################################
+                        #               Validation               #
+                        ##########################################
+
+                        start_valid_time = time.time()
+                        valid_metrics, valid_loss, _ = trainer.validation()
+
+                        wandb_logs['valid/time'] = time.time() - start_valid_time
+                        wandb_logs['valid/avg_loss'] = valid_loss
+                        wandb_logs['valid/avg_psnr'] = valid_metrics['psnr']
+                        for key in ('skip_ratio', 'skipped_ink', 'skip_psnr_cost'):
+                            if key in valid_metrics:
+                                wandb_logs[f'valid/{key}'] = valid_metrics[key]
+                        wandb_logs['valid/patience'] = patience
+
+                        trainer.psnr_list.append(valid_metrics['psnr'])
+                        psnr_running_mean = sum(trainer.psnr_list[-3:]) / len(trainer.psnr_list[-3:])
                         reset_patience = False
-                        if ema_valid_metrics['psnr'] > trainer.ema_best_psnr:
-                            trainer.ema_best_psnr = ema_valid_metrics['psnr']
-                            wandb_logs['test/best_ema_psnr_wrt_ema_valid'] = wandb_logs[
-                                f'test/avg_ema_{trainer.ema_rate}_psnr']
-                            wandb_logs['Best EMA PSNR'] = trainer.ema_best_psnr
-
-                        trainer.ema_psnr_list.append(ema_valid_metrics['psnr'])
-                        ema_psnr_running_mean = sum(trainer.ema_psnr_list[-3:]) / len(trainer.ema_psnr_list[-3:])
-                        wandb_logs['Psnr EMA Running Mean'] = ema_psnr_running_mean
-                        if ema_psnr_running_mean > trainer.ema_best_psnr_running_mean:
-                            trainer.ema_best_psnr_running_mean = ema_psnr_running_mean
+                        if valid_metrics['psnr'] > trainer.best_psnr:
+                            trainer.best_psnr = valid_metrics['psnr']
+                            wandb_logs['test/best_psnr_wrt_valid'] = wandb_logs['test/avg_psnr']
                             reset_patience = True
-                        wandb_logs['Best EMA PSNR Running Mean'] = trainer.ema_best_psnr_running_mean
+                        if psnr_running_mean > trainer.best_psnr_running_mean:
+                            trainer.best_psnr_running_mean = psnr_running_mean
 
-                    if reset_patience:
-                        patience = config['patience']
+                        wandb_logs['Best PSNR Running Mean'] = trainer.best_psnr_running_mean
+                        wandb_logs['Psnr Running Mean'] = psnr_running_mean
+                        wandb_logs['Best PSNR'] = trainer.best_psnr
 
-                        wandb_logs['test/best_psnr_running_mean_wrt_valid'] = wandb_logs['test/avg_psnr']
                         if trainer.ema_rate:
-                            wandb_logs['test/best_ema_psnr_running_mean_wrt_ema_valid'] = wandb_logs[
-                                f'test/avg_ema_{trainer.ema_rate}_psnr']
-
-                        logger.info(f"Saving best model (valid) with valid_PSNR: {trainer.best_psnr:.02f}" +
-                                    f" and test_PSNR: {trainer.best_psnr_running_mean:.02f}...")
-
-                        if epoch > 10:
-                            trainer.save_checkpoints(
-                                filename=config_args.experiment_name + f'{trainer.best_psnr:.02f}_best_psnr'
-                            )
-
-                        # Save images
-                        # names = images.keys()
-                        # predicted_images = [item[1] for item in list(images.values())]
-                        # store_images(parent_directory='results/training', directory=config_args.experiment_name,
-                        #              names=names, images=predicted_images)
-                    else:
-                        patience -= 1
+                            reset_patience = False
+                            if ema_valid_metrics['psnr'] > trainer.ema_best_psnr:
+                                trainer.ema_best_psnr = ema_valid_metrics['psnr']
+                                wandb_logs['test/best_ema_psnr_wrt_ema_valid'] = wandb_logs[
+                                    f'test/avg_ema_{trainer.ema_rate}_psnr']
+                                wandb_logs['Best EMA PSNR'] = trainer.ema_best_psnr
+
+                            trainer.ema_psnr_list.append(ema_valid_metrics['psnr'])
+                            ema_psnr_running_mean = sum(trainer.ema_psnr_list[-3:]) / len(trainer.ema_psnr_list[-3:])
+                            wandb_logs['Psnr EMA Running Mean'] = ema_psnr_running_mean
+                            if ema_psnr_running_mean > trainer.ema_best_psnr_running_mean:
+                                trainer.ema_best_psnr_running_mean = ema_psnr_running_mean
+                                reset_patience = True
+                            wandb_logs['Best EMA PSNR Running Mean'] = trainer.ema_best_psnr_running_mean
+
+                        if reset_patience:
+                            patience = config['patience']
+
+                            wandb_logs['test/best_psnr_running_mean_wrt_valid'] = wandb_logs['test/avg_psnr']
+                            if trainer.ema_rate:
+                                wandb_logs['test/best_ema_psnr_running_mean_wrt_ema_valid'] = wandb_logs[
+                                    f'test/avg_ema_{trainer.ema_rate}_psnr']
+
+                            logger.info(f"Saving best model (valid) with valid_PSNR: {trainer.best_psnr:.02f}" +
+                                        f" and test_PSNR: {trainer.best_psnr_running_mean:.02f}...")
+
+                            if epoch > 10:
+                                trainer.save_checkpoints(
+                                    filename=config_args.experiment_name + f'{trainer.best_psnr:.02f}_best_psnr'
+                                )
+
+                            # Save images
+                            # names = images.keys()
+                            # predicted_images = [item[1] for item in list(images.values())]
+                            # store_images(parent_directory='results/training', directory=config_args.experiment_name,
+                            #              names=names, images=predicted_images)
+                        else:
+                            patience -= 1
 
                 ##########################################
                 #                 Generic                #
@@ -264,16 +291,22 @@ def train(config_args, config):
                 wandb_logs['epoch'] = trainer.epoch
                 wandb_logs['epoch_time'] = time.time() - start_epoch_time
 
-                stdout = f"Validation Loss: {valid_loss:.4f} - PSNR: {valid_metrics['psnr']:.4f}"
-                stdout += f" Best Loss: {trainer.best_psnr:.3f}"
-                logger.info(stdout)
+                if evaluate:
+                    stdout = f"Validation Loss: {valid_loss:.4f} - PSNR: {valid_metrics['psnr']:.4f}"
+                    stdout += f" Best Loss: {trainer.best_psnr:.3f}"
+                    if 'skip_ratio' in valid_metrics:
+                        stdout += f" - Skipped tiles: {valid_metrics['skip_ratio']:.1%}"
+                        stdout += f" (PSNR cost at most {valid_metrics['skip_psnr_cost']:.4f})"
+                    logger.info(stdout)
 
-                stdout = f"Test Loss: {test_loss:.4f} - PSNR: {test_metrics['psnr']:.4f}"
-                stdout += f" Best Loss: {trainer.best_psnr:.3f}"
-                logger.info(stdout)
+                    stdout = f"Test Loss: {test_loss:.4f} - PSNR: {test_metrics['psnr']:.4f}"
+                    stdout += f" Best Loss: {trainer.best_psnr:.3f}"
+                    logger.info(stdout)
 
                 if config['lr_scheduler'] == 'plateau':
-                    trainer.lr_scheduler.step(metrics=psnr_running_mean)
+                    # The plateau scheduler only sees the epochs with a validation
+                    if evaluate:
+                        trainer.lr_scheduler.step(metrics=psnr_running_mean)
                 else:
                     trainer.lr_scheduler.step()
 
@@ -317,7 +350,23 @@ if __name__ == '__main__':
     parser.add_argument('--n_downsampling', type=int, default=3)
     parser.add_argument('--num_workers', type=int, default=4)
     parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--tile_batch_size', type=int, default=None,
+                        help='patches per forward pass in validation and test (default: --batch_size)')
+    parser.add_argument('--eval_batch_tiles', type=int, default=64,
+                        help='load validation and test pages in batches of about this many patches (0: one page)')
+    parser.add_argument('--eval_every_epochs', type=int, default=1, help='run validation and test every N epochs')
+    parser.add_argument('--eval_every_steps', type=int, default=0,
+                        help='run validation and test at the end of the epochs after at least N training steps')
+    parser.add_argument('--eval_subset_tiles', type=int, default=0,
+                        help='first evaluate N fixed random validation tiles, and only run the full validation and '
+                             'test when the estimate may beat the best one (0: always run them)')
+    parser.add_argument('--eval_subset_confidence', type=float, default=0.95,
+                        help='confidence level of the interval of the subset estimate')
     parser.add_argument('--operation', type=str, default='ffc', choices=['ffc', 'conv'])
+    parser.add_argument('--fft', type=str, default='false', choices=['true', 'false'])
+    parser.add_argument('--fft_precision', type=str, default='float32', choices=['float32', 'half'])
+    parser.add_argument('--fft_plan_cache_size', type=int, default=16,
+                        help='cuFFT plans kept for reuse on the GPU: one per distinct tile shape')
     parser.add_argument('--skip', type=str, default='none', choices=['none', 'add', 'cat'])
     parser.add_argument('--resume', type=str, default='none')
     parser.add_argument('--wandb_dir', type=str, default='/tmp')
@@ -336,9 +385,32 @@ if __name__ == '__main__':
     parser.add_argument('--lr_scheduler_kwargs', type=eval, default={})
     parser.add_argument('--ema_rate', type=float, default=-1)
     parser.add_argument('--load_data', type=str, default='true', choices=['true', 'false'])
+    parser.add_argument('--image_cache_gb', type=float, default=None,
+                        help='shared memory budget of the decoded images of the datasets loaded with --load_data '
+                             '(default: half of /dev/shm)')
+    parser.add_argument('--use_patch_store', type=str, default='false', choices=['true', 'false'],
+                        help='read the training patches from the stores built by pack_patches.py')
+    parser.add_argument('--sample_from_pages', type=str, default='false', choices=['true', 'false'],
+                        help='crop the training patches from the full pages instead of the pre-cut patch folders')
+    parser.add_argument('--ink_weight', type=float, default=0.,
+                        help='with --sample_from_pages, how much the crops are drawn towards the ink (0 to 1)')
     parser.add_argument('--train_transform_variant', type=str, default='none', choices=['threshold_mask', 'latin', 'none'])
     parser.add_argument('--merge_image', type=str, default='true', choices=['true', 'false'])
+    parser.add_argument('--merge_probability', type=float, default=1.,
+                        help='probability that a training sample is merged with another sample of its batch')
+    parser.add_argument('--batch_augmentation', type=str, default='false', choices=['true', 'false'],
+                        help='run the training augmentations on the device on whole batches')
     parser.add_argument('--overlap_test', type=str, default='false', choices=['true', 'false'])
+    parser.add_argument('--test_halo', type=int, default=None,
+                        help='overlap the test patches by twice this many pixels and keep only their core')
+    parser.add_argument('--test_blending', type=str, default='crop', choices=['crop', 'mean', 'gaussian', 'hann'])
+    parser.add_argument('--test_tiling', type=str, default='shift', choices=['shift', 'pad'],
+                        help='move the last test patches inside the page, or pad the page past its end')
+    parser.add_argument('--blank_tile_std', type=float, default=0.,
+                        help='skip the validation and test patches whose 8x8 blocks all have a standard deviation at '
+                             'most this and fill them with white (0 to run every patch)')
+    parser.add_argument('--blank_tile_min_mean', type=float, default=0.5,
+                        help='minimum brightness of every 8x8 block of a skipped patch')
     parser.add_argument('--threshold', type=float, default=0.5)
     parser.add_argument('--datasets', type=str, nargs='+', required=True)
     parser.add_argument('--validation_dataset', type=str, required=False)
@@ -387,6 +459,9 @@ if __name__ == '__main__':
 
     train_config['experiment_name'] = args.experiment_name
     train_config['use_convolutions'] = args.operation == 'conv'
+    train_config['resnet_conv_kwargs']['use_fft'] = args.fft == 'true'
+    train_config['resnet_conv_kwargs']['fft_precision'] = args.fft_precision
+    train_config['fft_plan_cache_size'] = args.fft_plan_cache_size
     train_config['skip_connections'] = args.skip
     train_config['unet_layers'] = args.unet_layers
     train_config['n_blocks'] = args.n_blocks
@@ -418,6 +493,7 @@ if __name__ == '__main__':
     train_config['aux_data_path'] = args.aux_data_path
     assert len(train_config['test_data_path']) > 0, f"Test dataset {args.test_dataset} not found in {args.datasets}"
     train_config['merge_image'] = args.merge_image == 'true'
+    train_config['merge_probability'] = args.merge_probability
 
     if args.attention_num_heads and args.attention_channel_scale_factor:
         train_config['cross_attention_args'] = {
@@ -437,6 +513,13 @@ if __name__ == '__main__':
     train_config['train_batch_size'] = train_config['train_kwargs']['batch_size']
     train_config['valid_batch_size'] = train_config['valid_kwargs']['batch_size']
     train_config['test_batch_size'] = train_config['test_kwargs']['batch_size']
+    if args.tile_batch_size:
+        train_config['tile_batch_size'] = args.tile_batch_size
+    train_config['eval_batch_tiles'] = args.eval_batch_tiles
+    train_config['eval_every_epochs'] = args.eval_every_epochs
+    train_config['eval_every_steps'] = args.eval_every_steps
+    train_config['eval_subset_tiles'] = args.eval_subset_tiles
+    train_config['eval_subset_confidence'] = args.eval_subset_confidence
 
     train_config['num_epochs'] = args.epochs
     train_config['patience'] = args.patience
@@ -447,6 +530,11 @@ if __name__ == '__main__':
     train_config['apply_threshold_to_test'] = args.apply_threshold_to
     train_config['threshold'] = args.threshold
     train_config['load_data'] = args.load_data == 'true'
+    train_config['image_cache_gb'] = args.image_cache_gb
+    train_config['use_patch_store'] = args.use_patch_store == 'true'
+    train_config['sample_from_pages'] = args.sample_from_pages == 'true'
+    train_config['ink_weight'] = args.ink_weight
+    train_config['batch_augmentation'] = args.batch_augmentation == 'true'
 
     train_config['apply_threshold_to_train'] = True
     train_config['apply_threshold_to_valid'] = True
@@ -461,10 +549,11 @@ if __name__ == '__main__':
         train_config['apply_threshold_to_train'] = False
         train_config['apply_threshold_to_valid'] = False
 
-    if args.overlap_test == 'true':
-        train_config['test_stride'] = args.patch_size // 2
-    else:
-        train_config['test_stride'] = args.patch_size
+    train_config['test_stride'] = make_test_stride(args.patch_size, args.overlap_test == 'true', args.test_halo)
+    train_config['test_blending'] = 'crop' if args.test_halo is not None else args.test_blending
+    train_config['test_tiling'] = args.test_tiling
+    train_config['blank_tile_std'] = args.blank_tile_std
+    train_config['blank_tile_min_mean'] = args.blank_tile_min_mean
 
     train_config['train_patch_size'] = args.patch_size
     train_config['train_patch_size_raw'] = args.patch_size_raw if args.patch_size_raw else args.patch_size + 128
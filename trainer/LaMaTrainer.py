@@ -12,14 +12,18 @@ import torch.utils.data
 from torchvision.transforms import functional
 from typing_extensions import TypedDict
 
+from data.BatchTransforms import make_batch_transform, BatchMerge
+from data.ImageCache import set_image_cache_size
 from data.dataloaders import make_train_dataloader, make_valid_dataloader, make_test_dataloader
 from data.datasets import make_train_dataset, make_val_dataset, make_test_dataset
-from data.utils import reconstruct_ground_truth
-from modules.FFC import LaMa
+from data.utils import blank_tiles_mask
+from modules.FFC import set_fft_plan_cache_size
 from trainer.EMA import params_to_model_state_dict, model_state_dict_to_params
 from trainer.Losses import make_criterion
 from trainer.Optimizers import make_optimizer
+from trainer.Runtime import make_model, Binarizer
 from trainer.Schedulers import make_lr_scheduler
+from trainer.TileScheduler import TileScheduler
 from trainer.Validator import Validator
 from utils.htr_logging import get_logger
 
@@ -60,6 +64,9 @@ class LaMaTrainingModule:
             self.config.update(checkpoint_config)
             config = self.config
 
+        if config.get('image_cache_gb'):
+            set_image_cache_size(int(config['image_cache_gb'] * 1024 ** 3))
+
         self.training_only_with_patch_square = False
         if make_loaders:
             if len(config['train_data_path']) == 1 and 'patch_square' in config['train_data_path'][0]:
@@ -81,15 +88,15 @@ class LaMaTrainingModule:
             self.valid_data_loader = make_valid_dataloader(self.valid_dataset, config)
             self.test_data_loader = make_test_dataloader(self.test_dataset, config)
 
-        self.model = LaMa(input_nc=config['input_channels'], output_nc=config['output_channels'],
-                          n_downsampling=config['n_downsampling'], init_conv_kwargs=config['init_conv_kwargs'],
-                          downsample_conv_kwargs=config['down_sample_conv_kwargs'],
-                          resnet_conv_kwargs=config['resnet_conv_kwargs'], n_blocks=config['n_blocks'],
-                          use_convolutions=config['use_convolutions'],
-                          cross_attention=config['cross_attention'],
-                          cross_attention_args=config['cross_attention_args'],
-                          skip_connections=config['skip_connections'],
-                          unet_layers=config['unet_layers'], )
+        # Augmentations applied to the training batches on the device, instead of per sample in the loader workers
+        self.batch_transform = make_batch_transform(config) if config.get('batch_augmentation', False) else None
+        # merge_image: samples of the same batch are overlaid on the device, instead of loading a second sample. Its
+        # seed differs from the one of batch_transform, so the two do not draw the same random stream
+        merge_seed = config['seed'] + 1 if config.get('seed', None) is not None else None
+        self.batch_merge = BatchMerge(config.get('merge_probability', 1.), seed=merge_seed) \
+            if config.get('merge_image', False) else None
+
+        self.model = make_model(config)
 
         config['num_params'] = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
         # Training
@@ -106,6 +113,8 @@ class LaMaTrainingModule:
             # self.load_random_settings(self.checkpoint)
 
         self.model = self.model.to(self.device)
+        if 'fft_plan_cache_size' in config:
+            set_fft_plan_cache_size(config['fft_plan_cache_size'], self.device)
         self.ema_rate = config['ema_rate']
         if self.ema_rate is not None:
             self.ema_parameters = copy.deepcopy(list(self.model.parameters()))
@@ -229,30 +238,25 @@ class LaMaTrainingModule:
             raise Exception("This function has to be called after load_ema")
 
     def eval_item(self, item, validator, threshold):
-        image_name = item['image_name'][0]
-        sample = item['sample']
-        num_rows = item['num_rows'].item()
-        samples_patches = item['samples_patches']
-        gt_sample = item['gt_sample']
-
-        samples_patches = samples_patches.squeeze(0)
-        test = samples_patches.to(self.device)
-        gt_test = gt_sample.to(self.device)
-
-        test = test.squeeze(0)
-        test = test.permute(1, 0, 2, 3)
+        return next(self.eval_items([item], validator, threshold))
 
-        pred = []
-        for chunk in torch.split(test, self.config['train_batch_size']):
-            pred.append(self.model(chunk))
-        pred = torch.cat(pred)
+    def eval_items(self, items, validator, threshold):
+        scheduler = TileScheduler(self.model, self.config, device=self.device)
+        for item, pred in scheduler.run(items):
+            yield self._eval_prediction(item, pred, validator, threshold)
 
-        pred = reconstruct_ground_truth(pred, gt_test, num_rows=num_rows, config=self.config)
+    def _eval_prediction(self, item, pred, validator, threshold):
+        image_name = item['image_name'][0]
+        sample = item['sample']
+        gt_test = item['gt_sample'].to(self.device)
 
         loss = self.criterion(pred, gt_test)
 
         pred = torch.where(pred > threshold, 1., 0.)
         validator.compute(pred, gt_test)
+        if 'blank_tiles' in item:
+            skipped = blank_tiles_mask(item['blank_tiles'], gt_test, item['num_rows'].item(), self.config)
+            validator.compute_skipped(pred, gt_test, item['blank_tiles'], skipped.to(pred.device))
 
         test = sample.squeeze(0).detach()
         pred = pred.squeeze(0).detach()
@@ -273,14 +277,14 @@ class LaMaTrainingModule:
         images = {}
         validator = Validator(apply_threshold=self.config['apply_threshold_to_test'], threshold=threshold)
 
-        for i, item in enumerate(self.test_data_loader):
-            test_loss_item, validator, images_item = self.eval_item(item, validator, threshold)
+        for i, (test_loss_item, validator, images_item) in enumerate(
+                self.eval_items(self.test_data_loader, validator, threshold)):
             test_loss += test_loss_item
             images.update(images_item)
             if i == 2:
                 break
 
-        avg_loss = test_loss / len(self.test_data_loader)
+        avg_loss = test_loss / len(self.test_data_loader.dataset)
         avg_metrics = validator.get_metrics()
 
         self.model.train()
@@ -293,10 +297,19 @@ class LaMaTrainingModule:
 
         validator = Validator(apply_threshold=self.config['apply_threshold_to_test'], threshold=threshold)
 
-        for i, item in enumerate(self.test_data_loader):
-            _, _, images_item = self.eval_item(item, validator, threshold)
+        for _, _, images_item in self.eval_items(self.test_data_loader, validator, threshold):
             yield images_item
 
+    @torch.no_grad()
+    def stream_binarize(self, stream, writer, threshold):
+        """
+        Binarize a page one row of patches at a time.
+
+        :param stream: TileRowStream of the page
+        :param writer: PngStreamWriter receiving the finished rows of the binarized page
+        """
+        Binarizer(self.model, self.config, self.device).stream_binarize(stream, writer, threshold)
+
     @torch.no_grad()
     def validation(self):
         self.model.eval()
@@ -308,12 +321,11 @@ class LaMaTrainingModule:
         images = {}
         validator = Validator(apply_threshold=self.config['apply_threshold_to_valid'], threshold=threshold)
 
-        for item in self.valid_data_loader:
-            valid_loss_item, validator, images_item = self.eval_item(item, validator, threshold)
+        for valid_loss_item, validator, images_item in self.eval_items(self.valid_data_loader, validator, threshold):
             valid_loss += valid_loss_item
             images.update(images_item)
 
-        avg_loss = valid_loss / len(self.valid_data_loader)
+        avg_loss = valid_loss / len(self.valid_data_loader.dataset)
         avg_metrics = validator.get_metrics()
 
         self.model.train()
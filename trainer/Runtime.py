@@ -0,0 +1,212 @@
+import json
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from data.utils import RowReconstructor
+from modules.FFC import LaMa
+from trainer.TileScheduler import TileScheduler
+
+
+def make_model(config: dict):
+    return LaMa(input_nc=config['input_channels'], output_nc=config['output_channels'],
+                n_downsampling=config['n_downsampling'], init_conv_kwargs=config['init_conv_kwargs'],
+                downsample_conv_kwargs=config['down_sample_conv_kwargs'],
+                resnet_conv_kwargs=config['resnet_conv_kwargs'], n_blocks=config['n_blocks'],
+                use_convolutions=config['use_convolutions'],
+                cross_attention=config['cross_attention'],
+                cross_attention_args=config['cross_attention_args'],
+                skip_connections=config['skip_connections'],
+                unet_layers=config['unet_layers'], )
+
+
+def supports_whole_page(config: dict):
+    """
+    Whether the model can binarize a whole page in one forward pass: with plain convolutions instead of Fourier units
+    and without attention, LaMa is fully convolutional and only needs the page padded to a multiple of
+    2 ** n_downsampling.
+    """
+    return bool(config.get('use_convolutions', False)) and config.get('cross_attention', 'none') == 'none'
+
+
+def activation_bytes_per_pixel(config: dict, bytes_per_value=4, chunked=False):
+    """
+    Estimate of the peak activation memory of an inference pass of LaMa, per pixel of the (padded) input page.
+
+    Every stage keeps about three tensors alive at once (its input, the output of its convolution and of its
+    normalization), and with skip connections the outputs of the down-sampling stages are kept until the up-sampling.
+    With chunked execution (ChunkedLaMa) only the input and output buffers of the running stage and the skip
+    connections are whole: the activations inside a stage are bounded by the chunk size and not counted.
+    """
+    ngf, max_features = config.get('ngf', 64), config.get('max_features', 1024)
+    n_downsampling = config['n_downsampling']
+    skip = config.get('skip_connections', 'none') != 'none'
+    cat = config.get('skip_connections', 'none') == 'cat'
+
+    # (channels, fraction of the input pixels) of the output of every down-sampling stage
+    down = [(ngf, 1.)] + [(min(max_features, ngf * 2 ** (i + 1)), 4. ** -(i + 1)) for i in range(n_downsampling)]
+    # Values of every tensor of the forward pass, per input pixel: the up-sampling stages take the concatenated skip
+    sizes = [channels * scale for channels, scale in down]
+    for i in range(n_downsampling + 1):
+        level = n_downsampling - i
+        channels = min(max_features, ngf * 2 ** level) if i < n_downsampling else ngf
+        sizes.append((channels + (down[level][0] if cat else 0)) * 4. ** -level)
+        if i < n_downsampling:
+            sizes.append(min(max_features, ngf * 2 ** (level - 1)) * 4. ** -(level - 1))
+
+    held = sum(channels * scale for channels, scale in down) if skip else 0.
+    peak = (2 if chunked else 3) * max(sizes)
+    return (held + peak) * bytes_per_value
+
+
+def whole_page_pixels(config: dict, memory_budget, chunked=False):
+    """:return: largest number of pixels of a padded page binarized in one forward pass within memory_budget bytes"""
+    if not supports_whole_page(config):
+        return 0
+    return int(memory_budget // activation_bytes_per_pixel(config, chunked=chunked))
+
+
+def config_path(model_path):
+    """Path of the JSON configuration stored next to an exported TorchScript or ONNX model."""
+    return Path(str(model_path) + '.json')
+
+
+def save_config(config: dict, model_path):
+    with open(config_path(model_path), 'w') as file:
+        json.dump(config, file, indent=2, default=str)
+
+
+def load_config(model_path):
+    with open(config_path(model_path)) as file:
+        return json.load(file)
+
+
+class EagerBackend:
+    """
+    Runs a LaMa module, loaded from a training checkpoint or from a model exported by export_inference.py. With
+    chunk_size, the model runs stage by stage over chunks of the input (see ChunkedLaMa), keeping the outputs of the
+    stages in host memory.
+    """
+
+    def __init__(self, path, device, fuse=False, chunk_size=None):
+        checkpoint = torch.load(path, map_location=device)
+        self.config = checkpoint['config']
+        if isinstance(checkpoint['model'], nn.Module):
+            self.model = checkpoint['model']
+        else:
+            self.model = make_model(self.config)
+            self.model.load_state_dict(checkpoint['model'], strict=True)
+        self.model = self.model.to(device).eval()
+
+        if fuse:
+            from modules.fusion import make_inference_model
+            self.model = make_inference_model(self.model)
+
+        if chunk_size:
+            from modules.chunked import ChunkedLaMa
+            self.model = ChunkedLaMa(self.model, chunk_size, buffer_device=torch.device('cpu'))
+
+    def eval(self):
+        return self
+
+    def __call__(self, tensor):
+        return self.model(tensor)
+
+
+class TorchScriptBackend:
+
+    def __init__(self, path, device):
+        self.config = load_config(path)
+        self.model = torch.jit.load(str(path), map_location=device).eval()
+
+    def eval(self):
+        return self
+
+    def __call__(self, tensor):
+        return self.model(tensor)
+
+
+class OnnxBackend:
+    """Runs an ONNX export on CPU with onnxruntime, with every graph optimization enabled."""
+
+    def __init__(self, path, device=None, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend requires onnxruntime: pip install onnxruntime')
+
+        self.config = load_config(path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(path), sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, tensor):
+        output = self.session.run(None, {self.input_name: tensor.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(tensor.device)
+
+
+def make_backend(kind: str, path, device, **kwargs):
+    if kind == 'eager':
+        return EagerBackend(path, device, **kwargs)
+    elif kind == 'torchscript':
+        return TorchScriptBackend(path, device, **kwargs)
+    elif kind == 'onnx':
+        return OnnxBackend(path, device, **kwargs)
+    else:
+        raise NotImplementedError(f"Backend {kind} not implemented")
+
+
+class Binarizer:
+    """
+    Inference-only binarization of pages: only needs a model callable (a module or one of the backends) and the
+    configuration of the checkpoint.
+    """
+
+    def __init__(self, model, config, device=None):
+        self.model = model
+        self.config = config
+        self.device = device
+
+    @classmethod
+    def from_file(cls, path, backend='eager', device=None, **kwargs):
+        runtime = make_backend(backend, path, device, **kwargs)
+        return cls(runtime, runtime.config, device)
+
+    @torch.no_grad()
+    def binarize(self, items, threshold):
+        """
+        :param items: iterable of test items, or of lists of test items, as accepted by TileScheduler.run. Items built
+        with whole_page_pixels carry the whole page, which is binarized in a single forward pass
+        :return: generator of (image name, binarized page with shape (1, 1, h, w))
+        """
+        self.model.eval()
+        scheduler = TileScheduler(self.model, self.config, device=self.device)
+        for item, pred in scheduler.run(items):
+            yield item['image_name'][0], torch.where(pred > threshold, 1., 0.)
+
+    @torch.no_grad()
+    def stream_binarize(self, stream, writer, threshold):
+        """
+        Binarize a page one row of patches at a time.
+
+        :param stream: TileRowStream of the page
+        :param writer: PngStreamWriter receiving the finished rows of the binarized page
+        """
+        self.model.eval()
+        batch_size = self.config.get('tile_batch_size', self.config['train_batch_size'])
+        reconstructor = RowReconstructor(stream.height, stream.width, stream.origins_y, stream.origins_x,
+                                         stream.patch_size, stream.stride,
+                                         blending=self.config.get('test_blending', 'crop'))
+        for row, patches in stream:
+            pred = torch.cat([self.model(chunk.to(self.device)) for chunk in torch.split(patches, batch_size)])
+            rows = reconstructor.add_row(row, pred)
+            rows = torch.where(rows > threshold, 255, 0).to(torch.uint8)
+            writer.write_rows(rows.cpu().numpy())
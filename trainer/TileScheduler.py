@@ -0,0 +1,136 @@
+from collections import deque
+
+import torch
+
+from data.utils import reconstruct_ground_truth, blank_tiles
+
+
+class _Page:
+
+    def __init__(self, item, num_tiles):
+        self.item = item
+        self.num_tiles = num_tiles
+        self.outputs = None
+        self.done = 0
+        # Indices of the patches run by the model, when the blank ones are skipped
+        self.kept = None
+        self.tile_shape = None
+
+    @property
+    def finished(self):
+        return self.done == self.num_tiles
+
+
+class TileScheduler:
+    """
+    Packs the patches of consecutive pages into fixed-size batches, runs the model once per batch and routes
+    every output tile back to the page it belongs to. Pages are returned in the order they were received.
+
+    Whole pages (items with a 'page' instead of 'samples_patches') are binarized on their own in a single forward pass.
+
+    With config['blank_tile_std'] > 0, the patches that blank_tiles finds to be background are not run and their
+    output is filled with 1. (white). Their mask is added to the items as 'blank_tiles'.
+    """
+
+    def __init__(self, model, config, device=None, batch_size=None):
+        self.model = model
+        self.config = config
+        self.device = device
+        self.batch_size = batch_size if batch_size else config.get('tile_batch_size', config['train_batch_size'])
+        self.blank_std = config.get('blank_tile_std', 0)
+        self.blank_min_mean = config.get('blank_tile_min_mean', 0.5)
+
+        self._pages = deque()
+        self._queue = deque()
+        self._queued = 0
+
+    def run(self, items):
+        """
+        :param items: iterable of test items (as returned by a TestDataset loader with batch size 1), or of lists of
+        test items (as returned by a loader with collate_pages)
+        :return: generator of (item, prediction) where prediction is the reconstructed page with shape (1, 1, h, w)
+        """
+        for batch in items:
+            for item in batch if isinstance(batch, list) else [batch]:
+                self._add(item)
+            while self._queued >= self.batch_size:
+                self._step()
+            yield from self._pop_finished()
+
+        while self._queued > 0:
+            self._step()
+        yield from self._pop_finished()
+
+    def _add(self, item):
+        if 'page' in item:
+            page = _Page(item, 1)
+            page.outputs = self.model(item['page'].to(self.device))
+            page.done = 1
+            self._pages.append(page)
+            return
+
+        patches = item['samples_patches'].squeeze(0).squeeze(0)  # loader and page batch dimensions
+        patches = patches.permute(1, 0, 2, 3)  # (num_tiles, channels, patch_size, patch_size)
+
+        page = _Page(item, patches.shape[0])
+        if self.blank_std:
+            blank = blank_tiles(patches, self.blank_std, self.blank_min_mean)
+            item['blank_tiles'] = blank
+            if blank.any():
+                page.kept = (~blank).nonzero()[:, 0]
+                page.tile_shape = patches.shape
+                patches = patches[page.kept]
+                page.num_tiles = patches.shape[0]
+
+        self._pages.append(page)
+        if page.num_tiles:
+            self._queue.append((page, 0, patches))
+            self._queued += page.num_tiles
+
+    def _step(self):
+        chunks, owners = [], []
+        needed = self.batch_size
+        while needed > 0 and self._queue:
+            page, start, patches = self._queue[0]
+            take = min(needed, patches.shape[0])
+            chunks.append(patches[:take])
+            owners.append((page, start, take))
+            if take == patches.shape[0]:
+                self._queue.popleft()
+            else:
+                self._queue[0] = (page, start + take, patches[take:])
+            needed -= take
+
+        batch = torch.cat(chunks).to(self.device)
+        pred = self.model(batch)
+        self._queued -= batch.shape[0]
+
+        offset = 0
+        for page, start, take in owners:
+            if page.outputs is None:
+                page.outputs = pred.new_empty((page.num_tiles,) + pred.shape[1:])
+            page.outputs[start:start + take] = pred[offset:offset + take]
+            page.done += take
+            offset += take
+
+    def _pop_finished(self):
+        while self._pages and self._pages[0].finished:
+            page = self._pages.popleft()
+            item = page.item
+            original = item['gt_sample'].to(self.device) if 'gt_sample' in item else item['page_size'][0].tolist()
+            if 'page' in item:
+                # Crop the padding of the page
+                height, width = original.shape[-2:] if torch.is_tensor(original) else original
+                yield item, page.outputs[:, :, :height, :width]
+                continue
+            outputs = page.outputs
+            if page.kept is not None:
+                num_tiles, _, height, width = page.tile_shape
+                channels = outputs.shape[1] if outputs is not None else self.config.get('output_channels', 1)
+                dtype, device = (outputs.dtype, outputs.device) if outputs is not None else (torch.float32, self.device)
+                outputs = torch.ones((num_tiles, channels, height, width), dtype=dtype, device=device)
+                if page.outputs is not None:
+                    outputs[page.kept.to(device)] = page.outputs
+            pred = reconstruct_ground_truth(outputs, original, num_rows=item['num_rows'].item(),
+                                            config=self.config)
+            yield item, pred
@@ -0,0 +1,127 @@
+import math
+import random
+from statistics import NormalDist
+
+import torch
+
+from data.dataloaders import dataset_num_tiles
+from data.utils import make_test_patches
+from utils.htr_logging import get_logger
+
+logger = get_logger(__file__)
+
+
+class ValidationScheduler:
+    """
+    Decides after which epochs the full validation and test passes run.
+
+    The passes run every every_epochs epochs, or once at least every_steps training steps have been done since the
+    last ones (checked at the end of every epoch). With subset_tiles > 0, the model (the EMA model when EMA is on, as
+    for patience) is first evaluated on a fixed random subset of validation tiles, and the full passes only run when
+    the subset PSNR is not confidently below the best subset PSNR so far, i.e. when the model may have improved. The
+    last epoch is always fully evaluated.
+    """
+
+    def __init__(self, trainer, every_epochs=1, every_steps=0, subset_tiles=0, confidence=0.95, seed=0):
+        self.trainer = trainer
+        self.every_epochs = max(1, every_epochs)
+        self.every_steps = every_steps
+        self.subset_tiles = subset_tiles
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.seed = seed
+
+        self.best_subset_psnr = None
+        self._last_epoch = None
+        self._last_steps = 0
+        self._subset = None
+
+    def should_evaluate(self, epoch, steps):
+        """
+        :param steps: number of training steps done so far
+        :return: whether to run the full passes, and the values to log
+        """
+        last_epoch = epoch == self.trainer.num_epochs - 1
+        if self.every_steps:
+            due = self._last_epoch is None or steps - self._last_steps >= self.every_steps
+        else:
+            due = (epoch + 1) % self.every_epochs == 0
+        if not due and not last_epoch:
+            return False, {}
+
+        logs = {}
+        evaluate = True
+        if self.subset_tiles:
+            psnr, half_width = self.estimate()
+            logs = {'valid/subset_psnr': psnr, 'valid/subset_psnr_ci': half_width}
+            evaluate = last_epoch or self.best_subset_psnr is None or psnr + half_width >= self.best_subset_psnr
+            logger.info(f"Subset validation PSNR: {psnr:.4f} +- {half_width:.4f} "
+                        f"(best {self.best_subset_psnr if self.best_subset_psnr is not None else float('nan'):.4f})"
+                        f"{'' if evaluate else ': skipping the full validation'}")
+            self.best_subset_psnr = psnr if self.best_subset_psnr is None else max(self.best_subset_psnr, psnr)
+
+        if evaluate:
+            self._last_epoch = epoch
+            self._last_steps = steps
+        return evaluate, logs
+
+    def _make_subset(self):
+        """Draw subset_tiles random tiles of the validation pages, once, and keep them as uint8 tensors."""
+        dataset = self.trainer.valid_dataset
+        num_tiles = dataset_num_tiles(dataset)
+        if num_tiles is None:
+            raise ValueError("Subset validation needs a validation set of full pages")
+
+        rng = random.Random(self.seed)
+        tiles = sorted(rng.sample(range(sum(num_tiles)), min(self.subset_tiles, sum(num_tiles))))
+
+        samples, gts = [], []
+        page, page_start = 0, 0
+        by_page = {}
+        for tile in tiles:
+            while tile >= page_start + num_tiles[page]:
+                page_start += num_tiles[page]
+                page += 1
+            by_page.setdefault(page, []).append(tile - page_start)
+
+        config = self.trainer.config
+        for page, indices in by_page.items():
+            item = dataset[page]
+            sample_patches = item['samples_patches'][0].permute(1, 0, 2, 3)
+            gt_patches, _ = make_test_patches(item['gt_sample'].unsqueeze(0), config['valid_patch_size'],
+                                              config['test_stride'], config.get('test_tiling', 'shift'))
+            gt_patches = gt_patches[0].permute(1, 0, 2, 3)
+            samples.append(sample_patches[indices].mul(255).round().to(torch.uint8))
+            gts.append(gt_patches[indices].mul(255).round().to(torch.uint8))
+        return torch.cat(samples), torch.cat(gts)
+
+    @torch.no_grad()
+    def estimate(self):
+        """:return: mean PSNR of the subset tiles and the half width of its confidence interval"""
+        if self._subset is None:
+            self._subset = self._make_subset()
+        samples, gts = self._subset
+
+        trainer = self.trainer
+        threshold = trainer.config['threshold']
+        batch_size = trainer.config.get('tile_batch_size', trainer.config['train_batch_size'])
+        if trainer.ema_rate:
+            trainer.load_ema()
+        trainer.model.eval()
+
+        psnrs = []
+        for start in range(0, samples.shape[0], batch_size):
+            sample = samples[start:start + batch_size].to(trainer.device).float().div_(255)
+            gt = gts[start:start + batch_size].to(trainer.device).float().div_(255)
+            pred = torch.where(trainer.model(sample) > threshold, 1., 0.)
+            gt = torch.where(gt > threshold, 1., 0.)
+            mse = (pred - gt).pow(2).mean(dim=(1, 2, 3))
+            # Same convention as calculate_psnr for perfect tiles
+            psnrs.append(torch.where(mse > 0, -10 * torch.log10(mse.clamp_min(1e-12)), torch.full_like(mse, 100.)))
+
+        trainer.model.train()
+        if trainer.ema_rate:
+            trainer.load_model()
+
+        psnrs = torch.cat(psnrs).double()
+        half_width = self.z * psnrs.std().item() / math.sqrt(len(psnrs)) if len(psnrs) > 1 else float('inf')
+        return psnrs.mean().item(), half_width
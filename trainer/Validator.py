@@ -1,3 +1,5 @@
+import math
+
 import torch
 from ignite.engine import Engine
 from ignite.metrics import PSNR, Precision, Recall
@@ -20,6 +22,7 @@ def eval_step(apply_threshold=True, threshold=0.5):
 class Validator:
     def __init__(self, apply_threshold=True, threshold=0.5):
         self.apply_threshold = apply_threshold
+        self.threshold = threshold
         self._evaluator = Engine(eval_step(self.apply_threshold, threshold))
 
         self._psnr = PSNR(data_range=1.0)
@@ -35,6 +38,13 @@ class Validator:
 
         self._count = 0
         self._psnr_value = 0.0
+        self._reset_skipped()
+
+    def _reset_skipped(self):
+        self._skipped_count = 0
+        self._skip_ratio_value = 0.0
+        self._skipped_ink_value = 0.0
+        self._skip_psnr_cost_value = 0.0
 
     def compute(self, predicts: torch.Tensor, targets: torch.Tensor):
         state = self._evaluator.run([[predicts, targets]])
@@ -54,6 +64,41 @@ class Validator:
 
         return metrics
 
+    def compute_skipped(self, predicts: torch.Tensor, targets: torch.Tensor, blank_tiles: torch.Tensor,
+                        skipped: torch.Tensor):
+        """
+        Effect of skipping the blank patches of a page (see TileScheduler).
+
+        :param predicts: binarized page with shape (1, 1, height, width)
+        :param blank_tiles: bool tensor with one entry per patch of the page, True for the skipped patches
+        :param skipped: bool tensor with the page shape, True where the page was filled with white instead of running
+        the model
+        :return: the fraction of skipped patches, the percentage of ink of the ground truth inside the skipped area
+        (missed by construction) and the PSNR the page would gain if the skipped area had no error (an upper bound
+        of the PSNR cost of skipping)
+        """
+        targets = torch.where(targets > self.threshold, 1., 0.) if self.apply_threshold else targets
+        error = (predicts - targets).pow(2)
+        mse = error.mean().item()
+        mse_skipped = (error * skipped).sum().item() / error.numel()
+        ink = 1. - targets
+        total_ink = ink.sum().item()
+
+        def psnr(value):
+            return 100. if value <= 0 else -10 * math.log10(value)
+
+        metrics = {
+            'skip_ratio': blank_tiles.float().mean().item(),
+            'skipped_ink': 100. * (ink * skipped).sum().item() / total_ink if total_ink > 0 else 0.,
+            'skip_psnr_cost': psnr(mse - mse_skipped) - psnr(mse),
+        }
+
+        self._skipped_count += 1
+        self._skip_ratio_value += metrics['skip_ratio']
+        self._skipped_ink_value += metrics['skipped_ink']
+        self._skip_psnr_cost_value += metrics['skip_psnr_cost']
+        return metrics
+
     def get_metrics(self):
         psnr = self._psnr_value / self._count
         metrics = {'psnr': psnr}
@@ -64,6 +109,11 @@ class Validator:
             metrics['precision'] = precision
             metrics['recall'] = recall
 
+        if self._skipped_count:
+            metrics['skip_ratio'] = self._skip_ratio_value / self._skipped_count
+            metrics['skipped_ink'] = self._skipped_ink_value / self._skipped_count
+            metrics['skip_psnr_cost'] = self._skip_psnr_cost_value / self._skipped_count
+
         return metrics
 
     def reset(self):
@@ -73,3 +123,5 @@ class Validator:
         if self.apply_threshold:
             self._precision_value = 0
             self._recall_value = 0
+
+        self._reset_skipped()
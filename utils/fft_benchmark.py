@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import torch
+
+from modules.FFC import LaMa, set_fft_plan_cache_size
+
+
+def make_model(use_fft, n_blocks, n_downsampling, ratio):
+    model = LaMa(input_nc=3, output_nc=1, n_downsampling=n_downsampling,
+                 init_conv_kwargs={'ratio_gin': 0, 'ratio_gout': 0},
+                 downsample_conv_kwargs={'ratio_gin': 0, 'ratio_gout': 0},
+                 resnet_conv_kwargs={'ratio_gin': ratio, 'ratio_gout': ratio, 'use_fft': use_fft},
+                 n_blocks=n_blocks, use_convolutions=False)
+    return model.eval()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def benchmark(model, tile_size, batch_size, repeats, warmup, device):
+    tiles = torch.rand(batch_size, 3, tile_size, tile_size, device=device)
+    for _ in range(warmup):
+        model(tiles)
+
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model(tiles)
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeats * batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the throughput of the spectral and the conv-only '
+                                                 'FourierUnit')
+    parser.add_argument('--tile_sizes', type=int, nargs='+', default=[128, 256, 384, 512, 768])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_blocks', type=int, default=9)
+    parser.add_argument('--n_downsampling', type=int, default=3)
+    parser.add_argument('--ratio', type=float, default=0.75, help='ratio of global channels in the resnet blocks')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--fft_plan_cache_size', type=int, default=16,
+                        help='cuFFT plans kept for reuse on a CUDA device (0 to rebuild the plans on every call)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    set_fft_plan_cache_size(args.fft_plan_cache_size, device)
+
+    models = {
+        'conv': make_model(False, args.n_blocks, args.n_downsampling, args.ratio).to(device),
+        'fft': make_model(True, args.n_blocks, args.n_downsampling, args.ratio).to(device),
+    }
+    for name, model in models.items():
+        num_params = sum(p.numel() for p in model.parameters())
+        print(f'{name}: {num_params} parameters')
+
+    print(f'{"tile":>6} {"conv ms/tile":>14} {"fft ms/tile":>14} {"conv tiles/s":>14} {"fft tiles/s":>14} '
+          f'{"fft/conv":>10}')
+    for tile_size in args.tile_sizes:
+        times = {name: benchmark(model, tile_size, args.batch_size, args.repeats, args.warmup, device)
+                 for name, model in models.items()}
+        print(f'{tile_size:>6} {times["conv"] * 1000:>14.2f} {times["fft"] * 1000:>14.2f} '
+              f'{1 / times["conv"]:>14.2f} {1 / times["fft"]:>14.2f} {times["fft"] / times["conv"]:>10.2f}')
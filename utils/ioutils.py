@@ -1,4 +1,11 @@
 import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
 
 from utils.htr_logging import get_logger
 
@@ -15,3 +22,90 @@ def store_images(parent_directory: str, directory: str, names: list, images: lis
         image.save(path)
         logger.debug(f"Saved {name} image")
     logger.info(f"Stored {len(names)} in \"{folder}\"")
+
+
+class PngStreamWriter:
+    """Writes an 8-bit grayscale PNG a few rows at a time, so the whole image never has to be held in memory."""
+
+    def __init__(self, path, width: int, height: int):
+        self.width = width
+        self.height = height
+        self._rows = 0
+        self._compressor = zlib.compressobj()
+        self._file = open(path, 'wb')
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _write_chunk(self, kind: bytes, data: bytes):
+        self._file.write(struct.pack('>I', len(data)) + kind + data)
+        self._file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        :param rows: uint8 array with shape (n, width)
+        """
+        assert rows.shape[1] == self.width, f"Expected rows of width {self.width}, got {rows.shape[1]}"
+        scanlines = np.zeros((rows.shape[0], self.width + 1), dtype=np.uint8)  # filter type 0 on every scanline
+        scanlines[:, 1:] = rows
+        self._rows += rows.shape[0]
+        data = self._compressor.compress(scanlines.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+    def close(self):
+        assert self._rows == self.height, f"Written {self._rows} rows out of {self.height}"
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
+
+
+class AsyncImageWriter:
+    """
+    Encodes and writes images on a pool of threads. At most max_pending images are queued: submit blocks when the
+    writers fall behind, so memory stays bounded.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8, compress_level: int = 6):
+        self.compress_level = compress_level
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def submit(self, image: np.ndarray, path):
+        """
+        :param image: uint8 array with shape (h, w) or (h, w, 3)
+        """
+        self._slots.acquire()
+        future = self._executor.submit(self._write, image, path)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+        self._futures.append(future)
+
+    def _write(self, image, path):
+        # Write to a temporary file first: an interrupted run never leaves a truncated image behind
+        image_format = Image.registered_extensions()[os.path.splitext(str(path))[1].lower()]
+        tmp_path = f'{path}.tmp'
+        Image.fromarray(image).save(tmp_path, format=image_format, compress_level=self.compress_level)
+        os.replace(tmp_path, path)
+        logger.debug(f"Saved {path}")
+
+    def close(self):
+        """Wait for the pending images and raise the first error of the writers, if any."""
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()